@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Measure how long importing the CLI takes, with ``python -X importtime``, and
+check it stays within a budget.
+
+The CLI is imported in fresh interpreters several times, and the median of the
+cumulative import times is compared to the budget, along with the modules of
+the commands for reference. The slowest imports of the CLI are listed, to find
+what to defer when the budget is exceeded.
+
+Usage: python benchmarks/cli_import_time.py [budget in milliseconds]
+
+The exit status is 1 if the CLI takes longer than the budget to import.
+"""
+
+import statistics
+import subprocess
+import sys
+
+
+#: The default budget for importing the CLI, in milliseconds.
+BUDGET = 150
+RUNS = 5
+
+MODULES = [
+    "fedmsg_migration_tools.cli",
+    "fedmsg_migration_tools.offline",
+    "fedmsg_migration_tools.replay",
+    "fedmsg_migration_tools.capture",
+    "fedmsg_migration_tools.bridges",
+    "fedmsg_migration_tools.verify_missing_asyncio",
+    "fedmsg_migration_tools.verify_missing",
+]
+
+
+def import_times(module):
+    """
+    Import a module in a new interpreter.
+
+    Returns:
+        dict: The cumulative import time of each module imported, in
+            milliseconds.
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    ).stderr.decode("utf-8")
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        try:
+            times[name.strip()] = int(cumulative) / 1000.0
+        except ValueError:
+            # The header line
+            continue
+    return times
+
+
+def measure(module):
+    """Return the median time to import a module, and the times of a run."""
+    runs = [import_times(module) for _ in range(RUNS)]
+    return statistics.median(run[module] for run in runs), runs[-1]
+
+
+def main(budget):
+    results = {module: measure(module) for module in MODULES}
+    for module in MODULES:
+        print("{:<50}{:>8.0f}ms".format(module, results[module][0]))
+
+    cli_time, cli_imports = results["fedmsg_migration_tools.cli"]
+    print("\nSlowest imports of the CLI:")
+    top_level = {}
+    for name, time in cli_imports.items():
+        package = name.split(".")[0]
+        top_level[package] = max(top_level.get(package, 0), time)
+    for package, time in sorted(top_level.items(), key=lambda i: -i[1])[:8]:
+        print("  {:<48}{:>8.1f}ms".format(package, time))
+
+    if cli_time > budget:
+        print(
+            "\nImporting the CLI takes {:.0f}ms, over the {:.0f}ms budget".format(
+                cli_time, budget
+            )
+        )
+        return 1
+    print(
+        "\nImporting the CLI takes {:.0f}ms, within the {:.0f}ms budget".format(
+            cli_time, budget
+        )
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Compare the time taken to get the ID of signed fedmsg messages by decoding them
+entirely, like the verify_missing ZeroMQ consumer used to, and with
+:func:`matching.extract_msg_id`.
+
+Usage: python benchmarks/msg_id_extraction.py [number of messages]
+"""
+
+import json
+import sys
+import time
+
+import fedmsg.encoding
+
+from fedmsg_migration_tools.matching import extract_msg_id
+
+from verify_missing_memory import make_message
+
+
+def sign(msg):
+    """Add a certificate and a signature of typical sizes, as fedmsg does."""
+    msg = dict(msg, crypto="x509", certificate="c" * 2400, signature="s" * 344)
+    return fedmsg.encoding.dumps(msg).encode("utf-8")
+
+
+def measure(bodies, get_msg_id):
+    """Return the time taken to get the ID of every message, in seconds."""
+    start = time.perf_counter()
+    for body in bodies:
+        get_msg_id(body)
+    return time.perf_counter() - start
+
+
+def full_decode(body):
+    return json.loads(body)["msg_id"]
+
+
+def main(count):
+    bodies = [sign(make_message(i)) for i in range(count)]
+    full = measure(bodies, full_decode)
+    fast = measure(bodies, extract_msg_id)
+    print("Messages:    {}".format(count))
+    print("Full decode: {:.0f} messages/s".format(count / full))
+    print("Extraction:  {:.0f} messages/s".format(count / fast))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Compare the startup time and memory of the Twisted and asyncio engines of the
+verify_missing service.
+
+Each engine is measured in a fresh interpreter: the time to import it and build
+its comparator and consumers, the resident memory once built, and the resident
+memory and throughput once its ZeroMQ consumer has handled a number of messages
+left waiting for their AMQP counterparts.
+
+Usage: python benchmarks/verify_missing_engines.py [number of messages]
+"""
+
+import json
+import resource
+import subprocess
+import sys
+import time
+import uuid
+
+
+def rss():
+    """Return the current resident memory of this process, in MiB."""
+    with open("/proc/self/statm") as fd:
+        pages = int(fd.read().split()[1])
+    return pages * resource.getpagesize() / 2**20
+
+
+def build(engine):
+    """Import an engine and build its service, without starting it."""
+    if engine == "twisted":
+        from fedmsg_migration_tools import verify_missing
+
+        services = verify_missing.get_main_service([])
+        return next(s for s in services if isinstance(s, verify_missing.ZmqConsumer))
+    from fedmsg_migration_tools import verify_missing_asyncio
+    from fedmsg_migration_tools.matching import make_comparator
+
+    comparator = make_comparator(verify_missing_asyncio.Comparator)
+    verify_missing_asyncio.AmqpConsumer(comparator.amqp_store, comparator)
+    return verify_missing_asyncio.ZmqConsumer(comparator.zmq_store, [], comparator)
+
+
+def measure(engine, count):
+    """Measure an engine in this interpreter, and print the results as JSON."""
+    messages = [
+        (json.dumps({"msg_id": "2019-{}".format(uuid.uuid4()), "msg": {}}).encode(),)
+        for _ in range(count)
+    ]
+    start = time.perf_counter()
+    zmq_consumer = build(engine)
+    startup = time.perf_counter() - start
+    idle = rss()
+    start = time.perf_counter()
+    for (body,) in messages:
+        zmq_consumer.on_message(body, b"org.fedoraproject.prod.dummy.topic")
+    rate = count / (time.perf_counter() - start)
+    json.dump(
+        {"startup": startup, "idle": idle, "loaded": rss(), "rate": rate}, sys.stdout
+    )
+
+
+def main(count):
+    print(
+        "{:<10}{:>12}{:>12}{:>16}{:>14}".format(
+            "Engine",
+            "Startup",
+            "Idle RSS",
+            "RSS with {}k".format(count // 1000),
+            "Messages/s",
+        )
+    )
+    for engine in ("twisted", "asyncio"):
+        output = subprocess.check_output(
+            [sys.executable, __file__, "--measure", engine, str(count)]
+        )
+        result = json.loads(output.decode("utf-8").splitlines()[-1])
+        print(
+            "{:<10}{:>10.0f}ms{:>8.1f} MiB{:>12.1f} MiB{:>14.0f}".format(
+                engine,
+                result["startup"] * 1000,
+                result["idle"],
+                result["loaded"],
+                result["rate"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Compare the memory used by the verify_missing stores when holding full message
+copies, like they used to, and when holding :class:`store.Record` instances.
+
+Usage: python benchmarks/verify_missing_memory.py [number of messages]
+"""
+
+from datetime import datetime
+import json
+import sys
+import tracemalloc
+import uuid
+
+from fedmsg_migration_tools.store import Record, Store
+
+
+TOPICS = [
+    "org.fedoraproject.prod.buildsys.task.state.change",
+    "org.fedoraproject.prod.copr.build.end",
+    "org.fedoraproject.prod.bodhi.update.comment",
+    "org.fedoraproject.prod.git.receive",
+]
+
+
+def make_message(i):
+    """Build a fedmsg of a typical size."""
+    return {
+        "topic": TOPICS[i % len(TOPICS)],
+        "msg_id": "{}-{}".format(datetime.utcnow().year, uuid.uuid4()),
+        "timestamp": 1546300800 + i,
+        "i": i,
+        "username": "apache",
+        "msg": {
+            "owner": "packager",
+            "name": "package-{}".format(i),
+            "version": "1.0.{}".format(i),
+            "release": "1.fc30",
+            "changelog": "x" * 512,
+        },
+    }
+
+
+def measure(messages, make_value):
+    """Return the memory, in bytes, of a store holding the given messages."""
+    tracemalloc.start()
+    store = Store()
+    before = tracemalloc.get_traced_memory()[0]
+    for topic, msg_id, body in messages:
+        store[msg_id] = make_value(topic, body)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before
+
+
+def full_copy(topic, body):
+    return (datetime.utcnow(), json.loads(body))
+
+
+def record(topic, body):
+    return Record(topic)
+
+
+def main(count):
+    messages = []
+    for i in range(count):
+        msg = make_message(i)
+        # Decode the topics like the consumers do, so each message has its own copy
+        topic = msg["topic"].encode("utf-8").decode("utf-8")
+        messages.append((topic, msg["msg_id"][5:], json.dumps(msg)))
+
+    full = measure(messages, full_copy)
+    compact = measure(messages, record)
+    print("Messages:          {}".format(count))
+    print("Full copies:       {:.1f} MiB".format(full / 2**20))
+    print("Records:           {:.1f} MiB".format(compact / 2**20))
+    print("Bytes per message: {:.0f} -> {:.0f}".format(full / count, compact / count))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,44 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Connection to the AMQP broker with pika directly.
+
+Unlike :mod:`fedora_messaging.api`, this doesn't import Twisted.
+"""
+
+import ssl
+
+from fedora_messaging import config as fm_config
+import pika
+
+
+def connection_parameters():
+    """
+    Build the connection parameters to the AMQP broker from the fedora-messaging
+    configuration.
+
+    Returns:
+        pika.URLParameters: The connection parameters.
+    """
+    parameters = pika.URLParameters(fm_config.conf["amqp_url"])
+    if parameters.ssl_options is not None:
+        tls = fm_config.conf["tls"]
+        ssl_context = ssl.create_default_context(cafile=tls["ca_cert"])
+        if tls["certfile"]:
+            ssl_context.load_cert_chain(tls["certfile"], tls["keyfile"])
+        parameters.ssl_options = pika.SSLOptions(ssl_context, parameters.host)
+    return parameters
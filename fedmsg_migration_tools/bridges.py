@@ -15,54 +15,987 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+from collections import OrderedDict, namedtuple
 import datetime
 import json
 import logging
+import math
 import re
+import signal
 import socket
 import time
+import types
 
 from fedmsg import config as fedmsg_config
 from fedora_messaging import api, config as fm_config
-from fedora_messaging.message import Message
-from fedora_messaging.exceptions import Nack, HaltConsumer
+from fedora_messaging.message import Message, get_message
+from fedora_messaging.exceptions import Nack, HaltConsumer, ValidationError
 import fedmsg
+import pika
 import zmq
 
+from fedmsg_migration_tools import spill
+from fedmsg_migration_tools.amqp import connection_parameters
+from fedmsg_migration_tools.lanes import Lanes
+from fedmsg_migration_tools.metrics import write_json
+from fedmsg_migration_tools.monitor import (
+    SocketMonitor,
+    set_socket_options,
+    socket_options,
+)
+from fedmsg_migration_tools.notify import Notifier, Watchdog
+from fedmsg_migration_tools.shaping import Shaper
+from fedmsg_migration_tools.tuning import BurstProfile, Tuner
+
 _log = logging.getLogger(__name__)
 
 
 YEAR_PREFIX_RE = re.compile("^[0-9]{4}-")
 
 
-def zmq_to_amqp(exchange, zmq_endpoints, topics):
+class RuntimeConfig(
+    namedtuple(
+        "RuntimeConfig",
+        [
+            "exchange",
+            "topics",
+            "validate_signatures",
+            "sign_messages",
+            "crypto_config",
+            "publish_endpoint",
+            "remote_publish",
+            "socket_options",
+        ],
+    )
+):
+    """
+    The configuration the bridges need for each message, resolved once.
+
+    The fedmsg and fedora-messaging configurations are looked up when this is
+    built, with :meth:`from_config`, rather than for each message. It is
+    immutable, so it can be shared between threads, and the bridges keep a
+    reference to it instead of changing the global configurations.
+
+    Attributes:
+        exchange (str): The AMQP exchange to publish to.
+        topics (tuple): The ZeroMQ topics to subscribe to, encoded in UTF-8.
+        validate_signatures (bool): Whether to drop the ZeroMQ messages whose
+            signature is invalid.
+        sign_messages (bool): Whether to sign the messages published to ZeroMQ.
+        crypto_config (types.MappingProxyType): A read-only copy of the fedmsg
+            configuration, to pass to :mod:`fedmsg.crypto`. When signing, its
+            "certname" is the one to sign with.
+        publish_endpoint (str): The ZeroMQ endpoint to publish to.
+        remote_publish (bool): Whether to connect to the publish endpoint
+            rather than bind to it.
+        socket_options (tuple): The reconnection and heartbeat options of the
+            publication socket, as returned by :func:`monitor.socket_options`.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, exchange=None, topics=()):
+        """
+        Resolve the runtime configuration from the fedmsg and fedora-messaging
+        configurations.
+
+        Args:
+            exchange (str): The AMQP exchange to publish to.
+            topics (list): The ZeroMQ topics to subscribe to, as str or bytes.
+
+        Returns:
+            RuntimeConfig: The runtime configuration.
+
+        Raises:
+            KeyError: If messages are signed, but no certificate name is
+                configured for this host.
+        """
+        crypto_config = fedmsg_config.conf.copy()
+        sign_messages = bool(crypto_config.get("sign_messages", False))
+        if sign_messages and not crypto_config.get("certname"):
+            crypto_config["certname"] = _find_certname(crypto_config)
+        consumer_config = fm_config.conf["consumer_config"]
+        return cls(
+            exchange=exchange,
+            topics=_encode_topics(topics),
+            validate_signatures=bool(crypto_config.get("validate_signatures", False)),
+            sign_messages=sign_messages,
+            crypto_config=types.MappingProxyType(crypto_config),
+            publish_endpoint=consumer_config.get("publish_endpoint", "tcp://*:9940"),
+            remote_publish=bool(consumer_config.get("remote_publish", False)),
+            socket_options=socket_options(consumer_config),
+        )
+
+
+def _find_certname(crypto_config):
+    """
+    Find the name of the certificate to sign messages with, as fedmsg does.
+
+    Args:
+        crypto_config (dict): The fedmsg configuration.
+
+    Returns:
+        str: The certificate name.
+    """
+    hostname = socket.gethostname().split(".", 1)[0]
+    if "cert_prefix" in crypto_config:
+        cert_index = "%s.%s" % (crypto_config["cert_prefix"], hostname)
+    else:
+        cert_index = crypto_config["name"]
+        if cert_index == "relay_inbound":
+            cert_index = "shell.%s" % hostname
+    return crypto_config["certnames"][cert_index]
+
+
+def zmq_to_amqp(exchange, zmq_endpoints, topics, **kwargs):
     """
     Connect to a set of ZeroMQ PUB sockets and re-publish the messages to an AMQP
     exchange.
+
+    See :class:`ZmqToAmqp` for the arguments.
+    """
+    ZmqToAmqp(exchange, zmq_endpoints, topics, **kwargs).run()
+
+
+def _encode_topics(topics):
+    """Return the topics as a tuple of UTF-8 encoded bytes."""
+    return tuple(t if isinstance(t, bytes) else t.encode("utf-8") for t in topics)
+
+
+class Source(object):
+    """
+    A subscription socket connected to a single ZeroMQ endpoint.
+
+    Each endpoint has its own socket, so it can be subscribed to its own topics,
+    have its own receive high water mark and reconnection settings, and have
+    its rates, drops, bursts and connection events counted. The endpoint is
+    considered stalled when no message was received from it for
+    ``stall_timeout``.
+
+    Args:
+        endpoint (str): The ZeroMQ endpoint to connect to.
+        topics (list): The topics to subscribe to.
+        rcvhwm (int): The receive high water mark of the socket: how many
+            messages ZeroMQ queues before dropping the new ones.
+        weight (int): How many times :attr:`ZmqToAmqp.QUANTUM` messages to
+            receive from the endpoint when it is its turn and it has some.
+        options (tuple): The reconnection and heartbeat options of the socket,
+            as returned by :func:`monitor.socket_options`.
+        stall_timeout (float): How long, in seconds, the endpoint can be silent
+            before it is considered stalled. 0 disables the detection.
+
+    Raises:
+        ValueError: If the weight isn't positive.
+    """
+
+    #: ZeroMQ's default receive high water mark.
+    RCVHWM = 1000
+
+    def __init__(
+        self, endpoint, topics, rcvhwm=RCVHWM, weight=1, options=(), stall_timeout=0
+    ):
+        if weight < 1:
+            raise ValueError("The weight of {} must be positive".format(endpoint))
+        self.endpoint = endpoint
+        self.topics = _encode_topics(topics)
+        self.rcvhwm = rcvhwm
+        self.weight = weight
+        self.options = options
+        self.stall_timeout = stall_timeout
+        self.stalled = False
+        #: The settings recommended by the tuner, to apply when the socket
+        #: reconnects, as :meth:`ZmqToAmqp.stats` reports them.
+        self.tuned = None
+        self.socket = None
+        self.monitor = None
+        self.last_received = time.monotonic()
+        self.profile = BurstProfile()
+        self.reset_stats()
+
+    @classmethod
+    def from_config(cls, endpoint, topics):
+        """
+        Args:
+            endpoint: The endpoint, or a dictionary with the ``endpoint`` and
+                optionally its ``topics``, ``rcvhwm``, ``weight``,
+                ``stall_timeout``, and socket options.
+            topics (list): The topics of the endpoints that don't set theirs.
+
+        Returns:
+            Source: The source, not connected yet.
+        """
+        if not isinstance(endpoint, dict):
+            endpoint = {"endpoint": endpoint}
+        return cls(
+            endpoint["endpoint"],
+            endpoint.get("topics", topics),
+            rcvhwm=endpoint.get("rcvhwm", cls.RCVHWM),
+            weight=endpoint.get("weight", 1),
+            options=socket_options(endpoint),
+            stall_timeout=endpoint.get("stall_timeout", 0),
+        )
+
+    def connect(self, context):
+        """Create the subscription socket and its monitor, connect it, and subscribe it."""
+        self.socket = context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.RCVHWM, self.rcvhwm)
+        set_socket_options(self.socket, self.options)
+        self.monitor = SocketMonitor(self.socket, self.endpoint)
+        self.last_received = time.monotonic()
+        self.socket.connect(self.endpoint)
+        _log.info("Connecting ZeroMQ subscription socket to %s", self.endpoint)
+        for topic in self.topics:
+            self._subscribe(topic)
+
+    def close(self):
+        """Close the subscription socket, dropping the messages it queued."""
+        _log.info("Disconnecting ZeroMQ subscription socket from %s", self.endpoint)
+        self.monitor.close()
+        self.socket.close(linger=0)
+        self.socket = None
+        self.monitor = None
+
+    def set_topics(self, topics):
+        """
+        Subscribe to the new topics, and then unsubscribe from the old ones.
+
+        Args:
+            topics (list): The topics to subscribe to.
+        """
+        topics = _encode_topics(topics)
+        for topic in topics:
+            if topic not in self.topics:
+                self._subscribe(topic)
+        for topic in self.topics:
+            if topic not in topics:
+                _log.info('Unsubscribing %s from the "%s" topic', self.endpoint, topic)
+                self.socket.setsockopt(zmq.UNSUBSCRIBE, topic)
+        self.topics = topics
+
+    def _subscribe(self, topic):
+        self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        _log.info('Subscribing %s to the "%s" topic', self.endpoint, topic)
+
+    def receive(self, limit):
+        """
+        Receive the messages the socket has queued, without blocking.
+
+        Args:
+            limit (int): The maximum number of messages to receive.
+
+        Returns:
+            list: The ``(topic, body)`` of the messages. Malformed ones are
+                logged, counted as dropped, and left out.
+        """
+        messages = []
+        count = size = 0
+        drained = False
+        for _ in range(limit):
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                drained = True
+                break
+            count += 1
+            size += sum(len(frame) for frame in frames)
+            if len(frames) != 2:
+                _log.error(
+                    "Unable to unpack a message with %d frames from %s",
+                    len(frames),
+                    self.endpoint,
+                )
+                self.dropped += 1
+                continue
+            messages.append(frames)
+        self.received += count
+        self.bytes += size
+        if count:
+            self.last_received = time.monotonic()
+            self.profile.add(count, size, drained)
+        return messages
+
+    def drain(self):
+        """
+        Unsubscribe from all the topics, so no new message is sent to the
+        socket, and receive the messages it already queued.
+
+        Returns:
+            list: The ``(topic, body)`` of the messages.
+        """
+        for topic in self.topics:
+            self.socket.setsockopt(zmq.UNSUBSCRIBE, topic)
+        self.topics = ()
+        messages = []
+        while True:
+            received = self.received
+            messages.extend(self.receive(self.RCVHWM))
+            if self.received - received < self.RCVHWM:
+                return messages
+
+    def silence(self):
+        """
+        Returns:
+            float: How long since the last message was received, or since the
+                socket was connected, in seconds.
+        """
+        return time.monotonic() - self.last_received
+
+    def check_stall(self):
+        """Log when the endpoint stalls, and when it resumes."""
+        if not self.stall_timeout:
+            return
+        silence = self.silence()
+        if not self.stalled and silence >= self.stall_timeout:
+            self.stalled = True
+            _log.warning(
+                "No message received from %s for %.0f seconds (%s)",
+                self.endpoint,
+                silence,
+                "connected" if self.monitor.connected else "not connected",
+            )
+        elif self.stalled and silence < self.stall_timeout:
+            self.stalled = False
+            _log.info("Receiving messages from %s again", self.endpoint)
+
+    def reset_stats(self):
+        """Forget the statistics counted so far and start a new period."""
+        self.received = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.started = time.monotonic()
+        self.profile.reset_stats()
+
+    @property
+    def rcvbuf(self):
+        """int: The kernel receive buffer size of the socket, or ``None`` if it's the default."""
+        return dict(self.options).get("rcvbuf")
+
+    def stats(self):
+        """
+        Returns:
+            dict: The messages and bytes received, their rate per second, and
+                the messages dropped by the bridge, since the statistics were
+                reset, how long the endpoint has been silent, whether it is
+                stalled, its :class:`tuning.BurstProfile`, and the statistics of
+                its :class:`SocketMonitor`.
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        stats = {
+            "received": self.received,
+            "bytes": self.bytes,
+            "dropped": self.dropped,
+            "rate": self.received / elapsed,
+            "byte_rate": self.bytes / elapsed,
+            "silence": self.silence(),
+            "stalled": self.stalled,
+            "bursts": self.profile.stats(),
+        }
+        if self.monitor is not None:
+            stats.update(self.monitor.stats())
+        return stats
+
+
+class ZmqToAmqp(object):
+    """
+    Re-publish the messages of a set of ZeroMQ PUB sockets to an AMQP exchange.
+
+    Each endpoint is a :class:`Source`, with its own subscription socket, and
+    they are all polled together. When several have messages, each one in turn
+    gets up to its weight times :attr:`QUANTUM` messages received, starting
+    with a different one each time, so a noisy endpoint can't starve the
+    others. The connection events of each endpoint are logged as they happen,
+    and so are the endpoints silent for longer than their ``stall_timeout``.
+    Their rates, drops, and connection statistics are logged every
+    ``report_interval``, along with the high water mark and kernel buffer size
+    recommended for the endpoints whose bursts didn't fit in their current ones.
+    In the ``auto`` tuning mode, the recommended settings are applied the next
+    time the endpoint reconnects: when it is disconnected, when it stalls, or
+    when a reload reconnects it. Replacing the socket of an endpoint that is
+    still sending could receive some messages twice, so it isn't done as soon
+    as the settings are recommended.
+
+    The configuration can be changed without restarting the bridge by sending
+    it SIGHUP, if it was given a ``reload`` function. Sources are created for
+    the new endpoints, and the removed ones are closed. The sources that are
+    kept are subscribed to their new topics and unsubscribed from their old
+    ones, or are replaced if their high water mark or socket options changed,
+    handling the messages the old socket queued. The runtime configuration is
+    then swapped. The AMQP connection stays up. The reload happens in the
+    message loop, between two messages, so every message is handled with
+    either the old or the new configuration.
+
+    The bridge stops on SIGTERM, once it has drained: it unsubscribes from all
+    the topics, and publishes the messages it already received, the ones its
+    sockets queued, and the ones waiting in the shaper and the lanes, until
+    ``drain_timeout`` has elapsed or publishing fails. The messages left are
+    written to ``spill_file``, if set, and are published when the bridge starts
+    again.
+
+    When run by systemd as a ``Type=notify`` service, the bridge tells systemd
+    it is ready once its sockets are connected and the AMQP broker accepts
+    connections, and it is stopping when it starts draining. It pings the
+    watchdog while its message loop makes progress (see
+    :class:`notify.Watchdog`), and reports how many messages it handles per
+    second, how many wait in the lanes and how many the shaper holds back in
+    its status. The messages the shaper holds back are released at its pace,
+    so they don't make the bridge look stuck.
+
+    Args:
+        exchange (str): The AMQP exchange to publish to.
+        zmq_endpoints (list): The ZeroMQ endpoints to subscribe to, as accepted
+            by :meth:`Source.from_config`.
+        topics (list): The ZeroMQ topics to subscribe to, for the endpoints
+            that don't set their own.
+        reload (callable): Called with no arguments on SIGHUP, it returns the
+            new exchange, endpoints and topics. If it raises an exception, the
+            current configuration is kept.
+        shaping (dict): The settings of the :class:`shaping.Shaper` limiting
+            the rate of the messages published, globally and per topic prefix.
+            The messages are not shaped by default. The shaping settings are
+            not reloaded.
+        lanes (dict): The settings of the :class:`lanes.Lanes` the messages
+            are sorted into by priority before being published. The messages
+            are received as fast as possible and queued in their lane, and
+            one is published after each check of the sockets, so the lanes of
+            high priority don't wait behind a burst in another lane. By
+            default, the messages are published in the order they arrive. The
+            lanes are not reloaded.
+        report_interval (float): How often to report the statistics of the
+            endpoints, in seconds. 0 disables the reports.
+        report_file (str): The path of a JSON file to write the statistics of
+            the endpoints, the shaper and the lanes to, when they are reported.
+        tuning (dict): The settings of the :class:`tuning.Tuner` recommending
+            the high water marks and kernel buffer sizes of the endpoints. The
+            tuning settings are not reloaded.
+        drain_timeout (float): How long to spend publishing the messages
+            received so far when stopping, in seconds.
+        spill_file (str): The path of the :mod:`spill` file to write the
+            messages that couldn't be published when stopping to, and to
+            publish the messages of when starting.
+        notifier (notify.Notifier): The notifier to tell systemd about the
+            bridge with. Defaults to one for the process's environment.
     """
-    context = zmq.Context.instance()
-    sub_socket = context.socket(zmq.SUB)
-    for endpoint in zmq_endpoints:
-        sub_socket.connect(endpoint)
-        _log.info("Connecting ZeroMQ subscription socket to %s", endpoint)
-    for topic in topics:
-        sub_socket.setsockopt(zmq.SUBSCRIBE, topic)
-        _log.info('Configuring ZeroMQ subscription socket with the "%s" topic', topic)
 
-    while True:
+    #: How long to wait for a message before checking for a reload, in milliseconds.
+    POLL_TIMEOUT = 500
+    #: How many messages to receive from an endpoint of weight 1 on its turn.
+    QUANTUM = 10
+    #: How often to check whether the endpoints are stalled, in seconds.
+    CHECK_INTERVAL = 1
+    #: How long to wait before trying to connect to the AMQP broker again, in seconds.
+    BROKER_RETRY = 5
+
+    def __init__(
+        self,
+        exchange,
+        zmq_endpoints,
+        topics,
+        reload=None,
+        shaping=None,
+        lanes=None,
+        report_interval=60,
+        report_file=None,
+        tuning=None,
+        drain_timeout=10,
+        spill_file=None,
+        notifier=None,
+    ):
+        self.runtime = RuntimeConfig.from_config(exchange, topics)
+        self.sources = OrderedDict(
+            (source.endpoint, source)
+            for source in (
+                Source.from_config(endpoint, self.runtime.topics)
+                for endpoint in zmq_endpoints
+            )
+        )
+        self._reload = reload
+        self._reload_requested = False
+        self._stop_requested = False
+        self.drain_timeout = drain_timeout
+        self.spill_file = spill_file
+        self._context = None
+        self._poller = None
+        self._turn = 0
+        self.shaper = None
+        if shaping:
+            self.shaper = Shaper.from_config(self._publish, shaping)
+        self.lanes = None
+        if lanes:
+            self.lanes = Lanes.from_config(lanes)
+        self.report_interval = report_interval
+        self.report_file = report_file
+        self.tuner = Tuner.from_config(tuning) if tuning else Tuner()
+        self._next_report = time.monotonic() + report_interval
+        self._next_check = time.monotonic()
+        self.notifier = notifier or Notifier()
+        self.watchdog = Watchdog(self.notifier)
+        self.handled = 0
+
+    @property
+    def endpoints(self):
+        """list: The ZeroMQ endpoints subscribed to."""
+        return list(self.sources)
+
+    def connect(self):
+        """Create the subscription sockets, and connect them to the endpoints."""
+        self._context = zmq.Context.instance()
+        self._poller = zmq.Poller()
+        for source in self.sources.values():
+            self._add(source)
+
+    def _add(self, source):
+        source.connect(self._context)
+        self._poller.register(source.socket, zmq.POLLIN)
+        self._poller.register(source.monitor.socket, zmq.POLLIN)
+
+    def _remove(self, source):
+        self._poller.unregister(source.socket)
+        self._poller.unregister(source.monitor.socket)
+        source.close()
+
+    def run(self):
+        """
+        Publish the spilled messages, and then handle the messages and the
+        reloads until the bridge is stopped, or an exception is raised.
+        """
+        if self._poller is None:
+            self.connect()
+        if self._reload is not None:
+            signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        if self.notifier.enabled:
+            self.wait_for_broker()
+        if self.spill_file and not self._stop_requested:
+            self.replay_spill()
+        self.notifier.ready("Subscribed to {} endpoints".format(len(self.sources)))
+
+        while True:
+            if self._stop_requested:
+                self.drain()
+                return
+            if self._reload_requested:
+                self.reload()
+            if time.monotonic() >= self._next_check:
+                self.check()
+            if self.report_interval and time.monotonic() >= self._next_report:
+                self.report()
+            timeout = self.POLL_TIMEOUT
+            if self.shaper is not None:
+                next_release = self.shaper.run_pending()
+                if next_release is not None:
+                    timeout = min(timeout, int(math.ceil(next_release * 1000)))
+            if self.lanes:
+                timeout = 0
+            try:
+                ready = dict(self._poller.poll(timeout))
+            except zmq.ZMQError as e:
+                _log.error("Failed to poll the subscription sockets: %s", e)
+                continue
+            if ready:
+                self._receive(ready)
+            if self.lanes is not None:
+                queued = self.lanes.get()
+                if queued is not None:
+                    self._send(*queued)
+            self.watchdog.tick(self.handled, self.waiting(), self.held())
+
+    def wait_for_broker(self):
+        """
+        Wait until the AMQP broker accepts connections, or the bridge is stopped.
+        """
+        while not self._stop_requested:
+            try:
+                pika.BlockingConnection(connection_parameters()).close()
+                return
+            except pika.exceptions.AMQPError as e:
+                _log.error(
+                    "Failed to connect to the AMQP broker, retrying in %d seconds: %r",
+                    self.BROKER_RETRY,
+                    e,
+                )
+                self.notifier.status("Waiting for the AMQP broker")
+                time.sleep(self.BROKER_RETRY)
+
+    def waiting(self):
+        """
+        Returns:
+            int: How many messages wait in the lanes to be published.
+        """
+        return 0 if self.lanes is None else len(self.lanes)
+
+    def held(self):
+        """
+        Returns:
+            int: How many messages the shaper holds back.
+        """
+        return 0 if self.shaper is None else len(self.shaper)
+
+    def _receive(self, ready):
+        """
+        Handle the events of the monitors, and receive the messages of the
+        sources with some, each in turn.
+
+        Args:
+            ready (dict): The sockets with messages or events, as returned by
+                the poller.
+        """
+        sources = list(self.sources.values())
+        for source in sources:
+            if source.monitor.socket in ready:
+                source.monitor.handle_events()
+        self._turn = (self._turn + 1) % len(sources)
+        for i in range(len(sources)):
+            source = sources[(self._turn + i) % len(sources)]
+            if source.socket not in ready:
+                continue
+            try:
+                messages = source.receive(source.weight * self.QUANTUM)
+            except zmq.ZMQError as e:
+                _log.error(
+                    "Failed to receive a message from %s: %s", source.endpoint, e
+                )
+                continue
+            self._dispatch(source, messages)
+
+    def _dispatch(self, source, messages):
+        """Publish the messages received from a source, or queue them in their lane."""
+        for topic, zmq_message in messages:
+            if self.lanes is None:
+                self._send(topic, zmq_message)
+            elif not self.lanes.put(topic, (topic, zmq_message)):
+                source.dropped += 1
+
+    def _send(self, topic, zmq_message):
+        """Publish a message, through the shaper if there is one."""
+        if self.shaper is None:
+            _convert_and_maybe_publish(topic, zmq_message, self.runtime)
+            self.handled += 1
+        else:
+            self.shaper.submit(topic, (topic, zmq_message))
+
+    def _publish(self, message):
+        """Publish a message the shaper let through, with the current configuration."""
+        topic, zmq_message = message
+        _convert_and_maybe_publish(topic, zmq_message, self.runtime)
+        self.handled += 1
+
+    def stats(self):
+        """
+        Returns:
+            dict: The statistics of each endpoint, with the settings recommended
+                for it, and those of the shaper and the lanes, if any.
+        """
+        stats = {"endpoints": {}}
+        for endpoint, source in self.sources.items():
+            source_stats = stats["endpoints"][endpoint] = source.stats()
+            source_stats["recommended"] = self._recommend(source)
+        if self.shaper is not None:
+            stats["shaping"] = self.shaper.stats()
+        if self.lanes is not None:
+            stats["lanes"] = self.lanes.stats()
+        return stats
+
+    def report(self):
+        """Log the statistics of the endpoints, write the report file, and reset them."""
+        stats = self.stats()
+        for endpoint, source_stats in stats["endpoints"].items():
+            level = logging.WARNING if source_stats["dropped"] else logging.INFO
+            _log.log(
+                level,
+                "Received %.1f messages/s (%.1f KiB/s) from %s, %d dropped, "
+                "%s, %d disconnections, %d retries, silent for %.0fs",
+                source_stats["rate"],
+                source_stats["byte_rate"] / 1024,
+                endpoint,
+                source_stats["dropped"],
+                "connected" if source_stats["connected"] else "not connected",
+                source_stats["disconnects"],
+                source_stats["retries"],
+                source_stats["silence"],
+            )
+        for source in list(self.sources.values()):
+            self._tune(source, stats["endpoints"][source.endpoint]["recommended"])
+        if self.report_file:
+            try:
+                write_json(self.report_file, stats)
+            except (IOError, OSError) as e:
+                _log.error("Failed to write the report to %s: %s", self.report_file, e)
+        for source in self.sources.values():
+            source.reset_stats()
+        self._next_report = time.monotonic() + self.report_interval
+
+    def _recommend(self, source):
+        """Return the settings recommended for a source, as :meth:`stats` reports them."""
+        recommended = self.tuner.recommend(source.profile, source.rcvhwm, source.rcvbuf)
+        if recommended is None:
+            return None
+        return {
+            "rcvhwm": recommended["hwm"],
+            "rcvbuf": recommended["buffer"],
+            "saturated": recommended["saturated"],
+            "grow": recommended["grow"],
+        }
+
+    def _tune(self, source, recommended):
+        """Log the settings recommended for a source, and apply them in auto mode."""
+        if recommended is None or not recommended["grow"]:
+            return
+        _log.log(
+            logging.WARNING if recommended["saturated"] else logging.INFO,
+            "Recommended settings for %s: rcvhwm = %d, rcvbuf = %d (largest burst "
+            "%d messages, %.1f KiB, largest backlog %d messages%s)",
+            source.endpoint,
+            recommended["rcvhwm"],
+            recommended["rcvbuf"],
+            source.profile.max_burst,
+            source.profile.max_burst_bytes / 1024,
+            source.profile.max_backlog,
+            ", which filled the queue" if recommended["saturated"] else "",
+        )
+        if not self.tuner.auto:
+            return
+        _log.info(
+            "Applying the recommended settings to %s when it reconnects",
+            source.endpoint,
+        )
+        source.tuned = recommended
+
+    def _tuned(self, source, recommended):
+        """
+        Args:
+            source (Source): A source, connected or not.
+            recommended (dict): The settings recommended for its endpoint.
+
+        Returns:
+            Source: A new source for the endpoint, not connected yet, with the
+                recommended settings where they are larger than its own.
+        """
+        options = dict(source.options)
+        if recommended["rcvbuf"] > (source.rcvbuf or Tuner.DEFAULT_BUFFER):
+            options["rcvbuf"] = recommended["rcvbuf"]
+        return Source(
+            source.endpoint,
+            source.topics,
+            rcvhwm=max(source.rcvhwm, recommended["rcvhwm"]),
+            weight=source.weight,
+            options=tuple(sorted(options.items())),
+            stall_timeout=source.stall_timeout,
+        )
+
+    def check(self):
+        """
+        Check whether the endpoints stalled, and reconnect the ones that are
+        disconnected or stalled with their tuned settings, if they have some.
+        """
+        for source in list(self.sources.values()):
+            source.check_stall()
+            if source.tuned is None:
+                continue
+            if source.stalled or not source.monitor.connected:
+                _log.info(
+                    "Reconnecting to %s with the recommended settings", source.endpoint
+                )
+                tuned = self._tuned(source, source.tuned)
+                self._replace(source, tuned)
+                self.sources[source.endpoint] = tuned
+        self._next_check = time.monotonic() + self.CHECK_INTERVAL
+
+    def _replace(self, current, source):
+        """
+        Replace the source of an endpoint with a new one, without dropping the
+        messages the current one queued.
+
+        The new socket is connected and subscribed first, and the current one
+        is then drained and closed, so no message is missed in between. A
+        message published while both are subscribed may be received twice.
+
+        Args:
+            current (Source): The connected source to replace.
+            source (Source): The new source, not connected yet. It keeps the
+                burst profile of the current one.
+        """
+        source.profile = current.profile
+        self._add(source)
         try:
-            topic, zmq_message = sub_socket.recv_multipart()
+            messages = current.drain()
         except zmq.ZMQError as e:
-            _log.error("Failed to receive message from subscription socket: %s", e)
-            continue
-        except ValueError as e:
-            _log.error("Unable to unpack message from pair socket: %s", e)
-            continue
+            _log.error(
+                "Failed to receive the messages queued for %s: %s", current.endpoint, e
+            )
+            messages = []
+        self._remove(current)
+        self._dispatch(source, messages)
 
-        _convert_and_maybe_publish(topic, zmq_message, exchange)
+    def close(self):
+        """Close the subscription sockets, dropping the messages they queued."""
+        for source in self.sources.values():
+            self._remove(source)
+        self._poller = None
 
+    def _publish_all(self, messages, deadline=None):
+        """
+        Publish messages in order, until publishing one fails or the deadline.
 
-def _convert_and_maybe_publish(topic, zmq_message, exchange):
+        Args:
+            messages (list): The ``(topic, body)`` of the messages.
+            deadline (float): When to stop publishing, as a :func:`time.monotonic` time.
+
+        Returns:
+            int: How many messages were published, or dropped as invalid.
+        """
+        handled = 0
+        for topic, zmq_message in messages:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if _convert_and_maybe_publish(topic, zmq_message, self.runtime) is False:
+                break
+            handled += 1
+        return handled
+
+    def request_stop(self, signum=None, frame=None):
+        """
+        Drain and stop before the next message. This is the SIGTERM handler,
+        so it only flags the stop for the message loop.
+        """
+        self._stop_requested = True
+
+    def drain(self):
+        """
+        Stop receiving messages, publish the ones received so far until the
+        drain timeout, close the sockets, and spill the messages left.
+        """
+        _log.info("Stopping, publishing the messages received so far")
+        self.notifier.stopping()
+        deadline = time.monotonic() + self.drain_timeout
+        pending = []
+        if self.shaper is not None:
+            pending.extend(self.shaper.drain())
+        if self.lanes is not None:
+            pending.extend(self.lanes.drain())
+        for source in self.sources.values():
+            pending.extend(source.drain())
+        self.close()
+        handled = self._publish_all(pending, deadline)
+        left = pending[handled:]
+        if not left:
+            _log.info("Published the %d messages received before stopping", handled)
+        elif self.spill_file:
+            try:
+                spilled = spill.write(self.spill_file, left)
+                _log.warning(
+                    "Wrote %d messages to %s, to publish them on the next start",
+                    spilled,
+                    self.spill_file,
+                )
+            except (IOError, OSError) as e:
+                _log.error(
+                    "Dropping %d messages, failed to write them to %s: %s",
+                    len(left),
+                    self.spill_file,
+                    e,
+                )
+        else:
+            _log.error(
+                "Dropping %d messages that couldn't be published before stopping",
+                len(left),
+            )
+
+    def replay_spill(self):
+        """Publish the messages spilled when the bridge last stopped."""
+        try:
+            messages = spill.read(self.spill_file)
+        except (IOError, OSError) as e:
+            _log.error(
+                "Failed to read the spilled messages in %s: %s", self.spill_file, e
+            )
+            return
+        if not messages:
+            return
+        _log.info(
+            "Publishing %d messages spilled to %s", len(messages), self.spill_file
+        )
+        handled = self._publish_all(messages)
+        if handled < len(messages):
+            _log.warning(
+                "Failed to publish %d spilled messages, keeping them in %s",
+                len(messages) - handled,
+                self.spill_file,
+            )
+        try:
+            spill.replace(self.spill_file, messages[handled:])
+        except (IOError, OSError) as e:
+            _log.error("Failed to update %s: %s", self.spill_file, e)
+
+    def request_reload(self, signum=None, frame=None):
+        """
+        Reload the configuration before the next message. This is the SIGHUP
+        handler, so it only flags the reload for the message loop.
+        """
+        self._reload_requested = True
+
+    def reload(self):
+        """Reload the configuration, and apply the changes to the sources."""
+        self._reload_requested = False
+        _log.info("Reloading the configuration")
+        try:
+            exchange, zmq_endpoints, topics = self._reload()
+            runtime = RuntimeConfig.from_config(exchange, topics)
+            sources = [
+                Source.from_config(endpoint, runtime.topics)
+                for endpoint in zmq_endpoints
+            ]
+        except Exception:
+            _log.exception(
+                "Failed to reload the configuration, keeping the current one"
+            )
+            return
+        self.update(runtime, sources)
+
+    def update(self, runtime, sources):
+        """
+        Apply a new configuration to the sources, and swap it in.
+
+        The new endpoints are connected to before the old ones are disconnected
+        from, and the new topics are subscribed to before the old ones are
+        unsubscribed from, so the messages on both are not missed. The sources
+        whose high water mark or socket options changed are replaced the same
+        way (see :meth:`_replace`), applying the settings recommended by the
+        tuner in the meantime, if any.
+
+        Args:
+            runtime (RuntimeConfig): The new runtime configuration.
+            sources (list): The new :class:`Source` of each endpoint, not
+                connected yet.
+        """
+        updated = OrderedDict()
+        for source in sources:
+            current = self.sources.get(source.endpoint)
+            if current is None:
+                self._add(source)
+            elif (current.rcvhwm, current.options) != (source.rcvhwm, source.options):
+                _log.info(
+                    "Reconnecting to %s to change its socket options", source.endpoint
+                )
+                if current.tuned is not None:
+                    source = self._tuned(source, current.tuned)
+                self._replace(current, source)
+            else:
+                current.set_topics(source.topics)
+                current.weight = source.weight
+                current.stall_timeout = source.stall_timeout
+                source = current
+            updated[source.endpoint] = source
+        for endpoint, source in self.sources.items():
+            if endpoint not in updated:
+                self._remove(source)
+        if runtime.exchange != self.runtime.exchange:
+            _log.info("Publishing to the %s exchange", runtime.exchange)
+        self.sources = updated
+        self.runtime = runtime
+
+
+def _convert_and_maybe_publish(topic, zmq_message, runtime):
     """
     Try to convert a fedmsg to a valid fedora-messaging AMQP message and
     publish it.  If something is wrong, no exception will be raised and the
@@ -71,7 +1004,13 @@ def _convert_and_maybe_publish(topic, zmq_message, exchange):
     Args:
         topic (bytes): The ZeroMQ message topic. Assumed to be UTF-8 encoded.
         zmq_message (bytes): The ZeroMQ message. Assumed to be UTF-8 encoded.
-        exchange (str): The name of the AMQP exchange to publish to.
+        runtime (RuntimeConfig): The runtime configuration, with the exchange
+            to publish to.
+
+    Returns:
+        bool: ``True`` if the message was published, ``False`` if publishing it
+            failed, so it can be published again later, and ``None`` if it was
+            dropped.
     """
     try:
         zmq_message = json.loads(zmq_message)
@@ -97,8 +1036,8 @@ def _convert_and_maybe_publish(topic, zmq_message, exchange):
             _log.error("Message is missing a message id, dropping it")
             return
 
-    if fedmsg_config.conf["validate_signatures"] and not fedmsg.crypto.validate(
-        zmq_message, **fedmsg_config.conf
+    if runtime.validate_signatures and not fedmsg.crypto.validate(
+        zmq_message, **runtime.crypto_config
     ):
         _log.error("Message on topic %r failed validation", topic)
         return
@@ -121,15 +1060,17 @@ def _convert_and_maybe_publish(topic, zmq_message, exchange):
 
     _log.debug("Publishing %r to %r", body, topic)
     try:
-        api.publish(message, exchange=exchange)
+        api.publish(message, exchange=runtime.exchange)
     except Exception as e:
         _log.exception(
             'Publishing "%r" to exchange "%r" on topic "%r" failed (%r)',
             body,
-            exchange,
+            runtime.exchange,
             topic,
             e,
         )
+        return False
+    return True
 
 
 class AmqpToZmq(object):
@@ -153,25 +1094,97 @@ class AmqpToZmq(object):
         publish_endpoint = "tcp://gateway.example.com:9941"
         remote_publish = true
 
+    The reconnection and heartbeat settings of the ZeroMQ socket can be set in
+    the "consumer_config" key as well, in milliseconds (see
+    :data:`monitor.SOCKET_OPTIONS`), and its connection events are logged::
+
+        [consumer_config]
+        reconnect_ivl = 1000
+        reconnect_ivl_max = 10000
+        heartbeat_ivl = 5000
+        heartbeat_timeout = 15000
+
+    The rate of the messages published and the connection statistics of the
+    socket are logged every "report_interval" seconds, and written to
+    "report_file" as JSON if it is set (see :meth:`stats`)::
+
+        [consumer_config]
+        report_interval = 60
+        report_file = "/var/lib/fedmsg-migration-tools/amqp_to_zmq.json"
+
+    The sizes of the bursts of messages published are recorded, and the
+    ``sndhwm`` and ``sndbuf`` that would hold them are logged when they are
+    larger than the current ones, and reported with the statistics. They can
+    be set in "consumer_config" too.
+
     Additionally, this consumer can optionally sign messages if they don't have
     a signature already. This happens if the published message originates from
     an AMQP publisher. The ZMQ -> AMQP bridge can be configured to validate
     messages signatures before publishing, so we rely on the AMQP broker's
     authentication and authorization to ensure the message is legitimate. To
     enable this, set "sign_messages" to true in the fedmsg configuration.
+
+    When run with the ``amqp_to_zmq`` command rather than as a fedora-messaging
+    callback, messages are consumed, published, and acknowledged in batches
+    (see :meth:`consume_batches`). The batch size and the time to wait for a
+    batch to fill up, in milliseconds, can be set in the "consumer_config" key,
+    along with how long to wait for the messages sent to be delivered when
+    stopping, in seconds::
+
+        [consumer_config]
+        batch_size = 100
+        batch_timeout = 50
+        drain_timeout = 10
+
+    When run by systemd as a ``Type=notify`` service with the ``amqp_to_zmq``
+    command, the bridge tells systemd it is ready once it consumes from its
+    queues, pings the watchdog while batches get published, and reports how
+    many messages it publishes per second in its status.
+
+    The configuration is resolved once, when the bridge is created.
+
+    Args:
+        runtime (RuntimeConfig): The runtime configuration. Defaults to the one
+            resolved from the current configuration.
+        notifier (notify.Notifier): The notifier to tell systemd about the
+            bridge with. Defaults to one for the process's environment.
+        report_interval (float): How often to report the statistics of the
+            publication socket, in seconds. 0 disables the reports. Defaults
+            to the "report_interval" of "consumer_config", or 60.
+        report_file (str): The path of a JSON file to write the statistics to,
+            when they are reported. Defaults to the "report_file" of
+            "consumer_config", if any.
     """
 
-    def __init__(self):
-        try:
-            self.publish_endpoint = fm_config.conf["consumer_config"][
-                "publish_endpoint"
-            ]
-        except KeyError:
-            self.publish_endpoint = "tcp://*:9940"
+    #: ZeroMQ's default send high water mark.
+    SNDHWM = 1000
+
+    def __init__(
+        self, runtime=None, notifier=None, report_interval=None, report_file=None
+    ):
+        self.runtime = runtime or RuntimeConfig.from_config()
+        consumer_config = fm_config.conf["consumer_config"]
+        if report_interval is None:
+            report_interval = consumer_config.get("report_interval", 60)
+        if report_file is None:
+            report_file = consumer_config.get("report_file") or None
+        self.report_interval = report_interval
+        self.report_file = report_file
+        self._next_report = time.monotonic() + report_interval
+        self.publish_endpoint = self.runtime.publish_endpoint
 
         context = zmq.Context.instance()
         self.pub_socket = context.socket(zmq.PUB)
-        if fm_config.conf["consumer_config"].get("remote_publish", False):
+        set_socket_options(self.pub_socket, self.runtime.socket_options)
+        self.monitor = SocketMonitor(self.pub_socket, "publication")
+        self.profile = BurstProfile()
+        self.tuner = Tuner()
+        self._recommended = None
+        self._stop_requested = False
+        self.notifier = notifier or Notifier()
+        self.handled = 0
+        self.reset_stats()
+        if self.runtime.remote_publish:
             self.pub_socket.connect(self.publish_endpoint)
             _log.info("Connected to %s for ZeroMQ publication", self.publish_endpoint)
         else:
@@ -186,6 +1199,38 @@ class AmqpToZmq(object):
         Args:
             message (fedora_messaging.api.Message): The message from AMQP.
         """
+        self.monitor.handle_events()
+        self._maybe_report()
+        zmq_message = self._to_zmq(message)
+        if zmq_message is None:
+            return
+        try:
+            _log.debug(
+                'Publishing message on "%s" to the ZeroMQ PUB socket "%s"',
+                message.topic,
+                self.publish_endpoint,
+            )
+            self.pub_socket.send_multipart(zmq_message)
+        except zmq.ZMQError as e:
+            _log.error("Message delivery failed: %r", e)
+            raise Nack()
+        self._profile([zmq_message])
+
+    def _to_zmq(self, message):
+        """
+        Wrap a message in the fedmsg format, sign it if configured to, and
+        serialize it.
+
+        Args:
+            message (fedora_messaging.api.Message): The message from AMQP.
+
+        Returns:
+            list: The ZeroMQ multipart message (topic and body, as bytes), or
+                ``None`` if the message should be dropped.
+
+        Raises:
+            HaltConsumer: If the message could not be signed.
+        """
         # fedmsg wraps message bodies in the following dictionary. We need to
         # wrap messages bridged back into ZMQ with it so old consumers don't
         # explode with KeyErrors.
@@ -193,7 +1238,7 @@ class AmqpToZmq(object):
         msg_id = message.id
         if msg_id is None:
             _log.error("Message is missing a message id, dropping it")
-            return
+            return None
         if not YEAR_PREFIX_RE.match(msg_id[:5]):
             msg_id = "{}-{}".format(datetime.datetime.utcnow().year, msg_id)
         wrapped_body = {
@@ -206,37 +1251,309 @@ class AmqpToZmq(object):
         }
         message.body = wrapped_body
 
-        if fedmsg_config.conf["sign_messages"]:
-            # Find the cert name
-            if not fedmsg_config.conf.get("certname"):
-                hostname = socket.gethostname().split(".", 1)[0]
-                if "cert_prefix" in fedmsg_config.conf:
-                    cert_index = "%s.%s" % (fedmsg_config.conf["cert_prefix"], hostname)
-                else:
-                    cert_index = fedmsg_config.conf["name"]
-                    if cert_index == "relay_inbound":
-                        cert_index = "shell.%s" % hostname
-                fedmsg_config.conf["certname"] = fedmsg_config.conf["certnames"][
-                    cert_index
-                ]
+        if self.runtime.sign_messages:
             # Sign the message
             try:
-                message.body = fedmsg.crypto.sign(message.body, **fedmsg_config.conf)
+                message.body = fedmsg.crypto.sign(
+                    message.body, **self.runtime.crypto_config
+                )
             except ValueError as e:
                 _log.error("Unable to sign message with fedmsg: %s", str(e))
                 raise HaltConsumer(exit_code=1, reason=e)
 
+        return [message.topic.encode("utf-8"), json.dumps(message.body).encode("utf-8")]
+
+    def consume_batches(self, batch_size=100, batch_timeout=0.05, drain_timeout=10):
+        """
+        Consume messages from AMQP and publish them to ZeroMQ in batches.
+
+        Rather than handling each message in turn like :meth:`__call__` does
+        when used as a fedora-messaging callback, this consumes directly from
+        the queues and bindings in the fedora-messaging configuration. Up to
+        ``batch_size`` messages are collected, or fewer if ``batch_timeout``
+        seconds elapse after the first one arrived. The whole batch is then
+        converted, sent to the PUB socket back-to-back, and acknowledged with a
+        single ``multiple=True`` ack.
+
+        On SIGTERM, the consumers are cancelled, so the broker stops sending
+        messages and requeues the ones not handed to the bridge yet, and the
+        batch collected so far is published and acknowledged. Messages are only
+        acknowledged once sent to the PUB socket, so those that weren't are
+        delivered again. The PUB socket is then closed, waiting up to
+        ``drain_timeout`` for the messages it queued to be sent.
+
+        This returns once stopped by SIGTERM, or when the consumer is halted.
+
+        Args:
+            batch_size (int): The maximum number of messages in a batch.
+            batch_timeout (float): How long, in seconds, to wait for a batch
+                to fill up before publishing what has arrived so far.
+            drain_timeout (float): How long, in seconds, to wait for the
+                messages queued by the PUB socket to be sent when stopping.
+
+        Raises:
+            HaltConsumer: If a message could not be signed.
+        """
+        connection = pika.BlockingConnection(connection_parameters())
+        channel = connection.channel()
+        channel.basic_qos(prefetch_count=batch_size)
+        _declare_and_bind(channel)
+
+        batch = []
+
+        def on_message(channel, method, properties, body):
+            batch.append((method, properties, body))
+
+        consumer_tags = []
+        for queue in fm_config.conf["queues"]:
+            consumer_tags.append(channel.basic_consume(queue, on_message))
+            _log.info("Consuming from the %s queue in batches of %d", queue, batch_size)
+
+        deadline = None
+        self._stop_requested = False
+        previous_handler = signal.signal(signal.SIGTERM, self.request_stop)
+        watchdog = Watchdog(self.notifier)
+        self.notifier.ready("Consuming from {} queues".format(len(consumer_tags)))
         try:
-            _log.debug(
-                'Publishing message on "%s" to the ZeroMQ PUB socket "%s"',
-                message.topic,
-                self.publish_endpoint,
+            while not self._stop_requested:
+                if batch:
+                    time_limit = max(0, deadline - time.monotonic())
+                else:
+                    time_limit = 1
+                connection.process_data_events(time_limit=time_limit)
+                self.monitor.handle_events()
+                self._maybe_report()
+                watchdog.tick(self.handled, len(batch))
+                if not batch:
+                    continue
+                if deadline is None:
+                    deadline = time.monotonic() + batch_timeout
+                if len(batch) >= batch_size or time.monotonic() >= deadline:
+                    self._flush(channel, batch)
+                    del batch[:]
+                    deadline = None
+            _log.info(
+                "Stopping, publishing the %d messages received so far", len(batch)
+            )
+            self.notifier.stopping()
+            for consumer_tag in consumer_tags:
+                channel.basic_cancel(consumer_tag)
+            if batch:
+                self._flush(channel, batch)
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+            self.close(drain_timeout)
+            if connection.is_open:
+                connection.close()
+
+    def request_stop(self, signum=None, frame=None):
+        """
+        Stop consuming after the current batch. This is the SIGTERM handler,
+        so it only flags the stop for :meth:`consume_batches`.
+        """
+        self._stop_requested = True
+
+    def close(self, linger=10):
+        """
+        Close the PUB socket.
+
+        Args:
+            linger (float): How long, in seconds, to wait for the messages it
+                queued to be sent to the subscribers.
+        """
+        self.monitor.close()
+        self.pub_socket.close(linger=int(linger * 1000))
+
+    def _flush(self, channel, batch):
+        """
+        Publish a batch of AMQP deliveries to ZeroMQ and acknowledge them.
+
+        Args:
+            channel (pika.channel.Channel): The channel the batch was consumed from.
+            batch (list): A list of ``(method, properties, body)`` tuples, in the
+                order they were delivered.
+
+        If sending a message fails, the deliveries before it are acknowledged,
+        so they aren't published twice, and it is returned to the queue with
+        the ones after it.
+
+        Raises:
+            HaltConsumer: If a message could not be signed. The batch is
+                returned to the queue first.
+        """
+        last_tag = batch[-1][0].delivery_tag
+        zmq_messages = []
+        try:
+            for method, properties, body in batch:
+                try:
+                    message = get_message(method.routing_key, properties, body)
+                except ValidationError:
+                    _log.error(
+                        "Dropping invalid message %r on %r", body, method.routing_key
+                    )
+                    zmq_messages.append((method.delivery_tag, None))
+                    continue
+                zmq_messages.append((method.delivery_tag, self._to_zmq(message)))
+        except HaltConsumer:
+            channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+            raise
+
+        _log.debug(
+            'Publishing %d messages to the ZeroMQ PUB socket "%s"',
+            len(zmq_messages),
+            self.publish_endpoint,
+        )
+        sent = []
+        handled_tag = None
+        handled = 0
+        failed = False
+        for delivery_tag, zmq_message in zmq_messages:
+            if zmq_message is not None:
+                try:
+                    self.pub_socket.send_multipart(zmq_message)
+                except zmq.ZMQError as e:
+                    _log.error(
+                        "Delivery of a batch of %d messages failed after %d: %r",
+                        len(batch),
+                        handled,
+                        e,
+                    )
+                    failed = True
+                    break
+                sent.append(zmq_message)
+            handled_tag = delivery_tag
+            handled += 1
+        if handled_tag is not None:
+            channel.basic_ack(delivery_tag=handled_tag, multiple=True)
+        if failed:
+            channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+        self.handled += handled
+        self._profile(sent)
+
+    def reset_stats(self):
+        """Forget the statistics counted so far and start a new period."""
+        self.published = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.profile.reset_stats()
+
+    def stats(self):
+        """
+        Returns:
+            dict: The messages and bytes published, and their rate per second,
+                since the statistics were reset, the bursts of its
+                :class:`tuning.BurstProfile` with the ``sndhwm`` and ``sndbuf``
+                recommended to hold them, and the statistics of the
+                :class:`SocketMonitor` of the publication socket.
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        stats = {
+            "published": self.published,
+            "bytes": self.bytes,
+            "rate": self.published / elapsed,
+            "byte_rate": self.bytes / elapsed,
+            "bursts": self.profile.stats(),
+            "recommended": self._recommend(),
+        }
+        stats.update(self.monitor.stats())
+        return stats
+
+    def report(self):
+        """Log the statistics of the publication socket, write the report file, and reset them."""
+        stats = self.stats()
+        _log.info(
+            "Published %.1f messages/s (%.1f KiB/s) to %s, %d peers, "
+            "%d disconnections, %d retries",
+            stats["rate"],
+            stats["byte_rate"] / 1024,
+            self.publish_endpoint,
+            stats["peers"],
+            stats["disconnects"],
+            stats["retries"],
+        )
+        if self.report_file:
+            try:
+                write_json(self.report_file, stats)
+            except (IOError, OSError) as e:
+                _log.error("Failed to write the report to %s: %s", self.report_file, e)
+        self.reset_stats()
+        self._next_report = time.monotonic() + self.report_interval
+
+    def _maybe_report(self):
+        if self.report_interval and time.monotonic() >= self._next_report:
+            self.report()
+
+    def _profile(self, zmq_messages):
+        """
+        Count messages published together, and log the settings recommended for
+        the publication socket when they grow.
+
+        Args:
+            zmq_messages (list): The frames of each message.
+        """
+        if not zmq_messages:
+            return
+        size = sum(len(frame) for zmq_message in zmq_messages for frame in zmq_message)
+        self.published += len(zmq_messages)
+        self.bytes += size
+        self.profile.add(len(zmq_messages), size)
+        recommended = self._recommend()
+        if recommended is None or not recommended["grow"]:
+            return
+        if (recommended["sndhwm"], recommended["sndbuf"]) == self._recommended:
+            return
+        self._recommended = (recommended["sndhwm"], recommended["sndbuf"])
+        _log.info(
+            "Recommended settings for the publication socket: sndhwm = %d, "
+            "sndbuf = %d (largest burst %d messages, %.1f KiB)",
+            recommended["sndhwm"],
+            recommended["sndbuf"],
+            self.profile.max_burst,
+            self.profile.max_burst_bytes / 1024,
+        )
+
+    def _recommend(self):
+        """Return the settings recommended for the publication socket, as in :meth:`stats`."""
+        options = dict(self.runtime.socket_options)
+        recommended = self.tuner.recommend(
+            self.profile, options.get("sndhwm", self.SNDHWM), options.get("sndbuf")
+        )
+        if recommended is None:
+            return None
+        return {
+            "sndhwm": recommended["hwm"],
+            "sndbuf": recommended["buffer"],
+            "saturated": recommended["saturated"],
+            "grow": recommended["grow"],
+        }
+
+
+def _declare_and_bind(channel):
+    """
+    Declare the exchanges and queues from the fedora-messaging configuration,
+    and bind them together.
+
+    Args:
+        channel (pika.channel.Channel): The channel to declare objects with.
+    """
+    for name, exchange in fm_config.conf["exchanges"].items():
+        channel.exchange_declare(
+            name,
+            exchange_type=exchange["type"],
+            durable=exchange["durable"],
+            auto_delete=exchange["auto_delete"],
+            arguments=exchange["arguments"],
+        )
+    for name, queue in fm_config.conf["queues"].items():
+        channel.queue_declare(
+            name,
+            durable=queue["durable"],
+            auto_delete=queue["auto_delete"],
+            exclusive=queue["exclusive"],
+            arguments=queue["arguments"],
+        )
+    for binding in fm_config.conf["bindings"]:
+        for routing_key in binding["routing_keys"]:
+            channel.queue_bind(
+                binding["queue"], binding["exchange"], routing_key=routing_key
             )
-            zmq_message = [
-                message.topic.encode("utf-8"),
-                json.dumps(message.body).encode("utf-8"),
-            ]
-            self.pub_socket.send_multipart(zmq_message)
-        except zmq.ZMQError as e:
-            _log.error("Message delivery failed: %r", e)
-            raise Nack()
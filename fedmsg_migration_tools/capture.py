@@ -0,0 +1,534 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Recording of the ZeroMQ and AMQP message streams.
+
+Messages are written to rotating segment files, in the message log format
+read by :mod:`fedmsg_migration_tools.offline`: one JSON object per line with
+the ``received`` time, ``topic``, ``msg_id`` and ``body`` of the message (and
+its ``headers``, for AMQP messages).
+
+Messages are buffered and written in blocks. Each block is a separate gzip
+member, so segments are regular gzip files, but a block can also be
+decompressed on its own. Next to each segment, a ``.idx`` sidecar file lists
+its blocks, with their offset, the time range they cover, and the IDs of their
+messages, so a message or a time range can be found by only reading the blocks
+that contain it.
+"""
+
+from datetime import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+import pika
+import zmq
+
+from fedmsg_migration_tools.amqp import connection_parameters
+from fedmsg_migration_tools.matching import normalize_msg_id
+
+
+_log = logging.getLogger(__name__)
+
+
+def format_entry(received, topic, msg_id, body, headers=None):
+    """
+    Format a message as a line of a message log.
+
+    Args:
+        received (float): The time the message was received at, in seconds
+            since the epoch.
+        topic (str): The message topic.
+        msg_id (str): The message ID.
+        body (str): The message body, already serialized to JSON. It is
+            included as is, rather than decoded and serialized again, unless
+            it spans several lines.
+        headers (dict): The message headers, if any.
+
+    Returns:
+        str: The line, without the trailing newline.
+
+    Raises:
+        ValueError: If the body spans several lines and isn't valid JSON.
+    """
+    if "\n" in body or "\r" in body:
+        # Line breaks can only be whitespace in JSON, so a compact serialization
+        # keeps the message on a single line
+        body = json.dumps(json.loads(body), separators=(",", ":"))
+    line = '{{"received": {!r}, "topic": {}, "msg_id": {}'.format(
+        received, json.dumps(topic), json.dumps(msg_id)
+    )
+    if headers is not None:
+        line += ', "headers": {}'.format(json.dumps(headers))
+    return line + ', "body": {}}}'.format(body)
+
+
+class SegmentWriter(object):
+    """
+    Write messages to rotating, compressed and indexed segment files.
+
+    This is not thread-safe, each thread should have its own writer.
+
+    Args:
+        directory (str): The directory to write the segments to.
+        prefix (str): The prefix of the segment file names.
+        max_bytes (int): The size after which a new segment is started.
+        max_age (int): The age, in seconds, after which a new segment is started.
+        block_size (int): The maximum number of messages in a block.
+        flush_interval (float): The maximum time, in seconds, messages are
+            buffered for before being written.
+        compresslevel (int): The gzip compression level.
+        on_flush (callable): A function called without arguments each time a
+            block has been written.
+    """
+
+    def __init__(
+        self,
+        directory,
+        prefix,
+        max_bytes=256 * 1024 * 1024,
+        max_age=3600,
+        block_size=1000,
+        flush_interval=1,
+        compresslevel=6,
+        on_flush=None,
+    ):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.compresslevel = compresslevel
+        self.on_flush = on_flush
+        self.path = None
+        self._segment = None
+        self._index = None
+        self._opened = None
+        self._lines = []
+        self._ids = []
+        self._first = None
+        self._last = None
+        self._buffered_since = None
+
+    def write(self, received, msg_id, line):
+        """
+        Buffer a message, and write the buffer if it is full.
+
+        Args:
+            received (float): The time the message was received at, in seconds
+                since the epoch.
+            msg_id (str): The message ID. It is indexed without its year prefix.
+            line (str): The message, formatted with :func:`format_entry`.
+        """
+        if not self._lines:
+            self._first = received
+            self._buffered_since = time.monotonic()
+        self._lines.append(line)
+        self._ids.append(normalize_msg_id(msg_id))
+        self._last = received
+        if len(self._lines) >= self.block_size:
+            self.flush()
+
+    def maybe_flush(self):
+        """Write the buffer if messages have been waiting for too long."""
+        if (
+            self._lines
+            and time.monotonic() - self._buffered_since >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered messages as a new block."""
+        if not self._lines:
+            return
+        if self._segment is None or self._should_rotate():
+            self._rotate()
+        data = gzip.compress(
+            ("\n".join(self._lines) + "\n").encode("utf-8"), self.compresslevel
+        )
+        offset = self._segment.tell()
+        self._segment.write(data)
+        self._segment.flush()
+        block = {
+            "offset": offset,
+            "length": len(data),
+            "first": self._first,
+            "last": self._last,
+            "count": len(self._lines),
+            "ids": self._ids,
+        }
+        self._index.write(json.dumps(block) + "\n")
+        self._index.flush()
+        self._lines = []
+        self._ids = []
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def _should_rotate(self):
+        return (
+            self._segment.tell() >= self.max_bytes
+            or time.monotonic() - self._opened >= self.max_age
+        )
+
+    def _rotate(self):
+        self._close_segment()
+        name = "{}-{}".format(self.prefix, datetime.utcnow().strftime("%Y%m%dT%H%M%S"))
+        # The counter keeps segments started in the same second in order
+        counter = 0
+        while True:
+            path = os.path.join(
+                self.directory, "{}.{:04d}.jsonl.gz".format(name, counter)
+            )
+            if not os.path.exists(path):
+                break
+            counter += 1
+        _log.info("Starting a new capture segment in %s", path)
+        self.path = path
+        self._segment = open(path, "wb")
+        self._index = open(index_path(path), "w")
+        self._opened = time.monotonic()
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._index.close()
+            self._segment = self._index = None
+
+    def close(self):
+        """Write the buffered messages and close the current segment."""
+        self.flush()
+        self._close_segment()
+
+
+def index_path(segment):
+    """Get the path of the index of a segment."""
+    return segment + ".idx"
+
+
+def list_segments(path):
+    """
+    List the segments of a capture, in chronological order.
+
+    Args:
+        path (str): A capture directory, or the path of a single segment.
+
+    Returns:
+        list: The paths of the segments.
+    """
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.jsonl.gz")))
+    return [path]
+
+
+def read_index(segment):
+    """
+    Read the index of a segment.
+
+    Args:
+        segment (str): The path of the segment.
+
+    Returns:
+        list: The blocks of the segment, as dictionaries.
+    """
+    with open(index_path(segment)) as fd:
+        return [json.loads(line) for line in fd if line.strip()]
+
+
+def read_block(segment, block):
+    """
+    Read the messages of a single block of a segment.
+
+    Args:
+        segment (str): The path of the segment.
+        block (dict): The block, from the segment's index.
+
+    Returns:
+        list: The messages of the block, as dictionaries. Invalid lines are
+            logged and skipped.
+    """
+    with open(segment, "rb") as fd:
+        fd.seek(block["offset"])
+        data = gzip.decompress(fd.read(block["length"]))
+    entries = []
+    # Only split on newlines: JSON strings may contain other line separators
+    for line in data.decode("utf-8").split("\n"):
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError as e:
+            _log.warning(
+                "Skipping an invalid line in the block at %d of %s: %r",
+                block["offset"],
+                segment,
+                e,
+            )
+    return entries
+
+
+def find_message(path, msg_id):
+    """
+    Find a message in a capture using the segments' indexes.
+
+    Args:
+        path (str): A capture directory, or the path of a single segment.
+        msg_id (str): The message ID, with or without the year prefix.
+
+    Returns:
+        dict: The message, or ``None`` if it is not in the capture.
+    """
+    msg_id = normalize_msg_id(msg_id)
+    for segment in list_segments(path):
+        for block in read_index(segment):
+            if msg_id in block["ids"]:
+                for entry in read_block(segment, block):
+                    if normalize_msg_id(entry["msg_id"]) == msg_id:
+                        return entry
+    return None
+
+
+def read_range(path, start=None, end=None):
+    """
+    Read the messages of a capture received in a time range, using the
+    segments' indexes to only read the blocks covering that range.
+
+    Args:
+        path (str): A capture directory, or the path of a single segment.
+        start (float): The beginning of the range, in seconds since the epoch.
+        end (float): The end of the range (excluded), in seconds since the epoch.
+
+    Yields:
+        dict: The messages received in the time range.
+    """
+    start = float("-inf") if start is None else start
+    end = float("inf") if end is None else end
+    for segment in list_segments(path):
+        for block in read_index(segment):
+            if block["last"] < start or block["first"] >= end:
+                continue
+            for entry in read_block(segment, block):
+                if start <= entry["received"] < end:
+                    yield entry
+
+
+class ZmqCapture(threading.Thread):
+    """
+    Record the messages published on ZeroMQ endpoints.
+
+    Args:
+        writer (SegmentWriter): The writer to record the messages with.
+        zmq_endpoints (list): The ZeroMQ endpoints to subscribe to.
+        rcvhwm (int): The high water mark of the subscription socket.
+    """
+
+    def __init__(self, writer, zmq_endpoints, rcvhwm=100000):
+        super(ZmqCapture, self).__init__(name="ZmqCapture")
+        self.writer = writer
+        self.zmq_endpoints = zmq_endpoints
+        self.rcvhwm = rcvhwm
+        self.stopping = threading.Event()
+        self.received = 0
+
+    def run(self):
+        context = zmq.Context.instance()
+        sub_socket = context.socket(zmq.SUB)
+        sub_socket.setsockopt(zmq.RCVHWM, self.rcvhwm)
+        sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        for endpoint in self.zmq_endpoints:
+            _log.info("Capturing the messages from the %s ZeroMQ endpoint", endpoint)
+            sub_socket.connect(endpoint)
+        poller = zmq.Poller()
+        poller.register(sub_socket, zmq.POLLIN)
+        try:
+            while not self.stopping.is_set():
+                if not poller.poll(100):
+                    self.writer.maybe_flush()
+                    continue
+                # Drain what's available before checking on the writer
+                while True:
+                    try:
+                        topic, body = sub_socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    except ValueError as e:
+                        _log.error("Unable to unpack message from ZeroMQ: %s", e)
+                        continue
+                    self._write(topic, body)
+                self.writer.maybe_flush()
+        finally:
+            self.writer.close()
+            sub_socket.close(linger=0)
+
+    def _write(self, topic, body):
+        received = time.time()
+        try:
+            body = body.decode("utf-8")
+            msg_id = json.loads(body)["msg_id"]
+            topic = topic.decode("utf-8")
+        except (ValueError, TypeError, KeyError) as e:
+            _log.error("Not capturing an invalid ZeroMQ message: %r", e)
+            return
+        self.writer.write(received, msg_id, format_entry(received, topic, msg_id, body))
+        self.received += 1
+
+
+class AmqpCapture(threading.Thread):
+    """
+    Record the messages published on AMQP exchanges.
+
+    Messages are only acknowledged once the block they are in has been written.
+
+    Args:
+        writer (SegmentWriter): The writer to record the messages with.
+        queue (dict): The queue to consume from, in the ``[verify_missing.queue]``
+            format.
+        bindings (list): The bindings of the queue, in the
+            ``[[verify_missing.bindings]]`` format.
+    """
+
+    def __init__(self, writer, queue, bindings):
+        super(AmqpCapture, self).__init__(name="AmqpCapture")
+        self.writer = writer
+        self.queue = dict(queue)
+        self.bindings = bindings
+        self.stopping = threading.Event()
+        self.received = 0
+        self.writer.on_flush = self._ack
+        self._channel = None
+        self._last_tag = None
+
+    def run(self):
+        connection = pika.BlockingConnection(connection_parameters())
+        channel = connection.channel()
+        channel.basic_qos(prefetch_count=self.writer.block_size * 2)
+        queue_name = self.queue.pop("queue")
+        channel.queue_declare(queue_name, **self.queue)
+        for binding in self.bindings:
+            for routing_key in binding["routing_keys"]:
+                channel.queue_bind(
+                    queue_name, binding["exchange"], routing_key=routing_key
+                )
+        channel.basic_consume(queue_name, self._on_message)
+        _log.info("Capturing the messages from the %s AMQP queue", queue_name)
+        self._channel = channel
+        try:
+            while not self.stopping.is_set():
+                connection.process_data_events(time_limit=0.1)
+                self.writer.maybe_flush()
+        finally:
+            self.writer.close()
+            if connection.is_open:
+                connection.close()
+
+    def _on_message(self, channel, method, properties, body):
+        received = time.time()
+        self._last_tag = method.delivery_tag
+        try:
+            body = body.decode("utf-8")
+        except UnicodeDecodeError as e:
+            _log.error("Not capturing an invalid AMQP message: %r", e)
+            return
+        if properties.message_id is None:
+            _log.error("Not capturing an AMQP message without a message ID")
+            return
+        try:
+            json.loads(body)
+        except ValueError:
+            # Keep the log readable, non-JSON bodies are recorded as strings
+            body = json.dumps(body)
+        line = format_entry(
+            received,
+            method.routing_key,
+            properties.message_id,
+            body,
+            properties.headers or {},
+        )
+        self.received += 1
+        self.writer.write(received, properties.message_id, line)
+
+    def _ack(self):
+        """Acknowledge the messages that have been written."""
+        if self._last_tag is not None:
+            self._channel.basic_ack(delivery_tag=self._last_tag, multiple=True)
+            self._last_tag = None
+
+
+def main(directory, zmq_endpoints=None, amqp=True, capture_config=None):
+    """
+    Record the messages from ZeroMQ and/or AMQP until interrupted.
+
+    The ZeroMQ and AMQP messages are recorded in the ``zmq`` and ``amqp``
+    subdirectories of the capture directory, respectively.
+
+    Args:
+        directory (str): The capture directory.
+        zmq_endpoints (list): The ZeroMQ endpoints to subscribe to, if any.
+        amqp (bool): Whether to record the AMQP messages.
+        capture_config (dict): The ``[capture]`` configuration section.
+    """
+    threads = []
+
+    def make_writer(prefix):
+        path = os.path.join(directory, prefix)
+        os.makedirs(path, exist_ok=True)
+        return SegmentWriter(
+            path,
+            prefix,
+            max_bytes=capture_config["segment_max_bytes"],
+            max_age=capture_config["segment_max_age"],
+            block_size=capture_config["block_size"],
+            flush_interval=capture_config["flush_interval"],
+            compresslevel=capture_config["compresslevel"],
+        )
+
+    if zmq_endpoints:
+        threads.append(
+            ZmqCapture(make_writer("zmq"), zmq_endpoints, capture_config["rcvhwm"])
+        )
+    if amqp:
+        threads.append(
+            AmqpCapture(
+                make_writer("amqp"),
+                capture_config["queue"],
+                capture_config["bindings"],
+            )
+        )
+
+    def stop(signum=None, frame=None):
+        for thread in threads:
+            thread.stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    for thread in threads:
+        thread.start()
+    try:
+        while all(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop()
+        for thread in threads:
+            thread.join()
+    for thread in threads:
+        _log.info("%s recorded %d messages", thread.name, thread.received)
@@ -17,27 +17,33 @@
 """
 The ``fedmsg-migration-tools`` `Click`_ CLI.
 
+The modules implementing the commands, and the libraries they depend on
+(fedmsg, fedora-messaging, ZeroMQ, Twisted...), are only imported by the command
+that is run, so the CLI starts quickly, especially to only show its help.
+
 .. _Click: http://click.pocoo.org/
 """
 from __future__ import absolute_import
 
 import logging
-import logging.config
 
 import click
-import zmq
-
-from . import bridges as bridges_module, config, verify_missing as verify_missing_module
 
-try:
-    # twisted.logger is available with Twisted 15+
-    from twisted.python import log as tw_log
-except ImportError:
-    tw_log = None
+from . import config
 
 
 _log = logging.getLogger(__name__)
 
+#: The settings of the zmq_to_amqp section that each endpoint can override.
+ENDPOINT_SETTINGS = (
+    "rcvhwm",
+    "reconnect_ivl",
+    "reconnect_ivl_max",
+    "heartbeat_ivl",
+    "heartbeat_timeout",
+    "stall_timeout",
+)
+
 
 @click.group()
 @click.option("--conf", envvar="FEDMSG_MIGRATION_TOOLS_CONFIG")
@@ -60,40 +66,294 @@ def cli(conf):
 @click.option("--zmq-endpoint", multiple=True, help="A ZMQ socket to subscribe to")
 @click.option("--exchange")
 def zmq_to_amqp(exchange, zmq_endpoint, topic):
-    """Bridge ZeroMQ messages to an AMQP exchange."""
-    topics = topic or config.conf["zmq_to_amqp"]["topics"]
-    exchange = exchange or config.conf["zmq_to_amqp"]["exchange"]
-    topics = [t.encode("utf-8") for t in topics]
+    """
+    Bridge ZeroMQ messages to an AMQP exchange.
 
-    zmq_endpoints = zmq_endpoint or config.conf["zmq_to_amqp"]["zmq_endpoints"]
-    if not zmq_endpoints:
+    Send SIGHUP to reload the topics, endpoints and exchange from the
+    configuration file, if they are not set on the command line.
+    """
+    from . import bridges as bridges_module
+
+    def get_section():
+        return dict(config.DEFAULTS["zmq_to_amqp"], **config.conf["zmq_to_amqp"])
+
+    def settings():
+        section = get_section()
+        zmq_endpoints = zmq_endpoint or section["zmq_endpoints"]
+        if not zmq_endpoints:
+            raise click.exceptions.UsageError(
+                "No ZeroMQ endpoints defined, please provide one or more endpoints "
+                "using the --zmq-endpoint flag or by setting endpoints in the "
+                '"zmq_to_amqp" section of your configuration.'
+            )
+        defaults = {key: section[key] for key in ENDPOINT_SETTINGS}
+        zmq_endpoints = [
+            dict(defaults, endpoint=endpoint, **section["sources"].get(endpoint, {}))
+            for endpoint in zmq_endpoints
+        ]
+        return (
+            exchange or section["exchange"],
+            zmq_endpoints,
+            topic or section["topics"],
+        )
+
+    def reload():
+        config.conf.reload()
+        return settings()
+
+    bridge_settings = settings()
+    section = get_section()
+    shaping, lanes, tuning = (
+        dict(config.DEFAULTS["zmq_to_amqp"][key], **section[key])
+        for key in ("shaping", "lanes", "tuning")
+    )
+    try:
+        bridge = bridges_module.ZmqToAmqp(
+            *bridge_settings,
+            reload=reload,
+            shaping=shaping,
+            lanes=lanes,
+            report_interval=section["report_interval"],
+            report_file=section["report_file"] or None,
+            tuning=tuning,
+            drain_timeout=section["drain_timeout"],
+            spill_file=section["spill_file"] or None,
+        )
+    except ValueError as e:
+        raise click.exceptions.UsageError(str(e))
+    try:
+        bridge.run()
+    except Exception:
+        _log.exception("An unexpected error occurred, please file a bug report")
+
+
+@cli.command("amqp_to_zmq")
+@click.option("--batch-size", type=int, help="The maximum number of messages per batch")
+@click.option(
+    "--batch-timeout",
+    type=int,
+    help="How long to wait for a batch to fill up, in milliseconds",
+)
+def amqp_to_zmq(batch_size, batch_timeout):
+    """Bridge AMQP messages to ZeroMQ, in batches."""
+    from fedora_messaging import config as fm_config
+    from fedora_messaging.exceptions import HaltConsumer
+
+    from . import bridges as bridges_module
+
+    consumer_config = fm_config.conf["consumer_config"]
+    if batch_size is None:
+        batch_size = consumer_config.get("batch_size", 100)
+    if batch_timeout is None:
+        batch_timeout = consumer_config.get("batch_timeout", 50)
+    if batch_size < 1:
+        raise click.exceptions.BadParameter("The batch size must be at least 1.")
+
+    try:
+        bridges_module.AmqpToZmq().consume_batches(
+            batch_size=batch_size,
+            batch_timeout=batch_timeout / 1000.0,
+            drain_timeout=consumer_config.get("drain_timeout", 10),
+        )
+    except HaltConsumer as e:
+        _log.error("The AMQP to ZeroMQ bridge halted: %s", e.reason)
+        raise click.exceptions.Exit(e.exit_code)
+    except Exception:
+        _log.exception("An unexpected error occurred, please file a bug report")
+
+
+@cli.command("capture")
+@click.option(
+    "--output",
+    type=click.Path(file_okay=False),
+    help="The directory to record the messages to",
+)
+@click.option("--zmq-endpoint", multiple=True, help="A ZMQ socket to subscribe to")
+@click.option(
+    "--source",
+    type=click.Choice(["zmq", "amqp", "both"]),
+    default="both",
+    help="The messages to record",
+)
+def capture(output, zmq_endpoint, source):
+    """Record the ZeroMQ and AMQP messages to compressed, indexed segments."""
+    from . import capture as capture_module
+
+    capture_config = dict(config.DEFAULTS["capture"], **config.conf["capture"])
+    directory = output or capture_config["directory"]
+    if not directory:
         raise click.exceptions.UsageError(
-            "No ZeroMQ endpoints defined, please provide one or more endpoints "
-            "using the --zmq-endpoint flag or by setting endpoints in the "
-            '"zmq_to_amqp" section of your configuration.'
+            "No capture directory defined, please provide one using the --output "
+            'flag or by setting the directory in the "capture" section of your '
+            "configuration."
         )
+    zmq_endpoints = None
+    if source in ("zmq", "both"):
+        zmq_endpoints = zmq_endpoint or config.conf["zmq_to_amqp"]["zmq_endpoints"]
+        if not zmq_endpoints:
+            raise click.exceptions.UsageError(
+                "No ZeroMQ endpoints defined, please provide one or more endpoints "
+                "using the --zmq-endpoint flag or by setting endpoints in the "
+                '"zmq_to_amqp" section of your configuration.'
+            )
 
     try:
-        bridges_module.zmq_to_amqp(exchange, zmq_endpoints, topics)
+        capture_module.main(
+            directory,
+            zmq_endpoints=zmq_endpoints,
+            amqp=source in ("amqp", "both"),
+            capture_config=capture_config,
+        )
     except Exception:
         _log.exception("An unexpected error occurred, please file a bug report")
 
 
+@cli.command("find")
+@click.argument("path", type=click.Path(exists=True))
+@click.argument("msg_id")
+def find(path, msg_id):
+    """Find a message in a capture by its ID, and print it as JSON."""
+    import json
+
+    from . import capture as capture_module
+
+    try:
+        entry = capture_module.find_message(path, msg_id)
+    except (IOError, OSError, EOFError, ValueError) as e:
+        raise click.exceptions.ClickException(
+            "Failed to read the capture: {}".format(e)
+        )
+    if entry is None:
+        raise click.exceptions.ClickException(
+            "The message {} is not in {}".format(msg_id, path)
+        )
+    click.echo(json.dumps(entry, indent=2, sort_keys=True))
+
+
+@cli.command("replay")
+@click.argument("log", type=click.Path(exists=True))
+@click.option(
+    "--to",
+    "destination",
+    type=click.Choice(["zmq", "amqp"]),
+    default="zmq",
+    help="Where to publish the messages",
+)
+@click.option("--publish-endpoint", help="The ZMQ socket to bind to")
+@click.option("--exchange", help="The AMQP exchange to publish to")
+@click.option(
+    "--speed",
+    type=float,
+    help="How many times faster than real time to replay, 0 for as fast as possible",
+)
+@click.option("--publishers", type=int, help="The number of publisher threads")
+@click.option("--start", type=float, help="Skip the messages received before then")
+@click.option("--end", type=float, help="Stop at the messages received then")
+def replay(log, destination, publish_endpoint, exchange, speed, publishers, start, end):
+    """Replay recorded messages to ZeroMQ or AMQP."""
+    import zmq
+
+    from . import replay as replay_module
+
+    replay_config = dict(config.DEFAULTS["replay"], **config.conf["replay"])
+    if speed is None:
+        speed = replay_config["speed"]
+    publishers = publishers or replay_config["publishers"]
+    if speed < 0:
+        raise click.exceptions.BadParameter("The speed can't be negative.")
+    if publishers < 1:
+        raise click.exceptions.BadParameter("There must be at least one publisher.")
+
+    try:
+        summary = replay_module.main(
+            log,
+            destination=destination,
+            publish_endpoint=publish_endpoint or replay_config["publish_endpoint"],
+            exchange=exchange or config.conf["zmq_to_amqp"]["exchange"],
+            speed=speed,
+            publishers=publishers,
+            start=start,
+            end=end,
+            queue_size=replay_config["queue_size"],
+            subscriber_delay=replay_config["subscriber_delay"],
+        )
+    except (IOError, OSError, EOFError, ValueError) as e:
+        raise click.exceptions.ClickException(
+            "Failed to read the message logs: {}".format(e)
+        )
+    except zmq.error.ZMQError as e:
+        raise click.exceptions.ClickException(
+            "Failed to publish to ZeroMQ: {}".format(e)
+        )
+    click.echo(replay_module.format_summary(summary))
+
+
 @cli.command("verify_missing")
 @click.option("--zmq-endpoint", multiple=True, help="A ZMQ socket to subscribe to")
-def verify_missing(zmq_endpoint):
+@click.option(
+    "--workers",
+    type=int,
+    help="The number of processes to split the verification over",
+)
+@click.option(
+    "--offline",
+    nargs=2,
+    type=click.Path(exists=True),
+    metavar="AMQP_LOG ZMQ_LOG",
+    help="Verify two recorded message logs instead of the live messages",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["twisted", "asyncio"]),
+    help="The event loop to run the verification on",
+)
+def verify_missing(zmq_endpoint, workers, offline, engine):
     """Check that all messages go through AMQP and ZeroMQ."""
-    if tw_log is None:
-        raise click.exceptions.UsageError(
-            "You need to install Twisted to use this command."
-        )
-    # When the current RHEL has Twisted 15+, we can use twisted.logger
-    # tw_logger.globalLogPublisher.addObserver(
-    #     tw_logger.STDLibLogObserver(name="verify_missing")
-    # )
-    # Send all the logs to stdlib's logging library
-    tw_log.PythonLoggingObserver(loggerName="verify_missing").start()
-    tw_log.startLogging(tw_log.NullFile())
+    if offline:
+        from . import offline as offline_module
+
+        verify_config = config.conf["verify_missing"]
+        defaults = config.DEFAULTS["verify_missing"]
+        try:
+            offline_module.verify(
+                *offline,
+                report_file=verify_config.get("report_file") or None,
+                prefix_depth=verify_config.get(
+                    "topic_prefix_depth", defaults["topic_prefix_depth"]
+                ),
+                match_window=verify_config.get(
+                    "match_window", defaults["match_window"]
+                ),
+            )
+        except (IOError, OSError, EOFError, ValueError) as e:
+            raise click.exceptions.ClickException(
+                "Failed to read the message logs: {}".format(e)
+            )
+        return
+
+    engine = engine or config.conf["verify_missing"].get(
+        "engine", config.DEFAULTS["verify_missing"]["engine"]
+    )
+    if engine == "asyncio":
+        from . import verify_missing_asyncio as verify_missing_module
+    else:
+        try:
+            # twisted.logger is available with Twisted 15+
+            from twisted.python import log as tw_log
+        except ImportError:
+            raise click.exceptions.UsageError(
+                "You need to install Twisted to use this command, or to use the "
+                "asyncio engine."
+            )
+        from . import verify_missing as verify_missing_module
+
+        # When the current RHEL has Twisted 15+, we can use twisted.logger
+        # tw_logger.globalLogPublisher.addObserver(
+        #     tw_logger.STDLibLogObserver(name="verify_missing")
+        # )
+        # Send all the logs to stdlib's logging library
+        tw_log.PythonLoggingObserver(loggerName="verify_missing").start()
+        tw_log.startLogging(tw_log.NullFile())
 
     zmq_endpoints = zmq_endpoint or config.conf["zmq_to_amqp"]["zmq_endpoints"]
     if not zmq_endpoints:
@@ -102,8 +362,23 @@ def verify_missing(zmq_endpoint):
             "using the --zmq-endpoint flag or by setting endpoints in the "
             '"zmq_to_amqp" section of your configuration.'
         )
+    if workers is None:
+        workers = config.conf["verify_missing"].get(
+            "workers", config.DEFAULTS["verify_missing"]["workers"]
+        )
+    if workers < 1:
+        raise click.exceptions.BadParameter("There must be at least one worker.")
+    if workers > 1 and engine == "asyncio":
+        raise click.exceptions.UsageError(
+            "The asyncio engine can only run a single worker."
+        )
+    import zmq
+
     try:
-        verify_missing_module.main(zmq_endpoints)
+        if workers > 1:
+            verify_missing_module.main_sharded(zmq_endpoints, workers)
+        else:
+            verify_missing_module.main(zmq_endpoints)
     except zmq.error.ZMQError as e:
         _log.exception(e)
     except Exception:
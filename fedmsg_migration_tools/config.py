@@ -32,8 +32,59 @@ _log = logging.getLogger(__name__)
 
 #: A dictionary of application configuration defaults.
 DEFAULTS = dict(
-    zmq_to_amqp={"exchange": "zmq.topic", "topics": [""], "zmq_endpoints": []},
+    zmq_to_amqp={
+        "exchange": "zmq.topic",
+        "topics": [""],
+        "zmq_endpoints": [],
+        "rcvhwm": 1000,
+        "reconnect_ivl": 1000,
+        "reconnect_ivl_max": 10000,
+        "heartbeat_ivl": 5000,
+        "heartbeat_timeout": 15000,
+        "stall_timeout": 0,
+        "sources": {},
+        "report_interval": 60,
+        "report_file": "",
+        "drain_timeout": 10,
+        "spill_file": "",
+        "shaping": {
+            "rate": 0,
+            "burst": 0,
+            "buffer": 1000,
+            "overflow": "delay",
+            "report_interval": 60,
+            "prefixes": {},
+        },
+        "lanes": {"weight": 1, "size": 10000, "report_interval": 60, "classes": {}},
+        "tuning": {
+            "auto": False,
+            "headroom": 2,
+            "max_hwm": 100000,
+            "max_buffer": 8388608,
+        },
+    },
     verify_missing={
+        "report_interval": 60,
+        "report_file": "",
+        "topic_prefix_depth": 4,
+        "digests": False,
+        "digest_threads": 4,
+        "workers": 1,
+        "engine": "twisted",
+        "state_file": "",
+        "state_interval": 5,
+        "match_window": 60,
+        "check_interval": 10,
+        "adaptive_window": False,
+        "match_window_min": 10,
+        "match_window_max": 300,
+        "match_window_factor": 2.0,
+        "store": {
+            "max_entries": 500000,
+            "max_bytes": 128 * 1024 * 1024,
+            "overflow": "spill",
+            "spill_path": "",
+        },
         "exchanges": [
             {"exchange": "amq.topic", "exchange_type": "topic", "durable": True},
             {"exchange": "zmq.topic", "exchange_type": "topic", "durable": True},
@@ -57,6 +108,40 @@ DEFAULTS = dict(
             },
         ],
     },
+    capture={
+        "directory": "",
+        "segment_max_bytes": 256 * 1024 * 1024,
+        "segment_max_age": 3600,
+        "block_size": 1000,
+        "flush_interval": 1,
+        "compresslevel": 6,
+        "rcvhwm": 100000,
+        "queue": {
+            "queue": "amqp_bridge_capture",
+            "durable": False,
+            "auto_delete": True,
+            "arguments": {"x-message-ttl": 1000 * 60},
+        },
+        "bindings": [
+            {
+                "exchange": "zmq.topic",
+                "queue": "amqp_bridge_capture",
+                "routing_keys": ["#"],
+            },
+            {
+                "exchange": "amq.topic",
+                "queue": "amqp_bridge_capture",
+                "routing_keys": ["#"],
+            },
+        ],
+    },
+    replay={
+        "publish_endpoint": "tcp://127.0.0.1:9940",
+        "speed": 1.0,
+        "publishers": 1,
+        "queue_size": 10000,
+        "subscriber_delay": 1,
+    },
     log_config={
         "version": 1,
         "disable_existing_loggers": False,
@@ -81,10 +166,6 @@ DEFAULTS = dict(
     },
 )
 
-# Start with a basic logging configuration, which will be replaced by any user-
-# specified logging configuration when the configuration is loaded.
-logging.config.dictConfig(DEFAULTS["log_config"])
-
 
 def load(filename=None):
     """
@@ -95,6 +176,19 @@ def load(filename=None):
     filesystem path, the configuration will be loaded from that location.
     Otherwise, the path defaults to ``/etc/fedmsg-migration-tools/config.toml``.
     """
+    try:
+        return _load(filename)
+    except toml.TomlDecodeError:
+        sys.exit(1)
+
+
+def _load(filename=None):
+    """
+    Like :func:`load`, but raise an exception if the file can't be parsed.
+
+    Raises:
+        toml.TomlDecodeError: If the file is not valid TOML.
+    """
     config = DEFAULTS.copy()
 
     if filename:
@@ -109,11 +203,11 @@ def load(filename=None):
         with open(config_path) as fd:
             try:
                 file_config = toml.load(fd)
-                for key in file_config:
-                    config[key.lower()] = file_config[key]
             except toml.TomlDecodeError as e:
                 _log.error("Failed to parse {}: {}".format(config_path, str(e)))
-                sys.exit(1)
+                raise
+        for key in file_config:
+            config[key.lower()] = file_config[key]
     else:
         _log.info("The configuration file, {}, does not exist.".format(config_path))
 
@@ -124,6 +218,7 @@ class LazyConfig(dict):
     """This class lazy-loads the configuration file."""
 
     loaded = False
+    filename = None
 
     def __getitem__(self, *args, **kw):
         if not self.loaded:
@@ -157,9 +252,26 @@ class LazyConfig(dict):
 
     def load_config(self, filename=None):
         self.loaded = True
+        self.filename = filename
         self.update(load(filename=filename))
         return self
 
+    def reload(self):
+        """
+        Load the configuration file again, from where it was loaded last.
+
+        Returns:
+            LazyConfig: This configuration.
+
+        Raises:
+            ValueError: If the file can't be parsed, in which case the
+                configuration is left unchanged.
+        """
+        config = _load(filename=self.filename)
+        self.loaded = True
+        self.update(config)
+        return self
+
 
 #: The application configuration dictionary.
 conf = LazyConfig()
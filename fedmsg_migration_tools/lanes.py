@@ -0,0 +1,280 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Priority lanes, so latency-sensitive topics are not stuck behind bulk traffic.
+
+The messages are sorted into :class:`Lane` queues by topic, with shell-style
+patterns like ``*.bodhi.update.*``, and :class:`Lanes` takes them out with a
+smooth weighted round-robin: with weights of 8 and 1, the first lane gets eight
+messages out for each one of the second, as long as both have some waiting.
+A lane with nothing waiting doesn't hold the others up.
+"""
+
+from collections import deque
+import fnmatch
+import logging
+import re
+import time
+
+from fedmsg_migration_tools.metrics import Histogram
+
+
+_log = logging.getLogger(__name__)
+
+
+class Lane(object):
+    """
+    A bounded queue for the messages of a priority class.
+
+    Args:
+        name (str): The name of the class, in the logs and statistics.
+        patterns (list): The shell-style patterns of the topics of the class.
+        weight (int): How many messages to take out of this lane for each one
+            taken out of a lane of weight 1, when both have messages waiting.
+        size (int): How many messages can wait in the lane. Messages are dropped
+            when it is full.
+        clock (callable): The monotonic clock to use.
+
+    Raises:
+        ValueError: If the weight or the size isn't positive.
+    """
+
+    def __init__(self, name, patterns=(), weight=1, size=10000, clock=time.monotonic):
+        if weight < 1 or size < 1:
+            raise ValueError(
+                "The weight and size of the {} lane must be positive".format(name)
+            )
+        self.name = name
+        self.patterns = list(patterns)
+        self.weight = weight
+        self.size = size
+        self.current_weight = 0
+        self.queue = deque()
+        self._clock = clock
+        self._regex = None
+        if self.patterns:
+            self._regex = re.compile(
+                b"|".join(
+                    fnmatch.translate(pattern).encode("utf-8")
+                    for pattern in self.patterns
+                )
+            )
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Forget the statistics counted so far and start a new period."""
+        self.queued = 0
+        self.published = 0
+        self.dropped = 0
+        self.max_depth = len(self.queue)
+        self.latency = Histogram()
+
+    def matches(self, topic):
+        """
+        Args:
+            topic (bytes): The topic of a message.
+
+        Returns:
+            bool: Whether the topic matches one of the patterns of the lane.
+        """
+        return self._regex is not None and self._regex.match(topic) is not None
+
+    def put(self, item):
+        """
+        Queue a message, unless the lane is full.
+
+        Returns:
+            bool: Whether the message was queued.
+        """
+        if len(self.queue) >= self.size:
+            self.dropped += 1
+            return False
+        self.queue.append((self._clock(), item))
+        self.queued += 1
+        self.max_depth = max(self.max_depth, len(self.queue))
+        return True
+
+    def get(self):
+        """Take the oldest message out of the lane, which must not be empty."""
+        queued, item = self.queue.popleft()
+        self.latency.add(self._clock() - queued)
+        self.published += 1
+        return item
+
+    def stats(self):
+        """
+        Returns:
+            dict: The messages queued, published, and dropped, the depth of the
+                queue, and the distribution of the time the messages spent in
+                it, since the statistics were reset.
+        """
+        return {
+            "queued": self.queued,
+            "published": self.published,
+            "dropped": self.dropped,
+            "depth": len(self.queue),
+            "max_depth": self.max_depth,
+            "latency": self.latency.summary(),
+        }
+
+
+class Lanes(object):
+    """
+    Priority lanes, with a weighted scheduler to take the messages out.
+
+    Args:
+        lanes (list): The :class:`Lane` of each priority class. A message goes
+            in the first lane whose patterns match its topic.
+        default (Lane): The lane of the messages no other lane matches.
+        report_interval (float): How often to log the statistics of the lanes,
+            in seconds. 0 disables the reports.
+        clock (callable): The monotonic clock to use.
+    """
+
+    def __init__(self, lanes, default, report_interval=60, clock=time.monotonic):
+        self.lanes = list(lanes)
+        self.default = default
+        self.report_interval = report_interval
+        self._all_lanes = self.lanes + [default]
+        self._clock = clock
+        self._next_report = clock() + report_interval
+
+    @classmethod
+    def from_config(cls, settings, clock=time.monotonic):
+        """
+        Build the lanes from the ``lanes`` settings of a bridge.
+
+        Args:
+            settings (dict): The ``weight`` and ``size`` of the default lane,
+                which are also the defaults of the other lanes, the
+                ``report_interval``, and the ``patterns``, ``weight`` and
+                ``size`` of each priority class in ``classes``.
+            clock (callable): The monotonic clock to use.
+
+        Returns:
+            Lanes: The lanes, or ``None`` if no priority class is configured.
+
+        Raises:
+            ValueError: If the settings of a lane are invalid.
+        """
+        if not settings["classes"]:
+            return None
+        lanes = [
+            Lane(
+                name,
+                patterns=lane["patterns"],
+                weight=lane.get("weight", settings["weight"]),
+                size=lane.get("size", settings["size"]),
+                clock=clock,
+            )
+            for name, lane in settings["classes"].items()
+        ]
+        default = Lane(
+            "default", weight=settings["weight"], size=settings["size"], clock=clock
+        )
+        return cls(
+            lanes, default, report_interval=settings["report_interval"], clock=clock
+        )
+
+    def __len__(self):
+        return sum(len(lane.queue) for lane in self._all_lanes)
+
+    def lane_for(self, topic):
+        """
+        Args:
+            topic (bytes): The topic of a message.
+
+        Returns:
+            Lane: The lane of the message.
+        """
+        for lane in self.lanes:
+            if lane.matches(topic):
+                return lane
+        return self.default
+
+    def put(self, topic, item):
+        """
+        Queue a message in the lane of its topic.
+
+        Args:
+            topic (bytes): The topic of the message.
+            item: The message.
+
+        Returns:
+            bool: Whether the message was queued, rather than dropped because
+                its lane is full.
+        """
+        return self.lane_for(topic).put(item)
+
+    def get(self):
+        """
+        Take the next message out of the lanes, and log the statistics when
+        they are due.
+
+        Returns:
+            The message, or ``None`` if no message is waiting.
+        """
+        if self.report_interval and self._clock() >= self._next_report:
+            self.report()
+        waiting = [lane for lane in self._all_lanes if lane.queue]
+        if not waiting:
+            return None
+        total = 0
+        for lane in waiting:
+            lane.current_weight += lane.weight
+            total += lane.weight
+        chosen = max(waiting, key=lambda lane: lane.current_weight)
+        chosen.current_weight -= total
+        return chosen.get()
+
+    def drain(self):
+        """
+        Take all the waiting messages out of the lanes.
+
+        Returns:
+            list: The messages, in the order the scheduler takes them out.
+        """
+        items = []
+        while len(self):
+            items.append(self.get())
+        return items
+
+    def stats(self):
+        """
+        Returns:
+            dict: The statistics of each lane, by name.
+        """
+        return {lane.name: lane.stats() for lane in self._all_lanes}
+
+    def report(self):
+        """Log the statistics of the lanes and reset them."""
+        for lane in self._all_lanes:
+            stats = lane.stats()
+            level = logging.WARNING if stats["dropped"] else logging.INFO
+            _log.log(
+                level,
+                "Priority lane %s: %d published (p99 latency %.3fs), %d dropped, "
+                "%d waiting (max %d)",
+                lane.name,
+                stats["published"],
+                stats["latency"].get("p99", 0.0),
+                stats["dropped"],
+                stats["depth"],
+                stats["max_depth"],
+            )
+            lane.reset_stats()
+        self._next_report = self._clock() + self.report_interval
@@ -0,0 +1,651 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Matching of the messages received from AMQP and ZeroMQ.
+
+This is independent from how the messages are received, so it is shared by
+both engines of the live verify_missing service and the offline verification
+of captures.
+"""
+
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import re
+import time
+import zlib
+
+from fedmsg_migration_tools import config
+from fedmsg_migration_tools.metrics import (
+    Histogram,
+    MatchStats,
+    format_summary,
+    write_json,
+)
+from fedmsg_migration_tools.store import Record, SpillStore, StateLog, Store
+
+
+_log = logging.getLogger(__name__)
+
+YEAR_PREFIX_RE = re.compile("^[0-9]{4}-")
+
+
+def normalize_msg_id(msg_id):
+    """
+    Remove the year prefix fedmsg adds to message IDs, so they can be compared
+    with the IDs of the AMQP messages.
+
+    Args:
+        msg_id (str): The message ID.
+
+    Returns:
+        str: The message ID without the year prefix.
+    """
+    return YEAR_PREFIX_RE.sub("", msg_id)
+
+
+MSG_ID_KEY = b'"msg_id"'
+MSG_ID_RE = re.compile(rb'"msg_id"\s*:\s*"([^"\\]*)"')
+BRACKETS_RE = re.compile(rb"[][{}]")
+
+
+def _only_brace(data, brace):
+    """
+    Check whether the only bracket in some JSON text is a brace at its start
+    (``{``) or at its end (``}``), strings included.
+
+    Looking inside strings too can only make this stricter, and allows for a
+    plain search rather than tokenizing the text.
+    """
+    if brace == b"{":
+        data = data.lstrip()
+        return data.startswith(brace) and BRACKETS_RE.search(data, 1) is None
+    data = data.rstrip()
+    return data.endswith(brace) and BRACKETS_RE.search(data, 0, len(data) - 1) is None
+
+
+def extract_msg_id(body):
+    """
+    Get the top-level ``msg_id`` of a JSON-serialized fedmsg message, without
+    decoding all of it when possible.
+
+    The ID is found with a regular expression, and is only trusted if the key
+    appears once in the message, its value has no escape sequence, and the
+    text on the shorter side of it has no bracket other than the brace opening
+    or closing the message, so the key must be at the top level. As fedmsg
+    sorts the message keys, ``msg_id`` comes right after the (large) ``msg``,
+    so only the few keys after it are looked at. In any other case, the whole
+    message is decoded.
+
+    Args:
+        body (bytes): The message, serialized to JSON and encoded in UTF-8.
+
+    Returns:
+        str: The message ID, or ``None`` if the message has no ``msg_id``.
+
+    Raises:
+        ValueError: If the message has to be decoded and isn't valid JSON.
+    """
+    index = body.find(MSG_ID_KEY)
+    if (
+        index > 0
+        and body[index - 1] != 0x5C  # a backslash, the quote would be escaped
+        and body.rfind(MSG_ID_KEY) == index
+    ):
+        match = MSG_ID_RE.match(body, index)
+        if match is not None:
+            start, end = match.span()
+            if start < len(body) - end:
+                top_level = _only_brace(body[:start], b"{")
+            else:
+                top_level = _only_brace(body[end:], b"}")
+            if top_level:
+                return match.group(1).decode("utf-8")
+    message = json.loads(body)
+    if not isinstance(message, dict):
+        return None
+    return message.get("msg_id")
+
+
+def body_digest(body):
+    """
+    Compute a digest of a message body that doesn't depend on how the body was
+    serialized, so the bodies received from AMQP and ZeroMQ can be compared.
+
+    The body is serialized to canonical JSON (sorted keys, no whitespace) and
+    hashed with BLAKE2b.
+
+    Args:
+        body: The decoded message body.
+
+    Returns:
+        bytes: The 16-byte digest.
+    """
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).digest()
+
+
+def decode_with_digest(body):
+    """
+    Decode a fedmsg message, and compute the digest of its body.
+
+    Args:
+        body (bytes): The message, serialized to JSON.
+
+    Returns:
+        tuple: The message ID (``None`` if there is none) and the body digest.
+    """
+    message = json.loads(body)
+    if not isinstance(message, dict):
+        return None, None
+    return message.get("msg_id"), body_digest(message.get("msg"))
+
+
+class Shard(namedtuple("Shard", ["index", "count"])):
+    """
+    One of the shards the messages are split into, by message ID, so they can
+    be matched by several processes.
+
+    Args:
+        index (int): The index of the shard, from 0 to ``count - 1``.
+        count (int): The number of shards.
+    """
+
+    __slots__ = ()
+
+    def owns(self, msg_id):
+        """
+        Check whether a message belongs to this shard.
+
+        Messages without an ID all belong to the first shard, so they are only
+        reported once.
+
+        Args:
+            msg_id (str): The message ID, with or without the year prefix.
+
+        Returns:
+            bool: Whether the message belongs to this shard.
+        """
+        if msg_id is None:
+            return self.index == 0
+        msg_id = normalize_msg_id(msg_id).encode("utf-8")
+        return zlib.crc32(msg_id) % self.count == self.index
+
+
+def report_stats(stats, report_file=None, match_window=None):
+    """
+    Log a summary of the statistics, and write it to a JSON file.
+
+    Args:
+        stats (MatchStats): The statistics.
+        report_file (str): The path of the JSON file to write the summary to,
+            if any.
+        match_window (float): The match window in use, to add to the summary,
+            if any.
+
+    Returns:
+        dict: The summary of the statistics.
+    """
+    summary = stats.summary()
+    if match_window is not None:
+        summary["match_window"] = match_window
+    _log.info("Bridge report: %s", format_summary(summary))
+    if report_file:
+        try:
+            write_json(report_file, summary)
+        except (IOError, OSError) as e:
+            _log.error("Failed to write the report to %s: %s", report_file, e)
+    return summary
+
+
+class Matcher(object):
+    """
+    Match messages received from AMQP and ZeroMQ, and report the ones that were
+    only received on one side.
+
+    Messages are matched as soon as they are received (see :meth:`received`).
+    The :meth:`remove_matching` method only remains as a safety net for
+    messages added to the stores directly.
+
+    Rather than logging every message that was received on both sides, the
+    delays between both receptions and the number of missing messages are
+    collected by topic prefix in :attr:`stats`, and a summary is logged and
+    optionally written to a JSON file periodically (see :meth:`report`).
+
+    When the records of both sides have a digest of the message body (see
+    :func:`body_digest`), the digests are compared too, and the messages whose
+    bodies differ are reported.
+
+    The messages received on one side only are reported once they have waited
+    for longer than the match window. The window can be adapted to the observed
+    latencies: every report, it is set to their :attr:`WINDOW_QUANTILE`
+    quantile times a safety factor, within bounds. The messages reported as
+    missing are counted as latencies of a whole window, so the window widens
+    when more of them than the quantile allows go missing, rather than staying
+    stuck below latencies it can no longer observe.
+
+    Args:
+        amqp_store (Store): The messages received from AMQP.
+        zmq_store (Store): The messages received from ZeroMQ.
+        stats (MatchStats): Where to collect statistics. Defaults to a new
+            :class:`MatchStats`.
+        report_file (str): The path of the JSON file to write the reports to, if
+            any.
+        clock (callable): The function returning the current time, on the same
+            scale as the records' reception times. Defaults to
+            :func:`time.monotonic`.
+        state (StateLog): Where to log the messages waiting to be matched, so
+            they can be restored after a restart (see :meth:`restore`), if
+            anywhere.
+        match_window (float): How long to wait for a message on the other side,
+            in seconds, or the initial value if it is adaptive.
+        window_bounds (tuple): The minimum and maximum match window, in
+            seconds, to make it adaptive. The window is fixed by default.
+        window_factor (float): What to multiply the latency quantile by to get
+            the adaptive match window.
+    """
+
+    MATCH_WINDOW = 60
+    #: The quantile of the latencies the adaptive match window is based on.
+    WINDOW_QUANTILE = 0.999
+    #: How many latencies to observe before adapting the match window.
+    WINDOW_MIN_SAMPLES = 1000
+
+    def __init__(
+        self,
+        amqp_store,
+        zmq_store,
+        stats=None,
+        report_file=None,
+        clock=time.monotonic,
+        state=None,
+        match_window=MATCH_WINDOW,
+        window_bounds=None,
+        window_factor=2.0,
+    ):
+        self.amqp_store = amqp_store
+        self.zmq_store = zmq_store
+        self.stats = stats or MatchStats()
+        self.report_file = report_file
+        self.clock = clock
+        self.state = state
+        self.match_window = match_window
+        self.window_bounds = window_bounds
+        self.window_factor = window_factor
+        self._latencies = Histogram()
+
+    def _side(self, store):
+        return "amqp" if store is self.amqp_store else "zmq"
+
+    def _state_added(self, store, msg_id, record):
+        if self.state is not None:
+            received = time.time() - (self.clock() - record.received)
+            self.state.added(
+                self._side(store), msg_id, record.topic, received, record.digest
+            )
+
+    def _state_removed(self, store, msg_id):
+        if self.state is not None:
+            self.state.removed(self._side(store), msg_id)
+
+    def _store(self, store, msg_id, record):
+        """
+        Add a message to a store and to the state log, and remove the messages
+        the store dropped to make room from the state log, since they were
+        already counted as not checked.
+        """
+        dropped = store.add(msg_id, record)
+        self._state_added(store, msg_id, record)
+        for dropped_id in dropped:
+            self._state_removed(store, dropped_id)
+
+    def restore(self):
+        """
+        Put the messages that were waiting to be matched when the service
+        stopped back in the stores, from the :attr:`state` log.
+
+        Their reception times are adjusted for the time the service was
+        stopped. The messages that expired in the meantime are dropped rather
+        than reported, since their counterparts may have been received while
+        the service was stopped.
+        """
+        if self.state is None:
+            return
+        now, wall_now = self.clock(), time.time()
+        restored = expired = 0
+        for (side, msg_id), (topic, received, digest) in self.state.load().items():
+            age = wall_now - received
+            if age > self.match_window:
+                self.state.removed(side, msg_id)
+                expired += 1
+                continue
+            store = self.amqp_store if side == "amqp" else self.zmq_store
+            for dropped_id in store.add(msg_id, Record(topic, now - age, digest)):
+                self.state.removed(side, dropped_id)
+            restored += 1
+        _log.info(
+            "Restored %d messages waiting to be matched, %d more expired while "
+            "stopped and could not be checked",
+            restored,
+            expired,
+        )
+
+    def received(self, store, msg_id, record):
+        """
+        Record a message received on one side, or resolve it immediately if it
+        was already received on the other side. Messages received twice on the
+        same side are only counted as duplicates.
+
+        Args:
+            store (Store): The store of the side the message was received on,
+                either ``amqp_store`` or ``zmq_store``.
+            msg_id (str): The message ID, without the year prefix.
+            record (Record): The record of the message.
+        """
+        if store is self.amqp_store:
+            source_name, peer_store = "AMQP", self.zmq_store
+        else:
+            source_name, peer_store = "ZeroMQ", self.amqp_store
+        if msg_id in store:
+            _log.info(
+                "Received a duplicate %s message with id %s on topic %s",
+                source_name,
+                msg_id,
+                record.topic,
+            )
+            self.stats.duplicate(record.topic, source_name)
+            return
+        peer_record = peer_store.pop(msg_id, None)
+        if peer_record is not None:
+            self._state_removed(peer_store, msg_id)
+            self._matched(msg_id, record, peer_record)
+            return
+        self._store(store, msg_id, record)
+
+    def _matched(self, msg_id, record, peer_record):
+        latency = record.received - peer_record.received
+        _log.debug(
+            "Successfully received message (id %s) via ZMQ and AMQP (%.3fs apart)",
+            msg_id,
+            abs(latency),
+        )
+        self.stats.matched(record.topic, latency)
+        if self.window_bounds is not None:
+            self._latencies.add(abs(latency))
+        if (
+            record.digest is not None
+            and peer_record.digest is not None
+            and record.digest != peer_record.digest
+        ):
+            _log.warning(
+                "Message %s was received with different bodies in AMQP and ZeroMQ "
+                "(with topic %s)",
+                msg_id,
+                record.topic or "NO TOPIC",
+            )
+            self.stats.mismatched(record.topic)
+
+    def received_at(self, record):
+        """
+        Get the wall-clock time a message was received at, for reporting.
+
+        Args:
+            record (Record): The record of the message.
+
+        Returns:
+            datetime.datetime: The UTC time the message was received at.
+        """
+        return record.received_at()
+
+    def remove_matching(self):
+        """Resolve the messages present in both stores."""
+        _log.debug(
+            "Checking for matching messages (%d, %d)",
+            len(self.amqp_store),
+            len(self.zmq_store),
+        )
+        for msg_id in list(self.amqp_store.keys()):
+            if msg_id in self.zmq_store:
+                self._matched(
+                    msg_id, self.amqp_store.pop(msg_id), self.zmq_store.pop(msg_id)
+                )
+                self._state_removed(self.amqp_store, msg_id)
+                self._state_removed(self.zmq_store, msg_id)
+
+    def check_missing(self):
+        """Report the messages that were only received on one side in time."""
+        _log.debug("Checking for missing messages")
+        self._check_store(self.amqp_store, "AMQP")
+        self._check_store(self.zmq_store, "ZeroMQ")
+
+    def _check_store(self, store, source_name):
+        threshold = self.clock() - self.match_window
+        for msg_id, record in store.expire(threshold):
+            self._state_removed(store, msg_id)
+            if self.window_bounds is not None:
+                self._latencies.add(self.match_window)
+            _log.warning(
+                "Message %s was only received in %s (at %s, with topic %s)",
+                msg_id,
+                source_name,
+                self.received_at(record).isoformat(),
+                record.topic or "NO TOPIC",
+            )
+            self.stats.missing(record.topic, source_name)
+        for topic, count in sorted(store.pop_overflowed().items()):
+            _log.warning(
+                "%d messages with topic %s overflowed the %s store and could not "
+                "be checked",
+                count,
+                topic,
+                source_name,
+            )
+
+    def adapt_window(self):
+        """
+        Adapt the match window to the latencies observed since it last was, if
+        it is adaptive and enough of them were.
+
+        Returns:
+            float: The match window, or ``None`` if it is fixed.
+        """
+        if self.window_bounds is None:
+            return None
+        if self._latencies.count < self.WINDOW_MIN_SAMPLES:
+            return self.match_window
+        minimum, maximum = self.window_bounds
+        window = self._latencies.quantile(self.WINDOW_QUANTILE) * self.window_factor
+        window = min(max(window, minimum), maximum)
+        if window != self.match_window:
+            _log.info(
+                "Adapted the match window from %.1fs to %.1fs",
+                self.match_window,
+                window,
+            )
+        self.match_window = window
+        self._latencies = Histogram()
+        return window
+
+    def report(self):
+        """
+        Adapt the match window, report the statistics collected since the last
+        report, and reset them.
+
+        Returns:
+            dict: The summary of the statistics that was reported.
+        """
+        summary = report_stats(self.stats, self.report_file, self.adapt_window())
+        self.stats.reset()
+        return summary
+
+
+class PeriodicMatcher(Matcher):
+    """
+    A :class:`Matcher` whose checks are run periodically by a service.
+
+    This is what the services of both verify_missing engines share: they only
+    schedule the calls to :meth:`remove_matching`, :meth:`check_missing`,
+    :meth:`report` and :meth:`flush_state`, between :meth:`start` and
+    :meth:`stop`.
+
+    See :class:`Matcher` for the arguments. Additionally:
+
+    Args:
+        report_interval (int): How often to report statistics, in seconds.
+        shard (Shard): The shard of the messages being compared, if they are
+            sharded.
+        report_queue (multiprocessing.Queue): If set, rather than being
+            reported, the statistics are put in this queue as a
+            ``(shard index, MatchStats.to_dict(), match window)`` tuple, to be
+            merged with the ones of the other shards.
+        state_interval (int): How often to write the :attr:`state` log, in
+            seconds.
+        check_interval (int): How often to check for missing messages, in
+            seconds.
+    """
+
+    SAFETY_NET_INTERVAL = 10
+    CHECK_INTERVAL = 10
+
+    def __init__(
+        self,
+        amqp_store,
+        zmq_store,
+        report_interval=60,
+        shard=None,
+        report_queue=None,
+        state_interval=5,
+        check_interval=CHECK_INTERVAL,
+        **kwargs
+    ):
+        Matcher.__init__(self, amqp_store, zmq_store, **kwargs)
+        self.report_interval = report_interval
+        self.shard = shard
+        self.report_queue = report_queue
+        self.state_interval = state_interval
+        self.check_interval = check_interval
+
+    def start(self):
+        """Restore the messages that were waiting when the service stopped."""
+        if self.state is not None:
+            self.restore()
+
+    def stop(self):
+        """Save the messages still waiting, for the next start."""
+        if self.state is not None:
+            self.state.flush()
+            self.state.close()
+
+    def flush_state(self):
+        """Write the changes to the messages waiting to the :attr:`state` log."""
+        self.state.flush()
+
+    def report(self):
+        if self.report_queue is None:
+            return Matcher.report(self)
+        self.report_queue.put(
+            (self.shard.index, self.stats.to_dict(), self.adapt_window())
+        )
+        self.stats.reset()
+
+
+def get_verify_config(key):
+    """Get a verify_missing configuration value, falling back to its default."""
+    try:
+        return config.conf["verify_missing"][key]
+    except KeyError:
+        return config.DEFAULTS["verify_missing"][key]
+
+
+def make_store(side, shard=None):
+    """
+    Create a message store bounded as configured.
+
+    Args:
+        side (str): The side of the bridge the store is for, ``amqp`` or ``zmq``.
+        shard (Shard): The shard the store is for, if messages are sharded.
+    """
+    store_config = dict(
+        config.DEFAULTS["verify_missing"]["store"], **get_verify_config("store")
+    )
+    spill = None
+    if store_config["overflow"] == "spill":
+        spill_path = store_config["spill_path"]
+        if spill_path:
+            spill_path += "." + side
+            if shard is not None:
+                spill_path += ".{}".format(shard.index)
+        spill = SpillStore(spill_path)
+    return Store(
+        max_entries=store_config["max_entries"] or None,
+        max_bytes=store_config["max_bytes"] or None,
+        spill=spill,
+    )
+
+
+def make_state_log(shard=None):
+    """
+    Create the log of the messages waiting to be matched, if configured.
+
+    Args:
+        shard (Shard): The shard the log is for, if messages are sharded.
+    """
+    path = get_verify_config("state_file")
+    if not path:
+        return None
+    if shard is not None:
+        path += ".{}".format(shard.index)
+    return StateLog(path)
+
+
+def make_comparator(comparator_class, shard=None, report_queue=None):
+    """
+    Create the comparator of a verify_missing engine, with its stores, as
+    configured.
+
+    Args:
+        comparator_class (type): The :class:`PeriodicMatcher` subclass of the
+            engine.
+        shard (Shard): The shard of the messages to verify, if they are sharded.
+        report_queue (multiprocessing.Queue): The queue to put the statistics
+            in, rather than reporting them, if any.
+
+    Returns:
+        PeriodicMatcher: The comparator.
+    """
+    window_bounds = None
+    if get_verify_config("adaptive_window"):
+        window_bounds = (
+            get_verify_config("match_window_min"),
+            get_verify_config("match_window_max"),
+        )
+    return comparator_class(
+        make_store("amqp", shard),
+        make_store("zmq", shard),
+        stats=MatchStats(prefix_depth=get_verify_config("topic_prefix_depth")),
+        report_interval=get_verify_config("report_interval"),
+        report_file=get_verify_config("report_file") or None,
+        shard=shard,
+        report_queue=report_queue,
+        state=make_state_log(shard),
+        state_interval=get_verify_config("state_interval"),
+        check_interval=get_verify_config("check_interval"),
+        match_window=get_verify_config("match_window"),
+        window_bounds=window_bounds,
+        window_factor=get_verify_config("match_window_factor"),
+    )
@@ -0,0 +1,346 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Statistics collected by the services, and how they are exported."""
+
+from datetime import datetime
+import json
+import math
+import os
+import tempfile
+
+
+def write_json(path, data):
+    """
+    Atomically replace a file with the JSON serialization of some data.
+
+    Readers of the file never see a partially written version.
+
+    Args:
+        path (str): The path of the file to write.
+        data: The data to serialize.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as fd:
+            json.dump(data, fd, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class Histogram(object):
+    """
+    A streaming histogram to estimate quantiles in constant memory.
+
+    Values are counted in logarithmic buckets, each one :attr:`GROWTH` times
+    wider than the previous one, so quantiles are estimated with a relative
+    error of about 2.5% whatever their magnitude. Histograms can be merged.
+    """
+
+    #: The values below this one all go in the first bucket.
+    MINIMUM = 1e-4
+    GROWTH = 1.05
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """
+        Count a value.
+
+        Args:
+            value (float): The value, which must not be negative.
+        """
+        if value <= self.MINIMUM:
+            index = 0
+        else:
+            index = int(math.log(value / self.MINIMUM, self.GROWTH)) + 1
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile of the values counted so far.
+
+        Args:
+            q (float): The quantile, between 0 and 1 (0.99 for the 99th percentile).
+
+        Returns:
+            float: The estimated value, or ``None`` if nothing was counted.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        if index == 0:
+            return min(self.MINIMUM, self.max)
+        # The geometric middle of the bucket
+        return min(self.MINIMUM * self.GROWTH ** (index - 0.5), self.max)
+
+    def merge(self, other):
+        """
+        Add the values counted by another histogram to this one.
+
+        Args:
+            other (Histogram): The other histogram.
+        """
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        """
+        Summarize the distribution of the values.
+
+        Returns:
+            dict: The mean, maximum, and usual percentiles of the values.
+        """
+        if not self.count:
+            return {}
+        return {
+            "mean": self.total / self.count,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "p99.9": self.quantile(0.999),
+            "max": self.max,
+        }
+
+    def to_dict(self):
+        """Serialize the histogram to a JSON-compatible dictionary."""
+        return {
+            "buckets": {str(index): count for index, count in self.buckets.items()},
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Deserialize a histogram produced by :meth:`to_dict`."""
+        histogram = cls()
+        histogram.buckets = {int(index): n for index, n in data["buckets"].items()}
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.max = data["max"]
+        return histogram
+
+
+class MatchStats(object):
+    """
+    Statistics on the messages matched (or not) between AMQP and ZeroMQ.
+
+    For each topic prefix, this counts the messages received on both sides,
+    the ones among them whose bodies differ, the ones only received on one
+    side, and the duplicates, and it keeps a :class:`Histogram` of the delay
+    between the two receptions.
+
+    Args:
+        prefix_depth (int): How many components of the topics to group them by.
+            For example, with 4, ``org.fedoraproject.prod.bodhi.update.comment``
+            is counted under ``org.fedoraproject.prod.bodhi``.
+    """
+
+    def __init__(self, prefix_depth=4):
+        self.prefix_depth = prefix_depth
+        self.reset()
+
+    def reset(self):
+        """Forget everything counted so far and start a new period."""
+        self.started = datetime.utcnow()
+        self.topics = {}
+
+    def _topic_stats(self, topic):
+        prefix = ".".join((topic or "").split(".")[: self.prefix_depth])
+        try:
+            return self.topics[prefix]
+        except KeyError:
+            stats = self.topics[prefix] = self._new_topic_stats()
+            return stats
+
+    @staticmethod
+    def _new_topic_stats():
+        return {
+            "matched": 0,
+            "mismatched": 0,
+            "missing": {},
+            "duplicates": {},
+            "latency": Histogram(),
+        }
+
+    def matched(self, topic, latency):
+        """
+        Count a message received on both sides.
+
+        Args:
+            topic (str): The message topic.
+            latency (float): The delay between both receptions, in seconds.
+        """
+        stats = self._topic_stats(topic)
+        stats["matched"] += 1
+        stats["latency"].add(abs(latency))
+
+    def mismatched(self, topic):
+        """
+        Count a message received on both sides with different bodies.
+
+        Args:
+            topic (str): The message topic.
+        """
+        self._topic_stats(topic)["mismatched"] += 1
+
+    def missing(self, topic, source):
+        """
+        Count a message only received on one side.
+
+        Args:
+            topic (str): The message topic.
+            source (str): The name of the side it was received on.
+        """
+        missing = self._topic_stats(topic)["missing"]
+        missing[source] = missing.get(source, 0) + 1
+
+    def duplicate(self, topic, source):
+        """
+        Count a message received more than once on one side.
+
+        Args:
+            topic (str): The message topic.
+            source (str): The name of the side it was received on.
+        """
+        duplicates = self._topic_stats(topic)["duplicates"]
+        duplicates[source] = duplicates.get(source, 0) + 1
+
+    def merge(self, other):
+        """
+        Add the statistics collected by another instance to this one.
+
+        The period of this instance is extended to start when the other one's
+        did, if it started earlier.
+
+        Args:
+            other (MatchStats): The other statistics.
+        """
+        self.started = min(self.started, other.started)
+        for prefix, other_stats in other.topics.items():
+            stats = self.topics.setdefault(prefix, self._new_topic_stats())
+            stats["matched"] += other_stats["matched"]
+            stats["mismatched"] += other_stats["mismatched"]
+            for key in ("missing", "duplicates"):
+                for source, count in other_stats[key].items():
+                    stats[key][source] = stats[key].get(source, 0) + count
+            stats["latency"].merge(other_stats["latency"])
+
+    def to_dict(self):
+        """Serialize the statistics to a JSON-compatible dictionary."""
+        topics = {}
+        for prefix, stats in self.topics.items():
+            topics[prefix] = dict(stats, latency=stats["latency"].to_dict())
+        return {
+            "prefix_depth": self.prefix_depth,
+            "started": self.started.isoformat(),
+            "topics": topics,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Deserialize statistics produced by :meth:`to_dict`."""
+        stats = cls(prefix_depth=data["prefix_depth"])
+        started = data["started"]
+        time_format = "%Y-%m-%dT%H:%M:%S.%f" if "." in started else "%Y-%m-%dT%H:%M:%S"
+        stats.started = datetime.strptime(started, time_format)
+        for prefix, topic_stats in data["topics"].items():
+            stats.topics[prefix] = dict(
+                topic_stats, latency=Histogram.from_dict(topic_stats["latency"])
+            )
+        return stats
+
+    def summary(self):
+        """
+        Summarize the statistics of the current period.
+
+        Returns:
+            dict: The overall and per-topic-prefix counts and latencies.
+        """
+        total = {"matched": 0, "mismatched": 0, "missing": {}, "duplicates": {}}
+        latency = Histogram()
+        topics = {}
+        for prefix, stats in self.topics.items():
+            total["matched"] += stats["matched"]
+            total["mismatched"] += stats["mismatched"]
+            for key in ("missing", "duplicates"):
+                for source, count in stats[key].items():
+                    total[key][source] = total[key].get(source, 0) + count
+            latency.merge(stats["latency"])
+            topics[prefix] = {
+                "matched": stats["matched"],
+                "mismatched": stats["mismatched"],
+                "missing": dict(stats["missing"]),
+                "duplicates": dict(stats["duplicates"]),
+                "latency": stats["latency"].summary(),
+            }
+        total["latency"] = latency.summary()
+        return {
+            "start": self.started.isoformat(),
+            "end": datetime.utcnow().isoformat(),
+            "total": total,
+            "topics": topics,
+        }
+
+
+def format_summary(summary):
+    """
+    Format a :meth:`MatchStats.summary` as a single log line.
+
+    Args:
+        summary (dict): The summary.
+
+    Returns:
+        str: The compact description of the summary.
+    """
+    total = summary["total"]
+    parts = ["{} matched".format(total["matched"])]
+    if total["mismatched"]:
+        parts.append("{} with different bodies".format(total["mismatched"]))
+    for source, count in sorted(total["missing"].items()):
+        parts.append("{} only in {}".format(count, source))
+    duplicates = sum(total["duplicates"].values())
+    if duplicates:
+        parts.append("{} duplicates".format(duplicates))
+    latency = total["latency"]
+    if latency:
+        parts.append(
+            "latency p50={:.0f}ms p99={:.0f}ms max={:.0f}ms".format(
+                latency["p50"] * 1000, latency["p99"] * 1000, latency["max"] * 1000
+            )
+        )
+    if "match_window" in summary:
+        parts.append("match window {:.1f}s".format(summary["match_window"]))
+    return ", ".join(parts)
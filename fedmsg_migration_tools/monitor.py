@@ -0,0 +1,195 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+The connection events of the ZeroMQ sockets, and their reconnection settings.
+
+A :class:`SocketMonitor` reads the events ZeroMQ reports on the monitor socket
+of a socket, to log and count its connections, disconnections and retries,
+rather than only noticing a lost relay because fewer messages arrive.
+"""
+
+import logging
+import time
+
+import zmq
+from zmq.utils.monitor import recv_monitor_message
+
+
+_log = logging.getLogger(__name__)
+
+#: The settings of the kernel buffers, queues, reconnections and heartbeats, and
+#: their socket options. The buffer sizes are in bytes, and the durations in
+#: milliseconds.
+SOCKET_OPTIONS = {
+    "rcvbuf": zmq.RCVBUF,
+    "sndbuf": zmq.SNDBUF,
+    "sndhwm": zmq.SNDHWM,
+    "reconnect_ivl": zmq.RECONNECT_IVL,
+    "reconnect_ivl_max": zmq.RECONNECT_IVL_MAX,
+    "heartbeat_ivl": zmq.HEARTBEAT_IVL,
+    "heartbeat_timeout": zmq.HEARTBEAT_TIMEOUT,
+    "heartbeat_ttl": zmq.HEARTBEAT_TTL,
+}
+
+
+def socket_options(settings):
+    """
+    Pick the socket options out of some settings.
+
+    Args:
+        settings (dict): Settings, which may include the keys of
+            :data:`SOCKET_OPTIONS`.
+
+    Returns:
+        tuple: The ``(name, value)`` of the socket options set, sorted by name.
+    """
+    return tuple(
+        sorted((name, settings[name]) for name in SOCKET_OPTIONS if name in settings)
+    )
+
+
+def set_socket_options(socket, options):
+    """
+    Set socket options, before the socket connects or binds.
+
+    Args:
+        socket (zmq.Socket): The socket.
+        options (tuple): The ``(name, value)`` of the options, as returned by
+            :func:`socket_options`.
+    """
+    for name, value in options:
+        socket.setsockopt(SOCKET_OPTIONS[name], value)
+
+
+class SocketMonitor(object):
+    """
+    Track the connection events of a ZeroMQ socket.
+
+    Call :meth:`handle_events` when the monitor socket has events, or
+    regularly, since it doesn't block.
+
+    Args:
+        socket (zmq.Socket): The socket to monitor. It should not be connected
+            or bound yet, so no event is missed.
+        name (str): The name of the socket, in the logs.
+    """
+
+    EVENT_NAMES = {
+        zmq.EVENT_CONNECTED: "connected",
+        zmq.EVENT_CONNECT_DELAYED: "connect delayed",
+        zmq.EVENT_CONNECT_RETRIED: "connect retried",
+        zmq.EVENT_LISTENING: "listening",
+        zmq.EVENT_BIND_FAILED: "bind failed",
+        zmq.EVENT_ACCEPTED: "accepted",
+        zmq.EVENT_ACCEPT_FAILED: "accept failed",
+        zmq.EVENT_CLOSED: "closed",
+        zmq.EVENT_CLOSE_FAILED: "close failed",
+        zmq.EVENT_DISCONNECTED: "disconnected",
+        zmq.EVENT_MONITOR_STOPPED: "monitor stopped",
+        zmq.EVENT_HANDSHAKE_FAILED_NO_DETAIL: "handshake failed",
+        zmq.EVENT_HANDSHAKE_FAILED_PROTOCOL: "handshake failed (protocol)",
+        zmq.EVENT_HANDSHAKE_FAILED_AUTH: "handshake failed (authentication)",
+        zmq.EVENT_HANDSHAKE_SUCCEEDED: "handshake succeeded",
+    }
+
+    def __init__(self, socket, name):
+        self.name = name
+        self.socket = socket.get_monitor_socket()
+        self._monitored = socket
+        self.peers = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.retries = 0
+        self.last_event = None
+        self.last_event_time = None
+
+    @property
+    def connected(self):
+        """bool: Whether the socket has at least a peer."""
+        return self.peers > 0
+
+    def handle_events(self):
+        """Handle the events waiting on the monitor socket, without blocking."""
+        while True:
+            try:
+                event = recv_monitor_message(self.socket, zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.handle_event(event["event"], event["endpoint"])
+
+    def handle_event(self, event, endpoint):
+        """
+        Count and log an event.
+
+        Args:
+            event (int): The ZeroMQ event.
+            endpoint (bytes): The endpoint the event is about.
+        """
+        name = self.EVENT_NAMES.get(event, str(event))
+        endpoint = endpoint.decode("utf-8", "replace")
+        self.last_event = name
+        self.last_event_time = time.time()
+        if event in (zmq.EVENT_CONNECTED, zmq.EVENT_ACCEPTED):
+            self.peers += 1
+            self.connects += 1
+            _log.info("The %s socket %s %s", self.name, name, endpoint)
+        elif event == zmq.EVENT_DISCONNECTED:
+            self.peers = max(0, self.peers - 1)
+            self.disconnects += 1
+            _log.warning("The %s socket was disconnected from %s", self.name, endpoint)
+        elif event == zmq.EVENT_CONNECT_RETRIED:
+            self.retries += 1
+            _log.debug(
+                "The %s socket is retrying to connect to %s", self.name, endpoint
+            )
+        elif event in (
+            zmq.EVENT_BIND_FAILED,
+            zmq.EVENT_ACCEPT_FAILED,
+            zmq.EVENT_CLOSE_FAILED,
+            zmq.EVENT_HANDSHAKE_FAILED_NO_DETAIL,
+            zmq.EVENT_HANDSHAKE_FAILED_PROTOCOL,
+            zmq.EVENT_HANDSHAKE_FAILED_AUTH,
+        ):
+            _log.error("The %s socket had an error: %s %s", self.name, name, endpoint)
+        else:
+            _log.debug("The %s socket event: %s %s", self.name, name, endpoint)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Whether the socket is connected, the number of its peers, the
+                connections, disconnections, and connection retries since it
+                was created, and its last event with its time.
+        """
+        return {
+            "connected": self.connected,
+            "peers": self.peers,
+            "connects": self.connects,
+            "disconnects": self.disconnects,
+            "retries": self.retries,
+            "last_event": self.last_event,
+            "last_event_time": self.last_event_time,
+        }
+
+    def close(self):
+        """Stop monitoring the socket, and close the monitor socket."""
+        try:
+            self._monitored.disable_monitor()
+        except zmq.ZMQError:
+            # The monitored socket was closed already
+            pass
+        self.socket.close(linger=0)
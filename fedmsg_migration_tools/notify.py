@@ -0,0 +1,182 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Notifications to systemd, for the services of ``Type=notify``.
+
+The :class:`Notifier` speaks the ``sd_notify`` protocol: datagrams of
+``VARIABLE=value`` lines sent to the socket systemd names in ``NOTIFY_SOCKET``.
+Nothing is sent when the service wasn't started by systemd. The
+:class:`Watchdog` pings systemd's watchdog only while a message loop makes
+progress, so a bridge stuck on a publish is restarted, and reports its
+throughput in the status of the service.
+"""
+
+import logging
+import os
+import socket
+import time
+
+
+_log = logging.getLogger(__name__)
+
+
+class Notifier(object):
+    """
+    Send notifications to systemd.
+
+    Args:
+        environ (dict): The environment to find the notification socket and
+            the watchdog timeout in. Defaults to the process's environment.
+    """
+
+    def __init__(self, environ=None):
+        environ = os.environ if environ is None else environ
+        self.address = environ.get("NOTIFY_SOCKET") or None
+        if self.address and self.address.startswith("@"):
+            # An abstract socket
+            self.address = "\0" + self.address[1:]
+        self.watchdog_interval = None
+        watchdog_usec = environ.get("WATCHDOG_USEC")
+        watchdog_pid = environ.get("WATCHDOG_PID")
+        if watchdog_usec and (not watchdog_pid or int(watchdog_pid) == os.getpid()):
+            # Ping twice per timeout, as systemd recommends
+            self.watchdog_interval = int(watchdog_usec) / 1e6 / 2
+        self._socket = None
+
+    @property
+    def enabled(self):
+        """bool: Whether the service was started by systemd with notifications."""
+        return self.address is not None
+
+    def notify(self, *assignments):
+        """
+        Send variable assignments to systemd.
+
+        Args:
+            assignments (str): The ``VARIABLE=value`` assignments.
+
+        Returns:
+            bool: Whether the notification was sent.
+        """
+        if not self.enabled:
+            return False
+        try:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.sendto("\n".join(assignments).encode("utf-8"), self.address)
+        except (IOError, OSError) as e:
+            _log.warning("Failed to notify systemd: %s", e)
+            return False
+        return True
+
+    def ready(self, status=None):
+        """Tell systemd the service is up, with an optional status."""
+        assignments = ["READY=1"]
+        if status is not None:
+            assignments.append("STATUS=" + status)
+        return self.notify(*assignments)
+
+    def status(self, status):
+        """Set the status of the service, as shown by ``systemctl status``."""
+        return self.notify("STATUS=" + status)
+
+    def stopping(self):
+        """Tell systemd the service is stopping."""
+        return self.notify("STOPPING=1")
+
+    def watchdog(self):
+        """Ping systemd's watchdog."""
+        return self.notify("WATCHDOG=1")
+
+
+class Watchdog(object):
+    """
+    Ping systemd's watchdog while a message loop makes progress, and report
+    its throughput in the status of the service.
+
+    The loop calls :meth:`tick` on each turn, with the number of messages it
+    processed so far, the number waiting and the number held back on purpose,
+    by a traffic shaper for example. It is making progress while it turns and
+    either processes messages or has none waiting. The messages held back
+    don't count as waiting: a slow rate may hold them for longer than the
+    watchdog timeout. The pings stop when the loop doesn't turn, because it's
+    stuck on a publish for example, or when messages wait without any being
+    processed for a whole watchdog interval, so systemd restarts the service.
+
+    Args:
+        notifier (Notifier): The notifier to send the pings and status with.
+        status_interval (float): How often to update the status, in seconds.
+        clock (callable): The monotonic clock to use.
+    """
+
+    #: How often to update the status of the service, in seconds.
+    STATUS_INTERVAL = 5
+
+    def __init__(self, notifier, status_interval=STATUS_INTERVAL, clock=time.monotonic):
+        self.notifier = notifier
+        self.status_interval = status_interval
+        self._clock = clock
+        now = clock()
+        self._processed = 0
+        self._progress = now
+        self._next_ping = now
+        self._withheld = False
+        self._status_processed = 0
+        self._status_time = now
+        self._next_status = now
+
+    def tick(self, processed, waiting=0, held=0):
+        """
+        Ping the watchdog and update the status, when they are due.
+
+        Args:
+            processed (int): How many messages the loop processed so far.
+            waiting (int): How many messages are waiting to be processed.
+            held (int): How many messages are held back on purpose, which only
+                appear in the status.
+        """
+        if not self.notifier.enabled:
+            return
+        now = self._clock()
+        if processed != self._processed or not waiting:
+            self._processed = processed
+            self._progress = now
+        interval = self.notifier.watchdog_interval
+        if interval and now >= self._next_ping:
+            if now - self._progress < interval:
+                self.notifier.watchdog()
+                self._withheld = False
+            elif not self._withheld:
+                _log.warning(
+                    "No message processed for %.0f seconds with %d waiting, "
+                    "not pinging the watchdog",
+                    now - self._progress,
+                    waiting,
+                )
+                self._withheld = True
+            self._next_ping = now + interval
+        if now >= self._next_status:
+            elapsed = max(now - self._status_time, 1e-6)
+            status = "{:.1f} messages/s, {} waiting".format(
+                (processed - self._status_processed) / elapsed, waiting
+            )
+            if held:
+                status += ", {} held back".format(held)
+            self.notifier.status(status)
+            self._status_processed = processed
+            self._status_time = now
+            self._next_status = now + self.status_interval
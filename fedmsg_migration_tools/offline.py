@@ -0,0 +1,216 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Offline verification of recorded AMQP and ZeroMQ message logs.
+
+A message log is a text file with one JSON object per line, optionally
+compressed with gzip, bzip2, xz or (if the ``zstandard`` module is installed)
+Zstandard, depending on its extension. Each object must have the ``msg_id`` and
+``topic`` of the message, and the time it was received at, in seconds since the
+epoch, as ``received``. Plain fedmsg messages are accepted too, in which case
+their ``timestamp`` is used as the reception time.
+
+A log can also be a directory, such as the ones written by the ``capture``
+command, in which case the logs it contains are read in the order of their
+names.
+
+Both logs are expected to be in chronological order. They are read in parallel,
+in a merge join on the reception time, so the memory used only depends on the
+number of messages received during the match window, not on the size of the
+logs.
+"""
+
+import bz2
+from datetime import datetime
+import gzip
+import heapq
+import io
+import json
+import logging
+import lzma
+import os
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+from fedmsg_migration_tools.matching import Matcher, normalize_msg_id
+from fedmsg_migration_tools.metrics import MatchStats
+from fedmsg_migration_tools.store import Record, Store
+
+
+_log = logging.getLogger(__name__)
+
+#: How often to look for missing messages, in seconds of recorded time.
+CHECK_INTERVAL = 1
+
+#: The extensions of the message logs in a directory.
+LOG_EXTENSIONS = (".jsonl", ".jsonl.gz", ".jsonl.bz2", ".jsonl.xz", ".jsonl.zst")
+
+
+def _open_zstd(path):
+    if zstandard is None:
+        raise ValueError(
+            "The zstandard module is required to read {}".format(os.path.basename(path))
+        )
+    reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return io.TextIOWrapper(reader, encoding="utf-8")
+
+
+def open_log(path):
+    """
+    Open a message log for reading, decompressing it if needed.
+
+    Args:
+        path (str): The path of the log.
+
+    Returns:
+        file: The log, opened in text mode.
+
+    Raises:
+        ValueError: If the log is compressed with Zstandard and the zstandard
+            module is not installed.
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == ".gz":
+        return gzip.open(path, "rt", encoding="utf-8")
+    if extension == ".bz2":
+        return bz2.open(path, "rt", encoding="utf-8")
+    if extension == ".xz":
+        return lzma.open(path, "rt", encoding="utf-8")
+    if extension == ".zst":
+        return _open_zstd(path)
+    return open(path, encoding="utf-8")
+
+
+def list_logs(path):
+    """
+    List the message logs in a directory, in the order of their names.
+
+    Args:
+        path (str): A directory, or the path of a single log.
+
+    Returns:
+        list: The paths of the logs.
+    """
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(
+        os.path.join(path, name)
+        for name in os.listdir(path)
+        if name.endswith(LOG_EXTENSIONS)
+    )
+
+
+def read_log(path):
+    """
+    Read the messages of a message log.
+
+    Invalid lines and messages without an ID, topic, or reception time are
+    skipped.
+
+    Args:
+        path (str): The path of the log, or of a directory of logs.
+
+    Yields:
+        tuple: The ``(received, msg_id, topic)`` of each message, where
+            ``msg_id`` has no year prefix.
+    """
+    for log_path in list_logs(path):
+        with open_log(log_path) as fd:
+            for lineno, line in enumerate(fd, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                    received = float(entry.get("received", entry.get("timestamp")))
+                    msg_id = normalize_msg_id(entry["msg_id"])
+                    topic = entry["topic"]
+                except (ValueError, TypeError, KeyError, AttributeError) as e:
+                    _log.warning("Skipping line %d of %s: %r", lineno, log_path, e)
+                    continue
+                yield received, msg_id, topic
+
+
+class OfflineMatcher(Matcher):
+    """
+    A :class:`Matcher` whose clock is the reception time of the last message
+    read from the logs.
+    """
+
+    def __init__(self, amqp_store, zmq_store, **kwargs):
+        kwargs["clock"] = self._clock
+        Matcher.__init__(self, amqp_store, zmq_store, **kwargs)
+        self.now = float("-inf")
+
+    def _clock(self):
+        return self.now
+
+    def received_at(self, record):
+        return datetime.utcfromtimestamp(record.received)
+
+
+def verify(
+    amqp_log,
+    zmq_log,
+    report_file=None,
+    prefix_depth=4,
+    match_window=Matcher.MATCH_WINDOW,
+):
+    """
+    Verify two message logs, recorded from AMQP and ZeroMQ, against each other.
+
+    The messages only present in one log are reported like they would be by the
+    verify_missing service, and so is the summary of the statistics.
+
+    Args:
+        amqp_log (str): The path of the log of the AMQP messages.
+        zmq_log (str): The path of the log of the ZeroMQ messages.
+        report_file (str): The path of the JSON file to write the summary to.
+        prefix_depth (int): How many components of the topics to group the
+            statistics by.
+        match_window (float): How long to wait for a message on the other side,
+            in seconds.
+
+    Returns:
+        dict: The summary of the statistics.
+    """
+    matcher = OfflineMatcher(
+        Store(),
+        Store(),
+        stats=MatchStats(prefix_depth=prefix_depth),
+        report_file=report_file,
+        match_window=match_window,
+    )
+    amqp_messages = (m + (matcher.amqp_store,) for m in read_log(amqp_log))
+    zmq_messages = (m + (matcher.zmq_store,) for m in read_log(zmq_log))
+    messages = heapq.merge(amqp_messages, zmq_messages, key=lambda m: m[0])
+
+    next_check = float("-inf")
+    for received, msg_id, topic, store in messages:
+        # Don't let a message out of order move the clock back
+        matcher.now = max(matcher.now, received)
+        if matcher.now >= next_check:
+            matcher.check_missing()
+            next_check = matcher.now + CHECK_INTERVAL
+        matcher.received(store, msg_id, Record(topic, received))
+
+    matcher.now = float("inf")
+    matcher.check_missing()
+    return matcher.report()
@@ -0,0 +1,420 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Replay of recorded messages, to load test the bridges or to backfill.
+
+Messages are read from message logs (see :mod:`fedmsg_migration_tools.offline`),
+such as the captures written by the ``capture`` command or exported fedmsg
+messages, and published in order, either to ZeroMQ in the fedmsg format, or to
+AMQP through the same conversion as the ZeroMQ to AMQP bridge.
+
+The pace is set by the recorded reception times: a speed of 1 replays the
+messages in real time, a speed of N replays them N times faster, and a speed of
+0 replays them as fast as possible.
+
+Publishing can be spread over several threads. Messages are sharded by topic,
+so the messages on a given topic are still published in order. For ZeroMQ, the
+publisher sockets connect to an in-process XSUB socket, proxied to an XPUB
+socket bound to the publication endpoint, so subscribers only have one endpoint
+to connect to. As with any PUB socket, messages subscribers can't keep up with
+are dropped once the high water mark is reached.
+"""
+
+import abc
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+
+import zmq
+
+from fedmsg_migration_tools import bridges, capture, offline
+
+
+_log = logging.getLogger(__name__)
+
+#: The username set on the messages recorded from AMQP, once wrapped for fedmsg.
+REPLAY_USERNAME = "fedmsg-migration-tools-replay"
+
+#: The in-process endpoint the ZeroMQ publishers connect to.
+PROXY_ENDPOINT = "inproc://fedmsg-migration-tools-replay"
+
+
+def to_fedmsg(entry):
+    """
+    Convert a message log entry to a fedmsg message.
+
+    Entries recorded from ZeroMQ already hold the fedmsg message in their
+    ``body``. Entries recorded from AMQP, which have ``headers``, are wrapped
+    in the fedmsg format. Other entries are expected to be fedmsg messages.
+
+    Args:
+        entry (dict): The message log entry.
+
+    Returns:
+        tuple: The reception time of the message, in seconds since the epoch,
+            its topic, and the fedmsg message as a dictionary.
+
+    Raises:
+        KeyError: If the entry lacks a required key.
+        TypeError: If the entry is not a dictionary.
+        ValueError: If the reception time is not a number.
+    """
+    if "body" not in entry:
+        return float(entry["timestamp"]), entry["topic"], entry
+    received = float(entry["received"])
+    if "headers" not in entry:
+        return received, entry["topic"], entry["body"]
+    message = {
+        "topic": entry["topic"],
+        "msg": entry["body"],
+        "timestamp": int(received),
+        "msg_id": entry["msg_id"],
+        "headers": entry["headers"],
+        "username": REPLAY_USERNAME,
+    }
+    return received, entry["topic"], message
+
+
+def _read_entries(path, start, end):
+    with offline.open_log(path) as fd:
+        for lineno, line in enumerate(fd, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+                received = float(entry.get("received", entry.get("timestamp")))
+            except (ValueError, TypeError, AttributeError) as e:
+                _log.warning("Skipping line %d of %s: %r", lineno, path, e)
+                continue
+            if start <= received < end:
+                yield entry
+
+
+def read_messages(path, start=None, end=None):
+    """
+    Read the messages to replay, in the order they were recorded.
+
+    The indexes of captures are used to only read the blocks covering the
+    requested time range.
+
+    Args:
+        path (str): A message log, or a directory of message logs.
+        start (float): Skip the messages received before this time, in seconds
+            since the epoch.
+        end (float): Stop at the messages received at or after this time, in
+            seconds since the epoch.
+
+    Yields:
+        tuple: The reception time, topic and fedmsg message, as returned by
+            :func:`to_fedmsg`.
+    """
+    ranged = start is not None or end is not None
+    start = float("-inf") if start is None else start
+    end = float("inf") if end is None else end
+    for log_path in offline.list_logs(path):
+        if ranged and os.path.exists(capture.index_path(log_path)):
+            entries = capture.read_range(log_path, start, end)
+        else:
+            entries = _read_entries(log_path, start, end)
+        for entry in entries:
+            try:
+                yield to_fedmsg(entry)
+            except (ValueError, TypeError, KeyError) as e:
+                _log.warning("Skipping an invalid message in %s: %r", log_path, e)
+
+
+class PublishError(Exception):
+    """Raised by :meth:`Publisher.publish` when a message wasn't published."""
+
+
+class Publisher(threading.Thread, metaclass=abc.ABCMeta):
+    """
+    A thread publishing the messages put in its queue.
+
+    Subclasses implement :meth:`publish`, and optionally :meth:`setup` and
+    :meth:`teardown`, which are all called from the thread. The messages whose
+    publication raises an exception are counted as failed.
+
+    Args:
+        queue_size (int): The maximum number of messages waiting in the queue.
+    """
+
+    def __init__(self, queue_size=10000):
+        super(Publisher, self).__init__()
+        self.queue = queue.Queue(queue_size)
+        self.published = 0
+        self.failed = 0
+
+    def setup(self):
+        """Prepare for publishing."""
+
+    @abc.abstractmethod
+    def publish(self, topic, body):
+        """
+        Publish a message.
+
+        Args:
+            topic (bytes): The message topic.
+            body (bytes): The fedmsg message, serialized to JSON.
+
+        Raises:
+            Exception: If the message wasn't published.
+        """
+
+    def teardown(self):
+        """Clean up once all the messages have been published."""
+
+    def run(self):
+        self.setup()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                try:
+                    self.publish(*item)
+                except Exception as e:
+                    _log.error("Failed to publish a message on %r: %r", item[0], e)
+                    self.failed += 1
+                else:
+                    self.published += 1
+        finally:
+            self.teardown()
+
+
+class ZmqPublisher(Publisher):
+    """
+    Publish messages to the :class:`ZmqProxy`.
+
+    Args:
+        context (zmq.Context): The ZeroMQ context the proxy uses.
+        queue_size (int): The maximum number of messages waiting in the queue.
+    """
+
+    def __init__(self, context, queue_size=10000):
+        super(ZmqPublisher, self).__init__(queue_size)
+        self.context = context
+        self._socket = None
+
+    def setup(self):
+        self._socket = self.context.socket(zmq.PUB)
+        self._socket.connect(PROXY_ENDPOINT)
+
+    def publish(self, topic, body):
+        self._socket.send_multipart([topic, body])
+
+    def teardown(self):
+        self._socket.close()
+
+
+class AmqpPublisher(Publisher):
+    """
+    Publish messages to AMQP, converting them as the ZeroMQ to AMQP bridge does.
+
+    Args:
+        exchange (str): The AMQP exchange to publish to.
+        queue_size (int): The maximum number of messages waiting in the queue.
+    """
+
+    def __init__(self, exchange, queue_size=10000):
+        super(AmqpPublisher, self).__init__(queue_size)
+        self.runtime = bridges.RuntimeConfig.from_config(exchange)
+
+    def publish(self, topic, body):
+        published = bridges._convert_and_maybe_publish(topic, body, self.runtime)
+        if published is None:
+            raise PublishError("the message was dropped by the conversion")
+        if not published:
+            raise PublishError("the message could not be published to AMQP")
+
+
+class ZmqProxy(threading.Thread):
+    """
+    Forward the messages of the :class:`ZmqPublisher` threads to an endpoint.
+
+    Args:
+        context (zmq.Context): The ZeroMQ context to use.
+        endpoint (str): The endpoint to bind the XPUB socket to.
+    """
+
+    #: How long to wait for the queued messages to be sent when stopping, in ms.
+    LINGER = 5000
+
+    #: How long to keep forwarding messages when stopping, in seconds, so the
+    #: ones the publishers have just sent make it through the proxy.
+    DRAIN_DELAY = 0.5
+
+    def __init__(self, context, endpoint):
+        super(ZmqProxy, self).__init__(name="ZmqProxy", daemon=True)
+        self.context = context
+        self._xsub = context.socket(zmq.XSUB)
+        self._xsub.bind(PROXY_ENDPOINT)
+        self._xpub = context.socket(zmq.XPUB)
+        self._xpub.bind(endpoint)
+        _log.info("Bound to %s for ZeroMQ publication", endpoint)
+        control_endpoint = PROXY_ENDPOINT + "-control"
+        self._control = context.socket(zmq.PAIR)
+        self._control.bind(control_endpoint)
+        self._control_peer = context.socket(zmq.PAIR)
+        self._control_peer.connect(control_endpoint)
+
+    def run(self):
+        try:
+            zmq.proxy_steerable(self._xsub, self._xpub, None, self._control_peer)
+        finally:
+            self._xsub.close()
+            self._xpub.close(linger=self.LINGER)
+            self._control_peer.close()
+
+    def stop(self):
+        """Stop forwarding messages and close the sockets."""
+        time.sleep(self.DRAIN_DELAY)
+        self._control.send(b"TERMINATE")
+        self.join()
+        self._control.close()
+
+
+def replay(messages, publishers, speed=1):
+    """
+    Hand messages to the publishers at the pace they were recorded at.
+
+    Once all the messages have been handed out, the publishers are stopped.
+
+    Args:
+        messages (iterable): The reception time, topic and fedmsg message of
+            the messages to replay, as returned by :func:`read_messages`.
+        publishers (list): The started :class:`Publisher` threads.
+        speed (float): How many times faster than real time to replay the
+            messages, or 0 to replay them as fast as possible.
+
+    Returns:
+        dict: A summary of the replay: the number of messages ``published``
+            and ``failed``, the ``duration`` of the replay and the ``span`` of
+            recorded time it covered, in seconds, the achieved ``rate`` in
+            messages per second, and the maximum ``lag`` behind the requested
+            pace, in seconds.
+    """
+    started = time.monotonic()
+    first = last = None
+    lag = 0
+    try:
+        for received, topic, message in messages:
+            if first is None:
+                first = received
+            last = received
+            if speed:
+                delay = started + (received - first) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+            topic = topic.encode("utf-8")
+            body = json.dumps(message).encode("utf-8")
+            publishers[zlib.crc32(topic) % len(publishers)].queue.put((topic, body))
+    finally:
+        for publisher in publishers:
+            publisher.queue.put(None)
+        for publisher in publishers:
+            publisher.join()
+    duration = time.monotonic() - started
+    published = sum(publisher.published for publisher in publishers)
+    return {
+        "published": published,
+        "failed": sum(publisher.failed for publisher in publishers),
+        "duration": duration,
+        "span": 0 if first is None else last - first,
+        "rate": published / duration if duration else 0,
+        "lag": lag,
+    }
+
+
+def format_summary(summary):
+    """
+    Format a replay summary for humans.
+
+    Args:
+        summary (dict): A summary, as returned by :func:`replay`.
+
+    Returns:
+        str: A one-line description of the replay.
+    """
+    text = (
+        "Replayed {published} messages ({failed} failed) spanning {span:.1f}s "
+        "in {duration:.1f}s: {rate:.0f} messages/s"
+    ).format(**summary)
+    if summary["duration"] and summary["span"]:
+        text += " ({:.1f}x real time)".format(summary["span"] / summary["duration"])
+    if summary["lag"]:
+        text += ", up to {:.3f}s behind".format(summary["lag"])
+    return text
+
+
+def main(
+    path,
+    destination="zmq",
+    publish_endpoint=None,
+    exchange=None,
+    speed=1,
+    publishers=1,
+    start=None,
+    end=None,
+    queue_size=10000,
+    subscriber_delay=1,
+):
+    """
+    Replay recorded messages to ZeroMQ or AMQP.
+
+    Args:
+        path (str): A message log, or a directory of message logs.
+        destination (str): Where to publish the messages, ``zmq`` or ``amqp``.
+        publish_endpoint (str): The ZeroMQ endpoint to bind to.
+        exchange (str): The AMQP exchange to publish to.
+        speed (float): How many times faster than real time to replay the
+            messages, or 0 to replay them as fast as possible.
+        publishers (int): The number of publisher threads.
+        start (float): Skip the messages received before this time.
+        end (float): Stop at the messages received at or after this time.
+        queue_size (int): The maximum number of messages waiting to be
+            published, per publisher.
+        subscriber_delay (float): How long to wait for ZeroMQ subscribers to
+            connect before publishing, in seconds.
+
+    Returns:
+        dict: The replay summary, see :func:`replay`.
+    """
+    proxy = None
+    if destination == "zmq":
+        context = zmq.Context.instance()
+        proxy = ZmqProxy(context, publish_endpoint)
+        proxy.start()
+        threads = [ZmqPublisher(context, queue_size) for __ in range(publishers)]
+    else:
+        threads = [AmqpPublisher(exchange, queue_size) for __ in range(publishers)]
+    for thread in threads:
+        thread.start()
+    if proxy is not None and subscriber_delay:
+        time.sleep(subscriber_delay)
+    try:
+        return replay(read_messages(path, start, end), threads, speed)
+    finally:
+        if proxy is not None:
+            proxy.stop()
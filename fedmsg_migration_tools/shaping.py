@@ -0,0 +1,355 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Token bucket traffic shaping, to protect the AMQP broker from bursts.
+
+A :class:`Shaper` sends the messages of each topic prefix through the
+:class:`TokenBucket` of that prefix, if any, and then through a global one.
+Messages going over the rate of a bucket wait in its bounded buffer until it
+has tokens again, or are dropped, depending on its overflow policy. Nothing
+sleeps: the caller hands the messages to :meth:`Shaper.submit` and calls
+:meth:`Shaper.run_pending` regularly to release the ones that waited.
+"""
+
+from collections import deque
+import logging
+import time
+
+from fedmsg_migration_tools.metrics import Histogram
+
+
+_log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    A token bucket, with a bounded buffer for the messages over its rate.
+
+    Args:
+        name (str): The name of the bucket, in the logs and statistics.
+        rate (float): How many messages can go through per second, on average.
+        burst (int): How many messages can go through at once, after the bucket
+            has been idle. Defaults to the rate.
+        buffer (int): How many messages can wait for a token.
+        overflow (str): What to do with the messages over the rate: ``delay``
+            them in the buffer, and drop them when it is full, or ``drop`` them
+            right away.
+        clock (callable): The monotonic clock to use.
+
+    Raises:
+        ValueError: If the rate isn't positive, or the overflow policy is unknown.
+    """
+
+    OVERFLOW_POLICIES = ("delay", "drop")
+
+    def __init__(
+        self,
+        name,
+        rate,
+        burst=None,
+        buffer=1000,
+        overflow="delay",
+        clock=time.monotonic,
+    ):
+        if rate <= 0:
+            raise ValueError("The rate of the {} bucket must be positive".format(name))
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(
+                "The overflow policy of the {} bucket must be one of {}, not {}".format(
+                    name, ", ".join(self.OVERFLOW_POLICIES), overflow
+                )
+            )
+        self.name = name
+        self.rate = float(rate)
+        self.burst = max(1, burst or int(rate))
+        self.buffer = buffer
+        self.overflow = overflow
+        self.tokens = float(self.burst)
+        self.waiting = deque()
+        self._clock = clock
+        self._updated = clock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Forget the statistics counted so far and start a new period."""
+        self.passed = 0
+        self.delayed = 0
+        self.dropped = 0
+        self.max_waiting = len(self.waiting)
+        self.delays = Histogram()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return now
+
+    def offer(self, item):
+        """
+        Let a message through if the bucket has a token for it.
+
+        Messages never overtake the ones already waiting in the buffer.
+
+        Args:
+            item: The message.
+
+        Returns:
+            bool: Whether the message can go through now. If not, it was either
+                buffered, to be returned by :meth:`release` later, or dropped.
+        """
+        now = self._refill()
+        if not self.waiting and self.tokens >= 1:
+            self.tokens -= 1
+            self.passed += 1
+            return True
+        if self.overflow == "drop" or len(self.waiting) >= self.buffer:
+            self.dropped += 1
+            return False
+        self.waiting.append((now, item))
+        self.max_waiting = max(self.max_waiting, len(self.waiting))
+        return False
+
+    def release(self):
+        """
+        Take the buffered messages the bucket now has tokens for.
+
+        Returns:
+            list: The messages, oldest first.
+        """
+        if not self.waiting:
+            return []
+        now = self._refill()
+        released = []
+        while self.waiting and self.tokens >= 1:
+            self.tokens -= 1
+            buffered, item = self.waiting.popleft()
+            self.delays.add(now - buffered)
+            self.delayed += 1
+            released.append(item)
+        return released
+
+    def next_release(self):
+        """
+        Returns:
+            float: How long until the next buffered message can be released, in
+                seconds, or ``None`` if no message is waiting.
+        """
+        if not self.waiting:
+            return None
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def stats(self):
+        """
+        Returns:
+            dict: The messages that went through right away, after waiting in
+                the buffer, or were dropped, the size of the buffer, and the
+                distribution of the delays, since the statistics were reset.
+        """
+        return {
+            "passed": self.passed,
+            "delayed": self.delayed,
+            "dropped": self.dropped,
+            "waiting": len(self.waiting),
+            "max_waiting": self.max_waiting,
+            "delay": self.delays.summary(),
+        }
+
+
+class Shaper(object):
+    """
+    Shape the traffic per topic prefix, and globally.
+
+    Each message goes through the bucket of the longest prefix of its topic, if
+    any, and then through the global bucket, if any, before being published.
+
+    Args:
+        publish (callable): Called with each message that went through.
+        buckets (dict): The :class:`TokenBucket` of each topic prefix, as bytes.
+        global_bucket (TokenBucket): The bucket all the messages go through.
+        report_interval (float): How often to log the statistics of the
+            buckets, in seconds. 0 disables the reports.
+        clock (callable): The monotonic clock to use.
+    """
+
+    def __init__(
+        self,
+        publish,
+        buckets=None,
+        global_bucket=None,
+        report_interval=60,
+        clock=time.monotonic,
+    ):
+        self.publish = publish
+        self.buckets = buckets or {}
+        self.global_bucket = global_bucket
+        self.report_interval = report_interval
+        self._prefixes = sorted(self.buckets, key=len, reverse=True)
+        self._clock = clock
+        self._next_report = clock() + report_interval
+
+    @classmethod
+    def from_config(cls, publish, settings, clock=time.monotonic):
+        """
+        Build a shaper from the ``shaping`` settings of a bridge.
+
+        Args:
+            publish (callable): Called with each message that went through.
+            settings (dict): The global ``rate``, ``burst``, ``buffer`` and
+                ``overflow``, the ``report_interval``, and the same settings
+                for each topic prefix in ``prefixes``, where the global ones
+                are the defaults.
+            clock (callable): The monotonic clock to use.
+
+        Returns:
+            Shaper: The shaper, or ``None`` if no rate is set.
+
+        Raises:
+            ValueError: If the settings of a bucket are invalid.
+        """
+
+        def bucket(name, bucket_settings):
+            return TokenBucket(
+                name,
+                bucket_settings["rate"],
+                burst=bucket_settings.get("burst", settings["burst"]),
+                buffer=bucket_settings.get("buffer", settings["buffer"]),
+                overflow=bucket_settings.get("overflow", settings["overflow"]),
+                clock=clock,
+            )
+
+        buckets = {
+            prefix.encode("utf-8"): bucket(prefix, prefix_settings)
+            for prefix, prefix_settings in settings["prefixes"].items()
+        }
+        global_bucket = bucket("global", settings) if settings["rate"] else None
+        if not buckets and global_bucket is None:
+            return None
+        return cls(
+            publish,
+            buckets=buckets,
+            global_bucket=global_bucket,
+            report_interval=settings["report_interval"],
+            clock=clock,
+        )
+
+    def bucket_for(self, topic):
+        """
+        Args:
+            topic (bytes): The topic of a message.
+
+        Returns:
+            TokenBucket: The bucket of the longest prefix of the topic, or
+                ``None``.
+        """
+        for prefix in self._prefixes:
+            if topic.startswith(prefix):
+                return self.buckets[prefix]
+        return None
+
+    def submit(self, topic, item):
+        """
+        Publish a message, unless it goes over the rate of a bucket.
+
+        Args:
+            topic (bytes): The topic of the message.
+            item: The message, as passed to the ``publish`` callable.
+        """
+        bucket = self.bucket_for(topic)
+        if bucket is not None and not bucket.offer(item):
+            return
+        self._submit_global(item)
+
+    def _submit_global(self, item):
+        if self.global_bucket is not None and not self.global_bucket.offer(item):
+            return
+        self.publish(item)
+
+    def run_pending(self):
+        """
+        Publish the buffered messages the buckets now have tokens for, and log
+        the statistics when they are due.
+
+        Returns:
+            float: How long until the next buffered message can be released,
+                in seconds, or ``None`` if no message is waiting.
+        """
+        for bucket in self.buckets.values():
+            for item in bucket.release():
+                self._submit_global(item)
+        if self.global_bucket is not None:
+            for item in self.global_bucket.release():
+                self.publish(item)
+        if self.report_interval and self._clock() >= self._next_report:
+            self.report()
+        releases = [
+            bucket.next_release() for bucket in self._all_buckets() if bucket.waiting
+        ]
+        return min(releases) if releases else None
+
+    def drain(self):
+        """
+        Take all the buffered messages out of the buckets, without publishing them.
+
+        Returns:
+            list: The messages, the ones waiting in the global bucket first, since
+                they already went through the bucket of their prefix.
+        """
+        buckets = list(self.buckets.values())
+        if self.global_bucket is not None:
+            buckets.insert(0, self.global_bucket)
+        items = []
+        for bucket in buckets:
+            items.extend(item for _, item in bucket.waiting)
+            bucket.waiting.clear()
+        return items
+
+    def __len__(self):
+        return sum(len(bucket.waiting) for bucket in self._all_buckets())
+
+    def _all_buckets(self):
+        buckets = list(self.buckets.values())
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+        return buckets
+
+    def stats(self):
+        """
+        Returns:
+            dict: The statistics of each bucket, by name.
+        """
+        return {bucket.name: bucket.stats() for bucket in self._all_buckets()}
+
+    def report(self):
+        """Log the statistics of the buckets and reset them."""
+        for bucket in self._all_buckets():
+            stats = bucket.stats()
+            level = logging.WARNING if stats["dropped"] else logging.INFO
+            _log.log(
+                level,
+                "Shaping on the %s bucket: %d passed, %d delayed (p99 %.3fs), "
+                "%d dropped, %d waiting (max %d)",
+                bucket.name,
+                stats["passed"],
+                stats["delayed"],
+                stats["delay"].get("p99", 0.0),
+                stats["dropped"],
+                stats["waiting"],
+                stats["max_waiting"],
+            )
+            bucket.reset_stats()
+        self._next_report = self._clock() + self.report_interval
@@ -0,0 +1,126 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Spill files, for the messages a bridge couldn't publish before it stopped.
+
+A spill file is a message log (see :mod:`fedmsg_migration_tools.offline`), with
+one JSON object per line holding the ``received`` time, ``topic``, ``msg_id``
+and ``body`` of a ZeroMQ message. The bridge publishes the messages of its
+spill file when it starts again, and the file can also be given to the
+``replay`` command.
+"""
+
+import json
+import logging
+import os
+import time
+
+from fedmsg_migration_tools.capture import format_entry
+
+
+_log = logging.getLogger(__name__)
+
+
+def write(path, messages):
+    """
+    Append messages to a spill file, and sync it to the disk.
+
+    Args:
+        path (str): The path of the spill file.
+        messages (list): The ``(topic, body)`` of the ZeroMQ messages, as bytes.
+
+    Returns:
+        int: How many messages were written. The invalid ones are logged and
+            left out.
+
+    Raises:
+        IOError: If the file can't be written.
+    """
+    received = time.time()
+    written = 0
+    with open(path, "a", encoding="utf-8") as fd:
+        for topic, body in messages:
+            try:
+                body = body.decode("utf-8")
+                msg_id = json.loads(body)["msg_id"]
+                topic = topic.decode("utf-8")
+            except (ValueError, TypeError, KeyError) as e:
+                _log.error("Not spilling an invalid ZeroMQ message: %r", e)
+                continue
+            fd.write(format_entry(received, topic, msg_id, body) + "\n")
+            written += 1
+        fd.flush()
+        os.fsync(fd.fileno())
+    return written
+
+
+def read(path):
+    """
+    Read the messages of a spill file.
+
+    Args:
+        path (str): The path of the spill file.
+
+    Returns:
+        list: The ``(topic, body)`` of the messages, as bytes, or an empty list
+            if there is no spill file. Invalid lines are logged and skipped.
+
+    Raises:
+        IOError: If the file exists but can't be read.
+    """
+    if not os.path.exists(path):
+        return []
+    messages = []
+    with open(path, encoding="utf-8") as fd:
+        for lineno, line in enumerate(fd, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+                messages.append(
+                    (
+                        entry["topic"].encode("utf-8"),
+                        json.dumps(entry["body"]).encode("utf-8"),
+                    )
+                )
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                _log.warning("Skipping line %d of %s: %r", lineno, path, e)
+    return messages
+
+
+def replace(path, messages):
+    """
+    Atomically replace the messages of a spill file, or remove it if there are
+    none left.
+
+    Args:
+        path (str): The path of the spill file.
+        messages (list): The ``(topic, body)`` of the messages to keep.
+
+    Raises:
+        IOError: If the file can't be written or removed.
+    """
+    if not messages:
+        if os.path.exists(path):
+            os.unlink(path)
+        return
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    write(tmp_path, messages)
+    os.rename(tmp_path, path)
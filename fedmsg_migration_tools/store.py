@@ -0,0 +1,509 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Storage for the messages the verify_missing service is waiting to match."""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+
+class Record(object):
+    """
+    What is remembered about a message while waiting for it on the other side.
+
+    Only what is needed to report on the message is kept, rather than a copy of
+    the whole message: topics are interned so all records on a topic share the
+    same string.
+
+    Args:
+        topic (str): The message topic.
+        received (float): The :func:`time.monotonic` time the message was
+            received at. Defaults to now.
+        digest (bytes): An optional digest of the message body.
+    """
+
+    __slots__ = ("topic", "received", "digest")
+
+    def __init__(self, topic, received=None, digest=None):
+        self.topic = sys.intern(topic) if isinstance(topic, str) else topic
+        self.received = time.monotonic() if received is None else received
+        self.digest = digest
+
+    def __repr__(self):
+        return "Record(topic={!r}, received={!r}, digest={!r})".format(
+            self.topic, self.received, self.digest
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, Record):
+            return NotImplemented
+        return (self.topic, self.received, self.digest) == (
+            other.topic,
+            other.received,
+            other.digest,
+        )
+
+    def received_at(self):
+        """
+        Convert the monotonic reception time to the wall-clock time.
+
+        Returns:
+            datetime.datetime: The UTC time the message was received at.
+        """
+        return datetime.utcnow() - timedelta(seconds=time.monotonic() - self.received)
+
+
+class Store(OrderedDict):
+    """
+    The messages received on one side of the bridge, keyed by message ID.
+
+    Entries are kept in the order they were received. Since they are received
+    in chronological order, the oldest entries are always at the front, so
+    finding the expired ones never requires looking at the whole store.
+
+    Values are :class:`Record` instances.
+
+    The store can be bounded in number of entries and (approximately) in bytes.
+    When it grows beyond either limit, the oldest entries are moved out of
+    memory: they are either spilled to a :class:`SpillStore`, where they can
+    still be matched and expired, or only counted by topic in
+    :attr:`overflowed`. In the latter case they can't be matched anymore.
+
+    Args:
+        max_entries (int): The maximum number of entries kept in memory, or
+            ``None`` for no limit.
+        max_bytes (int): The approximate maximum size of the entries kept in
+            memory, or ``None`` for no limit.
+        spill (SpillStore): Where to move the entries that don't fit in memory.
+            If ``None``, they are only counted.
+    """
+
+    #: The approximate size of an entry, on top of its message ID.
+    ENTRY_OVERHEAD = 120
+
+    def __init__(self, max_entries=None, max_bytes=None, spill=None):
+        super(Store, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.size = 0
+        self.overflowed = {}
+
+    def __setitem__(self, msg_id, record):
+        self.add(msg_id, record)
+
+    def add(self, msg_id, record):
+        """
+        Add an entry, moving the oldest ones out of memory if the store goes
+        over its limits.
+
+        Args:
+            msg_id (str): The message ID.
+            record (Record): The record of the message.
+
+        Returns:
+            list: The IDs of the entries dropped to make room, which were only
+                counted by topic. Spilled entries are not dropped.
+        """
+        if not super(Store, self).__contains__(msg_id):
+            self.size += self._entry_size(msg_id)
+        super(Store, self).__setitem__(msg_id, record)
+        if self._over_limit(0):
+            return self._shrink()
+        return []
+
+    def __delitem__(self, msg_id):
+        try:
+            super(Store, self).__delitem__(msg_id)
+        except KeyError:
+            if not self.spill or self.spill.pop(msg_id) is None:
+                raise
+        else:
+            self.size -= self._entry_size(msg_id)
+
+    def __contains__(self, msg_id):
+        if super(Store, self).__contains__(msg_id):
+            return True
+        return bool(self.spill) and msg_id in self.spill
+
+    def pop(self, msg_id, *default):
+        """
+        Remove an entry, wherever it is, and return its record.
+
+        Args:
+            msg_id (str): The message ID.
+            default: The value to return if the entry does not exist. If not
+                provided, a :class:`KeyError` is raised instead.
+        """
+        try:
+            record = super(Store, self).pop(msg_id)
+        except KeyError:
+            record = self.spill.pop(msg_id) if self.spill else None
+            if record is None:
+                if default:
+                    return default[0]
+                raise
+        else:
+            self.size -= self._entry_size(msg_id)
+        return record
+
+    def popitem(self, last=True):
+        msg_id, record = super(Store, self).popitem(last=last)
+        self.size -= self._entry_size(msg_id)
+        return msg_id, record
+
+    def _entry_size(self, msg_id):
+        return sys.getsizeof(msg_id) + self.ENTRY_OVERHEAD
+
+    def _over_limit(self, margin):
+        if self.max_entries is not None and len(self) > self.max_entries * (1 - margin):
+            return True
+        return self.max_bytes is not None and self.size > self.max_bytes * (1 - margin)
+
+    def _shrink(self):
+        """
+        Move the oldest entries out of memory until the store is 1% below its
+        limits, so the cost of moving them is shared by many insertions.
+
+        Returns:
+            list: The IDs of the entries dropped, when there is no spill store.
+        """
+        evicted = []
+        while self and self._over_limit(0.01):
+            evicted.append(self.popitem(last=False))
+        if self.spill is not None:
+            self.spill.add(evicted)
+            return []
+        for __, record in evicted:
+            self.overflowed[record.topic] = self.overflowed.get(record.topic, 0) + 1
+        return [msg_id for msg_id, __ in evicted]
+
+    def expire(self, threshold):
+        """
+        Remove the entries received before a given time.
+
+        This only looks at the expired entries and the first one that is not.
+        Spilled entries, being older than the ones in memory, come first.
+
+        Args:
+            threshold (float): The :func:`time.monotonic` time before which
+                entries are expired.
+
+        Yields:
+            tuple: The ``(msg_id, record)`` of each expired entry, oldest first.
+        """
+        if self.spill:
+            for item in self.spill.expire(threshold):
+                yield item
+        while self:
+            msg_id = next(iter(self))
+            if not self[msg_id].received < threshold:
+                break
+            yield self.popitem(last=False)
+
+    def pop_overflowed(self):
+        """
+        Return and reset the number of entries that overflowed, by topic.
+
+        Returns:
+            dict: The number of entries that were dropped, keyed by topic.
+        """
+        overflowed, self.overflowed = self.overflowed, {}
+        return overflowed
+
+
+class SpillStore(object):
+    """
+    An SQLite database holding the entries that did not fit in a :class:`Store`.
+
+    The database is created on first use. Durability is not needed, since the
+    entries are only relevant to the running process, so the journal is off.
+    The table is recreated empty when the database is opened, so each store
+    needs its own file, and the file is locked for as long as the store is
+    open.
+
+    Args:
+        path (str): The path of the database file. Defaults to a temporary
+            file that is removed when the database is closed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or ""
+        self._db = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, msg_id):
+        if not self._count:
+            return False
+        cursor = self._connect().execute(
+            "SELECT 1 FROM spill WHERE msg_id = ?", (msg_id,)
+        )
+        return cursor.fetchone() is not None
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=0)
+            try:
+                # Hold the lock until closed, so another store can't wipe this one
+                db.execute("PRAGMA locking_mode = EXCLUSIVE")
+                db.execute("PRAGMA journal_mode = OFF")
+                db.execute("PRAGMA synchronous = OFF")
+                db.execute("DROP TABLE IF EXISTS spill")
+                db.execute(
+                    "CREATE TABLE spill (msg_id TEXT PRIMARY KEY, topic TEXT, "
+                    "received REAL, digest BLOB)"
+                )
+                db.execute("CREATE INDEX spill_received ON spill (received)")
+            except sqlite3.OperationalError as e:
+                db.close()
+                raise sqlite3.OperationalError(
+                    "Failed to open the spill database {}, is another store "
+                    "using it? {}".format(self.path, e)
+                )
+            self._db = db
+        return self._db
+
+    def add(self, items):
+        """
+        Add entries to the database.
+
+        Args:
+            items (list): A list of ``(msg_id, record)`` tuples.
+        """
+        db = self._connect()
+        rows = [
+            (record.topic, record.received, record.digest, msg_id)
+            for msg_id, record in items
+        ]
+        with db:
+            db.execute("BEGIN")
+            changes = db.total_changes
+            db.executemany(
+                "INSERT OR IGNORE INTO spill (topic, received, digest, msg_id) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            added = db.total_changes - changes
+            if added < len(rows):
+                # Some were already spilled, the last record of a message wins
+                db.executemany(
+                    "UPDATE spill SET topic = ?, received = ?, digest = ? "
+                    "WHERE msg_id = ?",
+                    rows,
+                )
+        self._count += added
+
+    def pop(self, msg_id):
+        """
+        Remove an entry from the database.
+
+        Args:
+            msg_id (str): The message ID.
+
+        Returns:
+            Record: The record of the entry, or ``None`` if it does not exist.
+        """
+        if not self._count:
+            return None
+        db = self._connect()
+        row = db.execute(
+            "SELECT topic, received, digest FROM spill WHERE msg_id = ?", (msg_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        db.execute("DELETE FROM spill WHERE msg_id = ?", (msg_id,))
+        self._count -= 1
+        return Record(*row)
+
+    def expire(self, threshold):
+        """
+        Remove the entries received before a given time.
+
+        Args:
+            threshold (float): The :func:`time.monotonic` time before which
+                entries are expired.
+
+        Returns:
+            list: The ``(msg_id, record)`` of each expired entry, oldest first.
+        """
+        if not self._count:
+            return []
+        db = self._connect()
+        rows = db.execute(
+            "SELECT msg_id, topic, received, digest FROM spill WHERE received < ? "
+            "ORDER BY received",
+            (threshold,),
+        ).fetchall()
+        db.execute("DELETE FROM spill WHERE received < ?", (threshold,))
+        self._count -= len(rows)
+        return [(row[0], Record(*row[1:])) for row in rows]
+
+    def close(self):
+        """Close the database."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            self._count = 0
+
+
+class StateLog(object):
+    """
+    An append-only log of the messages waiting to be matched, so they survive
+    restarts.
+
+    Each line is a JSON array: ``["+", side, msg_id, topic, received, digest]``
+    when a message starts waiting, with the wall-clock time it was received at
+    and its digest in hexadecimal, and ``["-", side, msg_id]`` when it stops.
+    Changes are buffered, and appended to the file by :meth:`flush`.
+
+    Since most messages are matched quickly, most of the log ends up being
+    additions cancelled by removals. Once the log is more than twice as long
+    as the number of messages waiting, it is compacted: rewritten with only
+    the messages still waiting.
+
+    Args:
+        path (str): The path of the log.
+        compact_min_lines (int): The length under which the log is never
+            compacted.
+    """
+
+    COMPACT_MIN_LINES = 50000
+
+    def __init__(self, path, compact_min_lines=COMPACT_MIN_LINES):
+        self.path = path
+        self.compact_min_lines = compact_min_lines
+        self._pending = []
+        self._lines = 0
+        self._live = 0
+        self._fd = None
+
+    def added(self, side, msg_id, topic, received, digest=None):
+        """
+        Log a message that started waiting to be matched.
+
+        Args:
+            side (str): The side of the bridge the message was received on.
+            msg_id (str): The message ID.
+            topic (str): The message topic.
+            received (float): The time the message was received at, in seconds
+                since the epoch.
+            digest (bytes): The digest of the message body, if any.
+        """
+        digest = digest.hex() if digest is not None else None
+        self._pending.append(json.dumps(["+", side, msg_id, topic, received, digest]))
+        self._live += 1
+
+    def removed(self, side, msg_id):
+        """
+        Log a message that stopped waiting, because it was matched or expired.
+
+        Args:
+            side (str): The side of the bridge the message was received on.
+            msg_id (str): The message ID.
+        """
+        self._pending.append(json.dumps(["-", side, msg_id]))
+        self._live = max(0, self._live - 1)
+
+    def flush(self):
+        """Append the buffered changes to the log, and compact it if needed."""
+        if self._pending:
+            if self._fd is None:
+                self._fd = open(self.path, "a")
+            self._fd.write("\n".join(self._pending) + "\n")
+            self._fd.flush()
+            self._lines += len(self._pending)
+            self._pending = []
+        if self._lines > self.compact_min_lines and self._lines > 2 * self._live:
+            self.compact()
+
+    def read(self):
+        """
+        Read the messages waiting according to the log.
+
+        A truncated last line, left by a crash, is ignored.
+
+        Returns:
+            collections.OrderedDict: The ``(topic, received, digest)`` of the
+                messages, keyed by ``(side, msg_id)``, in the order they were
+                received.
+        """
+        entries = OrderedDict()
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path) as fd:
+            for line in fd:
+                try:
+                    entry = json.loads(line)
+                    if entry[0] == "+":
+                        digest = bytes.fromhex(entry[5]) if entry[5] else None
+                        entries[(entry[1], entry[2])] = (entry[3], entry[4], digest)
+                    else:
+                        entries.pop((entry[1], entry[2]), None)
+                except (ValueError, TypeError, IndexError):
+                    continue
+        return entries
+
+    def compact(self, entries=None):
+        """
+        Rewrite the log with only the messages still waiting.
+
+        Args:
+            entries (collections.OrderedDict): The messages still waiting, as
+                returned by :meth:`read`. Defaults to reading them from the log.
+        """
+        self.close()
+        if entries is None:
+            entries = self.read()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as fd:
+                for (side, msg_id), (topic, received, digest) in entries.items():
+                    digest = digest.hex() if digest is not None else None
+                    fd.write(
+                        json.dumps(["+", side, msg_id, topic, received, digest]) + "\n"
+                    )
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self._lines = self._live = len(entries)
+
+    def load(self):
+        """
+        Read the messages waiting according to the log, and compact it.
+
+        Returns:
+            collections.OrderedDict: The messages, as returned by :meth:`read`.
+        """
+        entries = self.read()
+        self.compact(entries)
+        return entries
+
+    def close(self):
+        """Close the log file, without writing the buffered changes."""
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
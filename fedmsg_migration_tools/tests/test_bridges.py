@@ -18,12 +18,17 @@
 import datetime
 import unittest
 import json
+import operator
+import os
 import socket
+import tempfile
 
-from fedora_messaging import message, testing as fml_testing
+from fedora_messaging import exceptions, message, testing as fml_testing
 import mock
+import pika
+import zmq
 
-from fedmsg_migration_tools import bridges
+from fedmsg_migration_tools import bridges, config, notify, spill
 from fedmsg_migration_tools.tests import FIXTURES_DIR
 
 
@@ -31,32 +36,34 @@ from fedmsg_migration_tools.tests import FIXTURES_DIR
     "fedmsg_migration_tools.bridges.fedmsg_config.conf", {"validate_signatures": False}
 )
 class ConvertAndMaybePublishTests(unittest.TestCase):
+    def convert(self, topic, zmq_message):
+        runtime = bridges.RuntimeConfig.from_config(exchange="amq.topic")
+        bridges._convert_and_maybe_publish(topic, zmq_message, runtime)
+
     def test_msg_becomes_body(self):
         """Assert the "msg" key of a fedmsg is the fedora-messaging body."""
         expected = message.Message(body={"hello": "world"}, topic="hi")
         zmq_message = b'{"msg": {"hello": "world"}, "msg_id": "abc123"}'
 
         with fml_testing.mock_sends(expected):
-            bridges._convert_and_maybe_publish(b"hi", zmq_message, "amq.topic")
+            self.convert(b"hi", zmq_message)
 
     def test_no_msg(self):
         """Assert no message is published if there's no "msg" key."""
         with fml_testing.mock_sends():
-            bridges._convert_and_maybe_publish(
-                b"hi", b'{"username": "test", "msg_id": "abc"}', "amq.topic"
-            )
+            self.convert(b"hi", b'{"username": "test", "msg_id": "abc"}')
 
     def test_no_msg_id(self):
         """Assert no message is published if there's no "msg_id" key."""
         with fml_testing.mock_sends():
-            bridges._convert_and_maybe_publish(b"hi", b'{"msg": "test"}', "amq.topic")
+            self.convert(b"hi", b'{"msg": "test"}')
 
     def test_drop_bridge_messages(self):
         """Assert ZMQ messages with the amqp-bridge username are ignored."""
         zmq_message = b'{"username": "amqp-bridge", "msg": {"hello": "world"}, "msg_id": "abc123"}'
 
         with fml_testing.mock_sends():
-            bridges._convert_and_maybe_publish(b"hi", zmq_message, "amq.topic")
+            self.convert(b"hi", zmq_message)
 
     def test_blank_headers(self):
         """Assert ZMQ messages with blank headers still get the defaults."""
@@ -64,7 +71,7 @@ class ConvertAndMaybePublishTests(unittest.TestCase):
         zmq_message = b'{"headers": {}, "msg": {"hello": "world"}, "msg_id": "abc123"}'
 
         with fml_testing.mock_sends(expected):
-            bridges._convert_and_maybe_publish(b"hi", zmq_message, "amq.topic")
+            self.convert(b"hi", zmq_message)
 
     def test_headers(self):
         """Assert ZMQ messages with headers are included."""
@@ -76,15 +83,766 @@ class ConvertAndMaybePublishTests(unittest.TestCase):
         )
 
         with fml_testing.mock_sends(expected):
-            bridges._convert_and_maybe_publish(b"hi", zmq_message, "amq.topic")
+            self.convert(b"hi", zmq_message)
 
     def test_invalid_json(self):
         """Assert invalid json doesn't crash the maybe_publisher."""
         with fml_testing.mock_sends():
-            bridges._convert_and_maybe_publish(b"hi", "{", "amq.topic")
+            self.convert(b"hi", "{")
+
+    def test_validate_signatures(self):
+        """Assert messages failing validation are dropped."""
+        zmq_message = b'{"msg": {"hello": "world"}, "msg_id": "abc123"}'
+        with mock.patch.dict(
+            "fedmsg_migration_tools.bridges.fedmsg_config.conf",
+            {"validate_signatures": True},
+        ):
+            runtime = bridges.RuntimeConfig.from_config(exchange="amq.topic")
+        with mock.patch(
+            "fedmsg_migration_tools.bridges.fedmsg.crypto.validate", return_value=False
+        ) as validate:
+            with fml_testing.mock_sends():
+                bridges._convert_and_maybe_publish(b"hi", zmq_message, runtime)
+        self.assertIs(validate.call_args[1]["validate_signatures"], True)
+
+
+class RuntimeConfigTests(unittest.TestCase):
+    def test_immutable(self):
+        """Assert the runtime configuration can't be changed."""
+        runtime = bridges.RuntimeConfig.from_config(exchange="amq.topic")
+        self.assertRaises(AttributeError, setattr, runtime, "exchange", "other")
+        self.assertRaises(AttributeError, setattr, runtime, "other", "value")
+        self.assertRaises(TypeError, operator.setitem, runtime.crypto_config, "a", "b")
+
+    def test_topics(self):
+        """Assert the topics are encoded once."""
+        runtime = bridges.RuntimeConfig.from_config(topics=["a.topic", b"b.topic"])
+        self.assertEqual(runtime.topics, (b"a.topic", b"b.topic"))
+
+    def test_socket_options(self):
+        """Assert the options of the publication socket are read from consumer_config."""
+        consumer_config = {"publish_endpoint": "tcp://*:9940", "heartbeat_ivl": 100}
+        with mock.patch.dict(
+            "fedmsg_migration_tools.bridges.fm_config.conf",
+            {"consumer_config": consumer_config},
+        ):
+            runtime = bridges.RuntimeConfig.from_config()
+        self.assertEqual(runtime.socket_options, (("heartbeat_ivl", 100),))
+
+    def test_certname(self):
+        """Assert the certificate name is resolved without changing fedmsg's config."""
+        conf = {
+            "sign_messages": True,
+            "certname": None,
+            "name": "fedmsg",
+            "certnames": {"fedmsg": "fedmsg-cert"},
+        }
+        with mock.patch.dict("fedmsg_migration_tools.bridges.fedmsg_config.conf", conf):
+            runtime = bridges.RuntimeConfig.from_config()
+            self.assertIsNone(bridges.fedmsg_config.conf["certname"])
+        self.assertEqual(runtime.crypto_config["certname"], "fedmsg-cert")
+
+    def test_unknown_certname(self):
+        """Assert a missing certificate name fails at startup."""
+        conf = {"sign_messages": True, "certname": None, "name": "x", "certnames": {}}
+        with mock.patch.dict("fedmsg_migration_tools.bridges.fedmsg_config.conf", conf):
+            self.assertRaises(KeyError, bridges.RuntimeConfig.from_config)
+
+
+@mock.patch.dict(
+    "fedmsg_migration_tools.bridges.fedmsg_config.conf", {"validate_signatures": False}
+)
+class ZmqToAmqpTests(unittest.TestCase):
+    def setUp(self):
+        context = mock.patch("fedmsg_migration_tools.bridges.zmq.Context").start()
+        context.instance.return_value.socket.side_effect = lambda kind: mock.Mock()
+        poller = mock.patch("fedmsg_migration_tools.bridges.zmq.Poller").start()
+        self.poller = poller.return_value
+        self.addCleanup(mock.patch.stopall)
+
+    def bridge(self, *args, **kwargs):
+        bridge = bridges.ZmqToAmqp(*args, **kwargs)
+        bridge.connect()
+        return bridge
+
+    def poll(self, *rounds):
+        """Make each poll return the sockets of a round as ready, in turn."""
+        self.poller.poll.side_effect = [
+            [(sub, zmq.POLLIN) for sub in ready] if isinstance(ready, list) else ready
+            for ready in rounds
+        ]
+
+    def test_connect(self):
+        """Assert each endpoint gets its own sub, topics, options and monitor."""
+        bridge = self.bridge(
+            "ex",
+            [
+                "tcp://a:1",
+                {
+                    "endpoint": "tcp://b:1",
+                    "topics": ["b."],
+                    "rcvhwm": 10,
+                    "reconnect_ivl": 200,
+                    "heartbeat_ivl": 1000,
+                },
+            ],
+            ["a.", "c."],
+        )
+        a = bridge.sources["tcp://a:1"].socket
+        b = bridge.sources["tcp://b:1"].socket
+        self.assertEqual(
+            a.mock_calls,
+            [
+                mock.call.setsockopt(zmq.RCVHWM, 1000),
+                mock.call.get_monitor_socket(),
+                mock.call.connect("tcp://a:1"),
+                mock.call.setsockopt(zmq.SUBSCRIBE, b"a."),
+                mock.call.setsockopt(zmq.SUBSCRIBE, b"c."),
+            ],
+        )
+        self.assertEqual(
+            b.mock_calls,
+            [
+                mock.call.setsockopt(zmq.RCVHWM, 10),
+                mock.call.setsockopt(zmq.HEARTBEAT_IVL, 1000),
+                mock.call.setsockopt(zmq.RECONNECT_IVL, 200),
+                mock.call.get_monitor_socket(),
+                mock.call.connect("tcp://b:1"),
+                mock.call.setsockopt(zmq.SUBSCRIBE, b"b."),
+            ],
+        )
+        self.assertEqual(
+            self.poller.register.call_args_list,
+            [
+                mock.call(a, zmq.POLLIN),
+                mock.call(a.get_monitor_socket.return_value, zmq.POLLIN),
+                mock.call(b, zmq.POLLIN),
+                mock.call(b.get_monitor_socket.return_value, zmq.POLLIN),
+            ],
+        )
+        self.assertEqual(bridge.endpoints, ["tcp://a:1", "tcp://b:1"])
+
+    def test_invalid_weight(self):
+        """Assert endpoints must have a positive weight."""
+        self.assertRaises(
+            ValueError,
+            bridges.ZmqToAmqp,
+            "ex",
+            [{"endpoint": "tcp://a:1", "weight": 0}],
+            [""],
+        )
+
+    def test_reload(self):
+        """Assert only the differences are applied to the sockets, new ones first."""
+        reload = mock.Mock(
+            return_value=(
+                "new",
+                [
+                    {"endpoint": "tcp://b:1", "topics": ["c."], "weight": 2},
+                    "tcp://c:1",
+                    {"endpoint": "tcp://d:1", "rcvhwm": 10, "reconnect_ivl": 200},
+                ],
+                ["a."],
+            )
+        )
+        bridge = self.bridge(
+            "ex",
+            [
+                "tcp://a:1",
+                {"endpoint": "tcp://b:1", "topics": ["b."]},
+                {"endpoint": "tcp://d:1", "rcvhwm": 10},
+            ],
+            ["a."],
+            reload=reload,
+        )
+        a, b, d = (source.socket for source in bridge.sources.values())
+        for sub in (a, b, d):
+            sub.reset_mock()
+        d.recv_multipart.side_effect = zmq.Again()
+        self.poller.reset_mock()
+
+        bridge.reload()
+
+        c = bridge.sources["tcp://c:1"].socket
+        new_d = bridge.sources["tcp://d:1"].socket
+        self.assertEqual(
+            b.mock_calls,
+            [
+                mock.call.setsockopt(zmq.SUBSCRIBE, b"c."),
+                mock.call.setsockopt(zmq.UNSUBSCRIBE, b"b."),
+            ],
+        )
+        self.assertEqual(bridge.sources["tcp://b:1"].weight, 2)
+        self.assertIn(mock.call.connect("tcp://c:1"), c.mock_calls)
+        self.assertIn(mock.call.setsockopt(zmq.RECONNECT_IVL, 200), new_d.mock_calls)
+        d.close.assert_called_once_with(linger=0)
+        a.close.assert_called_once_with(linger=0)
+        a.get_monitor_socket.return_value.close.assert_called_once_with(linger=0)
+        self.assertEqual(
+            self.poller.mock_calls,
+            [
+                mock.call.register(c, zmq.POLLIN),
+                mock.call.register(c.get_monitor_socket.return_value, zmq.POLLIN),
+                mock.call.register(new_d, zmq.POLLIN),
+                mock.call.register(new_d.get_monitor_socket.return_value, zmq.POLLIN),
+                mock.call.unregister(d),
+                mock.call.unregister(d.get_monitor_socket.return_value),
+                mock.call.unregister(a),
+                mock.call.unregister(a.get_monitor_socket.return_value),
+            ],
+        )
+        self.assertEqual(bridge.endpoints, ["tcp://b:1", "tcp://c:1", "tcp://d:1"])
+        self.assertEqual(bridge.runtime.exchange, "new")
+
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_reload_options_drain(self, convert):
+        """Assert the messages queued by a socket are handled when it's replaced."""
+        bridge = self.bridge("ex", [{"endpoint": "tcp://a:1", "rcvhwm": 10}], ["a."])
+        sub = bridge.sources["tcp://a:1"].socket
+        messages = [[b"a.topic", b'{"msg_id": "0"}'], [b"a.topic", b'{"msg_id": "1"}']]
+        sub.recv_multipart.side_effect = messages + [zmq.Again()]
+
+        with self.assertLogs(bridges._log.name, "INFO"):
+            bridge.update(
+                bridge.runtime,
+                [bridges.Source("tcp://a:1", ["a."], rcvhwm=20)],
+            )
+
+        new_sub = bridge.sources["tcp://a:1"].socket
+        self.assertIsNot(new_sub, sub)
+        self.assertEqual(
+            [call[0][:2] for call in convert.call_args_list],
+            [tuple(message) for message in messages],
+        )
+        self.assertIn(mock.call.setsockopt(zmq.UNSUBSCRIBE, b"a."), sub.mock_calls)
+        sub.close.assert_called_once_with(linger=0)
+        self.assertIn(mock.call.connect("tcp://a:1"), new_sub.mock_calls)
+
+    def test_reload_failure(self):
+        """Assert the configuration is kept if it can't be reloaded."""
+        reload = mock.Mock(side_effect=ValueError("invalid"))
+        bridge = self.bridge("ex", ["tcp://a:1"], ["a."], reload=reload)
+        runtime = bridge.runtime
+        sub = bridge.sources["tcp://a:1"].socket
+        sub.reset_mock()
+
+        with self.assertLogs(bridges._log.name, "ERROR"):
+            bridge.reload()
+
+        self.assertIs(bridge.runtime, runtime)
+        self.assertEqual(bridge.endpoints, ["tcp://a:1"])
+        self.assertEqual(sub.mock_calls, [])
+
+    @mock.patch("fedmsg_migration_tools.bridges.signal.signal")
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_run(self, convert, signal):
+        """Assert a requested reload is applied between two messages."""
+        reload = mock.Mock(return_value=("new", ["tcp://a:1"], ["a."]))
+        bridge = self.bridge("ex", ["tcp://a:1"], ["a."], reload=reload)
+        sub = bridge.sources["tcp://a:1"].socket
+        runtimes = []
+
+        def on_message(topic, body, runtime):
+            runtimes.append(runtime.exchange)
+            if len(runtimes) == 1:
+                bridge.request_reload()
+            else:
+                raise KeyboardInterrupt()
+
+        convert.side_effect = on_message
+        self.poll([], [sub], [sub])
+        message = [b"a.topic", b"{}"]
+        sub.recv_multipart.side_effect = [message, zmq.Again(), message, zmq.Again()]
+
+        self.assertRaises(KeyboardInterrupt, bridge.run)
+
+        signal.assert_any_call(bridges.signal.SIGHUP, bridge.request_reload)
+        self.assertEqual(runtimes, ["ex", "new"])
+        reload.assert_called_once_with()
+        sub.recv_multipart.assert_called_with(zmq.NOBLOCK)
+
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_weighted(self, convert):
+        """Assert the endpoints with messages are served in turn, by weight."""
+        bridge = self.bridge(
+            "ex", ["tcp://a:1", {"endpoint": "tcp://b:1", "weight": 2}], [""]
+        )
+        bridge.QUANTUM = 1
+        a, b = (source.socket for source in bridge.sources.values())
+        a.recv_multipart.return_value = [b"topic", b"a"]
+        b.recv_multipart.return_value = [b"topic", b"b"]
+        self.poll([a, b], [a, b], KeyboardInterrupt())
+
+        self.assertRaises(KeyboardInterrupt, bridge.run)
+
+        bodies = [call[0][1] for call in convert.call_args_list]
+        self.assertEqual(bodies, [b"b", b"b", b"a", b"a", b"b", b"b"])
+        stats = bridge.stats()["endpoints"]
+        self.assertEqual(stats["tcp://a:1"]["received"], 2)
+        self.assertEqual(stats["tcp://b:1"]["received"], 4)
+        self.assertEqual(stats["tcp://b:1"]["bytes"], 4 * len(b"topicb"))
+
+    def test_malformed(self):
+        """Assert malformed messages are logged and counted as dropped."""
+        bridge = self.bridge("ex", ["tcp://a:1"], [""])
+        source = bridge.sources["tcp://a:1"]
+        source.socket.recv_multipart.side_effect = [[b"topic"], zmq.Again()]
+
+        with self.assertLogs(bridges._log.name, "ERROR"):
+            self.assertEqual(source.receive(10), [])
+
+        self.assertEqual(source.stats()["dropped"], 1)
+
+    @mock.patch("fedmsg_migration_tools.monitor.recv_monitor_message")
+    def test_monitor_events(self, recv_monitor_message):
+        """Assert the events of the monitors are handled when they are ready."""
+        bridge = self.bridge("ex", ["tcp://a:1"], [""])
+        source = bridge.sources["tcp://a:1"]
+        recv_monitor_message.side_effect = [
+            {"event": zmq.EVENT_CONNECTED, "endpoint": b"tcp://a:1"},
+            zmq.Again(),
+        ]
+
+        bridge._receive({source.monitor.socket: zmq.POLLIN})
+
+        recv_monitor_message.assert_called_with(source.monitor.socket, zmq.NOBLOCK)
+        source.socket.recv_multipart.assert_not_called()
+        self.assertTrue(bridge.stats()["endpoints"]["tcp://a:1"]["connected"])
+
+    def test_stall(self):
+        """Assert endpoints silent for longer than their stall timeout are logged."""
+        bridge = self.bridge(
+            "ex", [{"endpoint": "tcp://a:1", "stall_timeout": 10}], [""]
+        )
+        source = bridge.sources["tcp://a:1"]
+        source.check_stall()
+        self.assertFalse(source.stalled)
+
+        source.last_received -= 11
+        with self.assertLogs(bridges._log.name, "WARNING") as logs:
+            source.check_stall()
+        self.assertIn("No message received from tcp://a:1", logs.output[0])
+        self.assertTrue(source.stats()["stalled"])
+        self.assertGreaterEqual(source.stats()["silence"], 11)
+
+        source.socket.recv_multipart.side_effect = [[b"topic", b"{}"], zmq.Again()]
+        source.receive(10)
+        with self.assertLogs(bridges._log.name, "INFO"):
+            source.check_stall()
+        self.assertFalse(source.stalled)
+
+    def test_report(self):
+        """Assert the statistics are logged, written, and reset."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            report_file = os.path.join(tmpdir, "report.json")
+            bridge = self.bridge("ex", ["tcp://a:1"], [""], report_file=report_file)
+            source = bridge.sources["tcp://a:1"]
+            source.dropped = 3
+            with self.assertLogs(bridges._log.name, "WARNING") as logs:
+                bridge.report()
+            with open(report_file) as fd:
+                report = json.load(fd)
+        self.assertIn("from tcp://a:1, 3 dropped", logs.output[0])
+        self.assertEqual(report["endpoints"]["tcp://a:1"]["dropped"], 3)
+        self.assertEqual(source.dropped, 0)
+
+    def test_recommend(self):
+        """Assert the settings holding the bursts are recommended, not applied."""
+        bridge = self.bridge("ex", [{"endpoint": "tcp://a:1", "rcvhwm": 10}], [""])
+        source = bridge.sources["tcp://a:1"]
+        source.socket.recv_multipart.return_value = [b"topic", b"{}"]
+        source.receive(10)
+
+        with self.assertLogs(bridges._log.name, "WARNING") as logs:
+            bridge.report()
+
+        self.assertIn("tcp://a:1: rcvhwm = 32", logs.output[-1])
+        self.assertIs(bridge.sources["tcp://a:1"], source)
+
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_auto_tune(self, convert):
+        """Assert the endpoints are reconnected with the recommended settings."""
+        tuning = dict(config.DEFAULTS["zmq_to_amqp"]["tuning"], auto=True)
+        bridge = self.bridge(
+            "ex",
+            [{"endpoint": "tcp://a:1", "rcvhwm": 10, "weight": 2}],
+            [""],
+            tuning=tuning,
+        )
+        source = bridge.sources["tcp://a:1"]
+        source.monitor.handle_event(zmq.EVENT_CONNECTED, b"tcp://a:1")
+        sub = source.socket
+        sub.recv_multipart.side_effect = [[b"topic", b"{}"]] * 5 + [zmq.Again()]
+        source.receive(10)
+        self.poller.reset_mock()
+        queued = [b"topic", b'{"msg_id": "queued"}']
+        sub.recv_multipart.side_effect = [queued, zmq.Again()]
+
+        with self.assertLogs(bridges._log.name, "INFO"):
+            bridge.report()
+            bridge.check()
+
+        self.assertIs(bridge.sources["tcp://a:1"], source)
+        self.assertEqual(source.tuned["rcvhwm"], 16)
+        sub.close.assert_not_called()
+
+        with self.assertLogs(bridges._log.name, "INFO"):
+            source.monitor.handle_event(zmq.EVENT_DISCONNECTED, b"tcp://a:1")
+            bridge.check()
+
+        tuned = bridge.sources["tcp://a:1"]
+        self.assertIsNot(tuned, source)
+        self.assertEqual(tuned.rcvhwm, 16)
+        self.assertEqual(tuned.weight, 2)
+        self.assertIsNone(tuned.rcvbuf)
+        self.assertIs(tuned.profile, source.profile)
+        self.assertIn(mock.call.setsockopt(zmq.RCVHWM, 16), tuned.socket.mock_calls)
+        sub.close.assert_called_once_with(linger=0)
+        convert.assert_called_once_with(b"topic", queued[1], bridge.runtime)
+        self.assertEqual(
+            self.poller.register.call_args_list[0], mock.call(tuned.socket, zmq.POLLIN)
+        )
+
+        with mock.patch.object(bridges._log, "log") as log:
+            bridge.report()
+        log.assert_called_once()
+
+    def test_auto_tune_stalled(self):
+        """Assert stalled endpoints are reconnected with the recommended settings."""
+        tuning = dict(config.DEFAULTS["zmq_to_amqp"]["tuning"], auto=True)
+        bridge = self.bridge(
+            "ex",
+            [{"endpoint": "tcp://a:1", "rcvhwm": 10, "stall_timeout": 30}],
+            [""],
+            tuning=tuning,
+        )
+        source = bridge.sources["tcp://a:1"]
+        source.monitor.handle_event(zmq.EVENT_CONNECTED, b"tcp://a:1")
+        source.socket.recv_multipart.side_effect = zmq.Again()
+        source.tuned = {"rcvhwm": 16, "rcvbuf": 0, "saturated": False, "grow": True}
+
+        bridge.check()
+        self.assertIs(bridge.sources["tcp://a:1"], source)
+
+        source.last_received -= 31
+        with self.assertLogs(bridges._log.name, "WARNING"):
+            bridge.check()
+
+        tuned = bridge.sources["tcp://a:1"]
+        self.assertIsNot(tuned, source)
+        self.assertEqual(tuned.rcvhwm, 16)
+        self.assertIsNone(tuned.tuned)
+
+    def test_auto_tune_reload(self):
+        """Assert a reload reconnecting an endpoint applies its recommended settings."""
+        bridge = self.bridge("ex", [{"endpoint": "tcp://a:1", "rcvhwm": 10}], [""])
+        source = bridge.sources["tcp://a:1"]
+        source.socket.recv_multipart.side_effect = zmq.Again()
+        source.tuned = {"rcvhwm": 16, "rcvbuf": 0, "saturated": False, "grow": True}
+
+        bridge.update(
+            bridge.runtime,
+            [
+                bridges.Source(
+                    "tcp://a:1", [""], rcvhwm=12, options=(("reconnect_ivl", 500),)
+                )
+            ],
+        )
+
+        tuned = bridge.sources["tcp://a:1"]
+        self.assertEqual(tuned.rcvhwm, 16)
+        self.assertEqual(tuned.options, (("reconnect_ivl", 500),))
+
+    @mock.patch("fedmsg_migration_tools.bridges.signal.signal", mock.Mock())
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_stop(self, convert):
+        """Assert the bridge drains and returns once a stop is requested."""
+        bridge = self.bridge("ex", ["tcp://a:1"], ["a."])
+        sub = bridge.sources["tcp://a:1"].socket
+        message = [b"a.topic", b"{}"]
+        sub.recv_multipart.side_effect = [message, zmq.Again(), message, zmq.Again()]
+        convert.side_effect = lambda *args: bridge.request_stop()
+        self.poll([sub])
+
+        bridge.run()
+
+        self.assertEqual(convert.call_count, 2)
+        sub.setsockopt.assert_called_with(zmq.UNSUBSCRIBE, b"a.")
+        sub.close.assert_called_once_with(linger=0)
+
+    @mock.patch("fedmsg_migration_tools.bridges.signal.signal", mock.Mock())
+    @mock.patch("fedmsg_migration_tools.bridges.connection_parameters", mock.Mock())
+    @mock.patch("fedmsg_migration_tools.bridges.pika.BlockingConnection")
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_notify(self, convert, connection):
+        """Assert systemd is told the bridge is ready once the broker is up."""
+        notifier = mock.Mock(enabled=True, watchdog_interval=10)
+        bridge = self.bridge("ex", ["tcp://a:1"], ["a."], notifier=notifier)
+        bridge.BROKER_RETRY = 0
+        sub = bridge.sources["tcp://a:1"].socket
+        message = [b"a.topic", b"{}"]
+        sub.recv_multipart.side_effect = [message, zmq.Again(), zmq.Again()]
+        connection.side_effect = [pika.exceptions.AMQPConnectionError(), mock.Mock()]
+        rounds = iter([[(sub, zmq.POLLIN)], []])
+
+        def poll(timeout):
+            ready = next(rounds)
+            if not ready:
+                bridge.request_stop()
+            return ready
+
+        self.poller.poll.side_effect = poll
+        with self.assertLogs(bridges._log.name, "ERROR"):
+            bridge.run()
+
+        self.assertEqual(connection.call_count, 2)
+        self.assertEqual(bridge.handled, 1)
+        self.assertEqual(
+            [call[0] for call in notifier.mock_calls if call[0] != "status"],
+            ["ready", "watchdog", "stopping"],
+        )
+
+    @mock.patch("fedmsg_migration_tools.bridges.signal.signal", mock.Mock())
+    @mock.patch("fedmsg_migration_tools.bridges.connection_parameters", mock.Mock())
+    @mock.patch("fedmsg_migration_tools.bridges.pika.BlockingConnection", mock.Mock())
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_notify_shaped(self, convert):
+        """Assert the watchdog is pinged while the shaper holds messages back."""
+        convert.return_value = True
+        notifier = mock.Mock(enabled=True, watchdog_interval=10)
+        shaping = dict(config.DEFAULTS["zmq_to_amqp"]["shaping"], rate=0.001, burst=1)
+        bridge = self.bridge(
+            "ex", ["tcp://a:1"], [""], shaping=shaping, notifier=notifier
+        )
+        clock = mock.Mock(return_value=1000.0)
+        bridge.watchdog = notify.Watchdog(notifier, clock=clock)
+        sub = bridge.sources["tcp://a:1"].socket
+        sub.recv_multipart.side_effect = [
+            [b"a.topic", json.dumps({"msg_id": str(i)}).encode("utf-8")]
+            for i in range(3)
+        ] + [zmq.Again(), zmq.Again()]
+        rounds = iter([[(sub, zmq.POLLIN)]] + [[]] * 5)
+
+        def poll(timeout):
+            clock.return_value += 10
+            ready = next(rounds, None)
+            if ready is None:
+                bridge.request_stop()
+                return []
+            return ready
+
+        self.poller.poll.side_effect = poll
+        held = []
+        notifier.watchdog.side_effect = lambda: held.append(bridge.held())
+        bridge.run()
+
+        self.assertEqual(held, [2] * 7)
+
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_drain(self, convert):
+        """Assert the messages held are published, oldest first, and the rest spilled."""
+        shaping = dict(config.DEFAULTS["zmq_to_amqp"]["shaping"], rate=1, burst=1)
+        lanes = dict(
+            config.DEFAULTS["zmq_to_amqp"]["lanes"],
+            classes={"critical": {"patterns": ["*.fas.*"], "weight": 10}},
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            spill_file = os.path.join(tmpdir, "spill.jsonl")
+            bridge = self.bridge(
+                "ex",
+                ["tcp://a:1"],
+                [""],
+                shaping=shaping,
+                lanes=lanes,
+                spill_file=spill_file,
+            )
+            sub = bridge.sources["tcp://a:1"].socket
+            messages = [
+                [topic, json.dumps({"msg_id": str(i)}).encode("utf-8")]
+                for i, topic in enumerate(
+                    [
+                        b"org.shaped",
+                        b"org.shaped",
+                        b"org.bulk",
+                        b"org.fas.user",
+                        b"org.queued",
+                    ]
+                )
+            ]
+            bridge._send(*messages[0])
+            bridge._send(*messages[1])
+            bridge.lanes.put(messages[2][0], tuple(messages[2]))
+            bridge.lanes.put(messages[3][0], tuple(messages[3]))
+            sub.recv_multipart.side_effect = [messages[4], zmq.Again()]
+            convert.reset_mock()
+            convert.side_effect = [True, True, False]
+
+            with self.assertLogs(bridges._log.name, "WARNING") as logs:
+                bridge.drain()
+
+            self.assertEqual(
+                [call[0][1] for call in convert.call_args_list],
+                [messages[1][1], messages[3][1], messages[2][1]],
+            )
+            self.assertIn("Wrote 2 messages", logs.output[-1])
+            self.assertEqual(
+                [
+                    json.loads(body.decode("utf-8"))["msg_id"]
+                    for _, body in spill.read(spill_file)
+                ],
+                ["2", "4"],
+            )
+            sub.close.assert_called_once_with(linger=0)
+
+            convert.reset_mock()
+            convert.side_effect = [True, False]
+            with self.assertLogs(bridges._log.name, "WARNING"):
+                bridge.replay_spill()
+            self.assertEqual(len(spill.read(spill_file)), 1)
+
+            convert.side_effect = [True]
+            bridge.replay_spill()
+            self.assertFalse(os.path.exists(spill_file))
+
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_replay_multiline_spill(self, convert):
+        """Assert messages with pretty-printed bodies are spilled and replayed."""
+        bodies = [
+            {"msg_id": "0", "msg": {"text": "a\nb"}},
+            {"msg_id": "1", "msg": {}},
+        ]
+        convert.return_value = True
+        with tempfile.TemporaryDirectory() as tmpdir:
+            spill_file = os.path.join(tmpdir, "spill.jsonl")
+            spill.write(
+                spill_file,
+                [
+                    (b"a.topic", json.dumps(body, indent=2).encode("utf-8"))
+                    for body in bodies
+                ],
+            )
+            bridge = self.bridge("ex", ["tcp://a:1"], [""], spill_file=spill_file)
+
+            bridge.replay_spill()
+
+            self.assertFalse(os.path.exists(spill_file))
+        self.assertEqual(
+            [json.loads(call[0][1].decode("utf-8")) for call in convert.call_args_list],
+            bodies,
+        )
+
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_drain_without_spill_file(self, convert):
+        """Assert the messages that couldn't be published are logged as dropped."""
+        bridge = self.bridge("ex", ["tcp://a:1"], [""], drain_timeout=0)
+        sub = bridge.sources["tcp://a:1"].socket
+        sub.recv_multipart.side_effect = [[b"topic", b"{}"], zmq.Again()]
+
+        with self.assertLogs(bridges._log.name, "ERROR") as logs:
+            bridge.drain()
+
+        convert.assert_not_called()
+        self.assertIn("Dropping 1 messages", logs.output[-1])
+
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_shaping(self, convert):
+        """Assert the messages over the rate wait, and the poll timeout is shortened."""
+        shaping = dict(config.DEFAULTS["zmq_to_amqp"]["shaping"], rate=10, burst=1)
+        bridge = self.bridge("ex", ["tcp://a:1"], ["a."], shaping=shaping)
+        sub = bridge.sources["tcp://a:1"].socket
+        sub.recv_multipart.side_effect = [
+            [b"a.topic", b"1"],
+            [b"a.topic", b"2"],
+            zmq.Again(),
+        ]
+        self.poll([sub], KeyboardInterrupt())
+
+        self.assertRaises(KeyboardInterrupt, bridge.run)
+
+        convert.assert_called_once_with(b"a.topic", b"1", bridge.runtime)
+        self.assertLess(self.poller.poll.call_args[0][0], bridge.POLL_TIMEOUT)
+        self.assertEqual(bridge.shaper.stats()["global"]["waiting"], 1)
+
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_lanes(self, convert):
+        """Assert waiting priority messages are published before bulk ones."""
+        lanes = dict(
+            config.DEFAULTS["zmq_to_amqp"]["lanes"],
+            classes={"critical": {"patterns": ["*.fas.*"], "weight": 10}},
+        )
+        bridge = self.bridge("ex", ["tcp://a:1"], [""], lanes=lanes)
+        sub = bridge.sources["tcp://a:1"].socket
+        sub.recv_multipart.side_effect = [
+            [b"org.buildsys.tag", b"1"],
+            [b"org.buildsys.tag", b"2"],
+            [b"org.fas.user", b"3"],
+            zmq.Again(),
+        ]
+        self.poll([sub], [], [], KeyboardInterrupt())
+
+        self.assertRaises(KeyboardInterrupt, bridge.run)
+
+        self.assertEqual(
+            [call[0][1] for call in convert.call_args_list], [b"3", b"1", b"2"]
+        )
+        self.assertEqual(
+            [call[0][0] for call in self.poller.poll.call_args_list],
+            [bridge.POLL_TIMEOUT, 0, 0, bridge.POLL_TIMEOUT],
+        )
+
+
+@mock.patch.dict(
+    "fedmsg_migration_tools.bridges.fedmsg_config.conf", {"validate_signatures": False}
+)
+class ZmqToAmqpSocketTests(unittest.TestCase):
+    @mock.patch("fedmsg_migration_tools.bridges._convert_and_maybe_publish")
+    def test_topics_per_endpoint(self, convert):
+        """Assert each endpoint only delivers the topics it is subscribed to."""
+        context = zmq.Context.instance()
+        publishers = []
+        for name in ("a", "b"):
+            publisher = context.socket(zmq.PUB)
+            publisher.bind("inproc://test-topics-{}".format(name))
+            self.addCleanup(publisher.close, linger=0)
+            publishers.append(publisher)
+        bridge = bridges.ZmqToAmqp(
+            "ex",
+            [
+                "inproc://test-topics-a",
+                {"endpoint": "inproc://test-topics-b", "topics": ["b.wanted"]},
+            ],
+            ["a."],
+        )
+        bridge.connect()
+        for source in bridge.sources.values():
+            self.addCleanup(source.close)
+        received = set()
+
+        def on_message(topic, body, runtime):
+            received.add(topic)
+            if {b"a.topic", b"b.wanted"} <= received:
+                raise KeyboardInterrupt()
+
+        poll = bridge._poller.poll
+
+        def publish_and_poll(timeout):
+            for publisher in publishers:
+                for topic in (b"a.topic", b"b.wanted", b"b.unwanted"):
+                    publisher.send_multipart([topic, b"{}"])
+            return poll(timeout)
+
+        convert.side_effect = on_message
+        with mock.patch.object(bridge._poller, "poll", side_effect=publish_and_poll):
+            self.assertRaises(KeyboardInterrupt, bridge.run)
+
+        self.assertEqual(received, {b"a.topic", b"b.wanted"})
+        self.assertEqual(
+            bridge.stats()["endpoints"]["inproc://test-topics-b"]["dropped"], 0
+        )
 
 
 @mock.patch("fedmsg_migration_tools.bridges.time.time", mock.Mock(return_value=101))
+@mock.patch("fedmsg_migration_tools.bridges.SocketMonitor", mock.Mock())
 class AmqpToZmqTests(unittest.TestCase):
     @mock.patch("fedmsg_migration_tools.bridges.zmq.Context", mock.Mock())
     def test_unsigned(self):
@@ -113,7 +871,6 @@ class AmqpToZmqTests(unittest.TestCase):
     def test_signed(self):
         """Assert messages are signed if fedmsg is configured for signatures."""
         year = datetime.datetime.utcnow().year
-        zmq_bridge = bridges.AmqpToZmq()
         msg = message.Message(topic="my.topic", body={"my": "message"})
         expected = {
             "topic": "my.topic",
@@ -127,7 +884,8 @@ class AmqpToZmqTests(unittest.TestCase):
         conf = {"sign_messages": True, "ssldir": FIXTURES_DIR, "certname": "fedmsg"}
 
         with mock.patch.dict("fedmsg_migration_tools.bridges.fedmsg_config.conf", conf):
-            zmq_bridge(msg)
+            zmq_bridge = bridges.AmqpToZmq()
+        zmq_bridge(msg)
 
         body = json.loads(
             zmq_bridge.pub_socket.send_multipart.call_args_list[0][0][0][1].decode(
@@ -144,7 +902,6 @@ class AmqpToZmqTests(unittest.TestCase):
     @mock.patch("fedmsg_migration_tools.bridges.zmq.Context", mock.Mock())
     def test_signed_implicit_cert(self):
         """Assert signing certificate is properly autodetected."""
-        zmq_bridge = bridges.AmqpToZmq()
         msg = message.Message(topic="my.topic", body={"my": "message"})
         hostname = socket.gethostname().split(".", 1)[0]
         base_conf = {"sign_messages": True, "ssldir": FIXTURES_DIR}
@@ -161,11 +918,12 @@ class AmqpToZmqTests(unittest.TestCase):
             with mock.patch.dict(
                 "fedmsg_migration_tools.bridges.fedmsg_config.conf", conf
             ):
-                with mock.patch(
-                    "fedmsg_migration_tools.bridges.fedmsg.crypto.sign"
-                ) as mock_sign:
-                    mock_sign.side_effect = lambda *a, **kw: a[0]
-                    zmq_bridge(msg)
+                zmq_bridge = bridges.AmqpToZmq()
+            with mock.patch(
+                "fedmsg_migration_tools.bridges.fedmsg.crypto.sign"
+            ) as mock_sign:
+                mock_sign.side_effect = lambda *a, **kw: a[0]
+                zmq_bridge(msg)
             sign_call_kw = mock_sign.call_args_list[-1][1]
             self.assertIn("certname", sign_call_kw)
             self.assertEqual(sign_call_kw["certname"], "fedmsg")
@@ -212,3 +970,326 @@ class AmqpToZmqTests(unittest.TestCase):
         except (TypeError, AttributeError) as e:
             self.fail(e)
         zmq_bridge.pub_socket.send_multipart.assert_not_called()
+
+
+@mock.patch.dict(
+    "fedmsg_migration_tools.bridges.fedmsg_config.conf", {"sign_messages": False}
+)
+class AmqpToZmqBatchTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("fedmsg_migration_tools.bridges.zmq.Context")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _delivery(self, msg, delivery_tag):
+        method = pika.spec.Basic.Deliver(
+            delivery_tag=delivery_tag, routing_key=msg.topic
+        )
+        return (method, msg._properties, msg._encoded_body)
+
+    def consume(self, rounds, **kwargs):
+        """
+        Run the consume loop, then stop it once the rounds are over.
+
+        Args:
+            rounds (list): The ``(count, elapsed)`` of each round: how many
+                messages the broker delivers, and how many seconds it takes.
+            kwargs: The arguments of :meth:`AmqpToZmq.consume_batches`.
+
+        Returns:
+            tuple: The bridge, its channel, and the time limit of each round.
+        """
+        for target in (
+            "fedmsg_migration_tools.bridges.signal.signal",
+            "fedmsg_migration_tools.bridges.SocketMonitor",
+            "fedmsg_migration_tools.bridges._declare_and_bind",
+            "fedmsg_migration_tools.bridges.connection_parameters",
+        ):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        clock = mock.Mock(return_value=0.0)
+        zmq_bridge = bridges.AmqpToZmq(notifier=mock.Mock(enabled=False))
+        connection = mock.Mock()
+        channel = connection.channel.return_value
+        rounds = iter(rounds)
+        time_limits = []
+        tags = iter(range(1, 1000))
+
+        def deliver(time_limit):
+            time_limits.append(time_limit)
+            count, elapsed = next(rounds, (0, 0))
+            on_message = channel.basic_consume.call_args[0][1]
+            for _ in range(count):
+                tag = next(tags)
+                msg = message.Message(topic="my.topic", body={"i": tag})
+                on_message(channel, *self._delivery(msg, tag))
+            clock.return_value += elapsed
+            if not (count or elapsed):
+                zmq_bridge.request_stop()
+
+        connection.process_data_events.side_effect = deliver
+        with mock.patch(
+            "fedmsg_migration_tools.bridges.pika.BlockingConnection",
+            return_value=connection,
+        ), mock.patch(
+            "fedmsg_migration_tools.bridges.time.monotonic", clock
+        ), mock.patch.dict(
+            "fedmsg_migration_tools.bridges.fm_config.conf", {"queues": {"q": {}}}
+        ):
+            zmq_bridge.consume_batches(**kwargs)
+        return zmq_bridge, channel, time_limits
+
+    def test_consume_batches_size(self):
+        """Assert a batch is published as soon as it is full."""
+        zmq_bridge, channel, time_limits = self.consume(
+            [(2, 0.01), (1, 0.01)], batch_size=2, batch_timeout=1
+        )
+
+        self.assertEqual(
+            [call for call in channel.mock_calls if call[0] != "basic_consume"][1:],
+            [
+                mock.call.basic_ack(delivery_tag=2, multiple=True),
+                mock.call.basic_cancel(channel.basic_consume.return_value),
+                mock.call.basic_ack(delivery_tag=3, multiple=True),
+            ],
+        )
+        self.assertEqual(zmq_bridge.pub_socket.send_multipart.call_count, 3)
+        self.assertEqual(time_limits[:2], [1, 1])
+        self.assertEqual(zmq_bridge.handled, 3)
+
+    def test_consume_batches_timeout(self):
+        """Assert a batch is published once its first message waited long enough."""
+        zmq_bridge, channel, time_limits = self.consume(
+            [(1, 0), (1, 0.03), (0, 0.03), (1, 0)], batch_size=10, batch_timeout=0.05
+        )
+
+        self.assertEqual(
+            [call for call in channel.mock_calls if call[0] != "basic_consume"][1:],
+            [
+                mock.call.basic_ack(delivery_tag=2, multiple=True),
+                mock.call.basic_cancel(channel.basic_consume.return_value),
+                mock.call.basic_ack(delivery_tag=3, multiple=True),
+            ],
+        )
+        for time_limit, expected in zip(time_limits, [1, 0.05, 0.02, 1]):
+            self.assertAlmostEqual(time_limit, expected)
+        self.assertEqual(zmq_bridge.handled, 3)
+
+    def test_consume_batches_failure(self):
+        """Assert only the messages not sent are requeued, and consuming goes on."""
+        sends = [None, zmq.ZMQError(), None, None, None]
+        with mock.patch.object(bridges.zmq.Context, "instance") as instance:
+            instance.return_value.socket.return_value.send_multipart.side_effect = sends
+            zmq_bridge, channel, time_limits = self.consume(
+                [(3, 0), (2, 0)], batch_size=3, batch_timeout=1
+            )
+
+        self.assertEqual(
+            [call for call in channel.mock_calls if call[0] != "basic_consume"][1:],
+            [
+                mock.call.basic_ack(delivery_tag=1, multiple=True),
+                mock.call.basic_nack(delivery_tag=3, multiple=True, requeue=True),
+                mock.call.basic_cancel(channel.basic_consume.return_value),
+                mock.call.basic_ack(delivery_tag=5, multiple=True),
+            ],
+        )
+        self.assertEqual(zmq_bridge.handled, 3)
+
+    def test_flush(self):
+        """Assert a batch is published in order and acked with a single ack."""
+        zmq_bridge = bridges.AmqpToZmq()
+        channel = mock.Mock()
+        msgs = [
+            message.Message(topic="my.topic.{}".format(i), body={"i": i})
+            for i in range(3)
+        ]
+        batch = [self._delivery(msg, i + 1) for i, msg in enumerate(msgs)]
+
+        zmq_bridge._flush(channel, batch)
+
+        sent = zmq_bridge.pub_socket.send_multipart.call_args_list
+        self.assertEqual(
+            [call[0][0][0] for call in sent],
+            [b"my.topic.0", b"my.topic.1", b"my.topic.2"],
+        )
+        self.assertEqual(
+            [json.loads(call[0][0][1].decode("utf-8"))["msg"] for call in sent],
+            [{"i": 0}, {"i": 1}, {"i": 2}],
+        )
+        channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+        channel.basic_nack.assert_not_called()
+
+    @mock.patch("fedmsg_migration_tools.bridges.signal.signal")
+    @mock.patch("fedmsg_migration_tools.bridges.SocketMonitor", mock.Mock())
+    @mock.patch("fedmsg_migration_tools.bridges._declare_and_bind", mock.Mock())
+    @mock.patch("fedmsg_migration_tools.bridges.connection_parameters", mock.Mock())
+    @mock.patch("fedmsg_migration_tools.bridges.pika.BlockingConnection")
+    def test_consume_batches_stop(self, connection, signal):
+        """Assert the consumers are cancelled and the batch flushed on SIGTERM."""
+        notifier = mock.Mock(enabled=False)
+        zmq_bridge = bridges.AmqpToZmq(notifier=notifier)
+        channel = connection.return_value.channel.return_value
+        channel.basic_consume.return_value = "ctag"
+        msg = message.Message(topic="my.topic", body={})
+
+        def deliver(time_limit):
+            on_message = channel.basic_consume.call_args[0][1]
+            on_message(channel, *self._delivery(msg, 1))
+            zmq_bridge.request_stop()
+
+        connection.return_value.process_data_events.side_effect = deliver
+        with mock.patch.dict(
+            "fedmsg_migration_tools.bridges.fm_config.conf", {"queues": {"q": {}}}
+        ):
+            zmq_bridge.consume_batches(batch_size=10, drain_timeout=2)
+
+        self.assertEqual(
+            channel.mock_calls[-2:],
+            [
+                mock.call.basic_cancel("ctag"),
+                mock.call.basic_ack(delivery_tag=1, multiple=True),
+            ],
+        )
+        zmq_bridge.pub_socket.send_multipart.assert_called_once()
+        zmq_bridge.pub_socket.close.assert_called_once_with(linger=2000)
+        self.assertEqual(signal.call_args_list[-1][0][0], bridges.signal.SIGTERM)
+        notifier.ready.assert_called_once_with("Consuming from 1 queues")
+        notifier.stopping.assert_called_once_with()
+        self.assertEqual(zmq_bridge.handled, 1)
+
+    def test_stats(self):
+        """Assert the messages published and the connection events are counted."""
+        zmq_bridge = bridges.AmqpToZmq(report_interval=0)
+        zmq_bridge.monitor.handle_event(zmq.EVENT_ACCEPTED, b"tcp://127.0.0.1:1")
+        msgs = [message.Message(topic="my.topic", body={"i": i}) for i in range(3)]
+        batch = [self._delivery(msg, i + 1) for i, msg in enumerate(msgs)]
+
+        zmq_bridge._flush(mock.Mock(), batch)
+        stats = zmq_bridge.stats()
+
+        self.assertEqual(stats["published"], 3)
+        self.assertGreater(stats["bytes"], 0)
+        self.assertGreater(stats["rate"], 0)
+        self.assertEqual(stats["bursts"]["max_burst"], 3)
+        self.assertEqual(
+            stats["recommended"],
+            {"sndhwm": 1000, "sndbuf": 212992, "saturated": False, "grow": False},
+        )
+        self.assertEqual(stats["peers"], 1)
+        self.assertEqual(stats["connects"], 1)
+        self.assertEqual(stats["disconnects"], 0)
+
+    def test_report(self):
+        """Assert the statistics are logged, written to the report file, and reset."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            report_file = os.path.join(tmpdir, "report.json")
+            zmq_bridge = bridges.AmqpToZmq(report_interval=60, report_file=report_file)
+            batch = [self._delivery(message.Message(topic="my.topic", body={}), 1)]
+            zmq_bridge._flush(mock.Mock(), batch)
+
+            with self.assertLogs(bridges._log.name, "INFO") as logs:
+                zmq_bridge.report()
+
+            with open(report_file) as fd:
+                report = json.load(fd)
+        self.assertIn("Published", logs.output[-1])
+        self.assertEqual(report["published"], 1)
+        self.assertIn("sndhwm", report["recommended"])
+        self.assertEqual(report["disconnects"], 0)
+        self.assertEqual(zmq_bridge.stats()["published"], 0)
+
+    @mock.patch("fedmsg_migration_tools.bridges.SocketMonitor", mock.Mock())
+    def test_report_due(self):
+        """Assert the statistics are reported from the callback when due."""
+        zmq_bridge = bridges.AmqpToZmq(report_interval=60)
+        zmq_bridge._next_report = 0
+
+        with mock.patch.object(zmq_bridge, "report") as report:
+            zmq_bridge(message.Message(topic="my.topic", body={}))
+
+        report.assert_called_once_with()
+
+    def test_flush_recommend(self):
+        """Assert the settings holding the bursts published are logged once."""
+        zmq_bridge = bridges.AmqpToZmq()
+        channel = mock.Mock()
+        msgs = [message.Message(topic="my.topic", body={"i": i}) for i in range(600)]
+        batch = [self._delivery(msg, i + 1) for i, msg in enumerate(msgs)]
+
+        with self.assertLogs(bridges._log.name, "INFO") as logs:
+            zmq_bridge._flush(channel, batch)
+            zmq_bridge._flush(channel, batch[:1])
+
+        recommendations = [log for log in logs.output if "Recommended" in log]
+        self.assertEqual(len(recommendations), 1)
+        self.assertIn("sndhwm = 2048", recommendations[0])
+
+    def test_flush_without_message_id(self):
+        """Assert messages without an id are dropped but still acked."""
+        zmq_bridge = bridges.AmqpToZmq()
+        channel = mock.Mock()
+        msg = message.Message(topic="my.topic", body={"my": "message"})
+        msg.id = None
+        batch = [self._delivery(msg, 1)]
+        with mock.patch("fedmsg_migration_tools.bridges.get_message", return_value=msg):
+            zmq_bridge._flush(channel, batch)
+
+        zmq_bridge.pub_socket.send_multipart.assert_not_called()
+        channel.basic_ack.assert_called_once_with(delivery_tag=1, multiple=True)
+
+    def test_flush_zmq_error(self):
+        """Assert the whole batch is requeued if ZeroMQ delivery fails."""
+        zmq_bridge = bridges.AmqpToZmq()
+        zmq_bridge.pub_socket.send_multipart.side_effect = zmq.ZMQError()
+        channel = mock.Mock()
+        msgs = [message.Message(topic="my.topic", body={"i": i}) for i in range(2)]
+        batch = [self._delivery(msg, i + 1) for i, msg in enumerate(msgs)]
+
+        zmq_bridge._flush(channel, batch)
+
+        channel.basic_nack.assert_called_once_with(
+            delivery_tag=2, multiple=True, requeue=True
+        )
+        channel.basic_ack.assert_not_called()
+
+    def test_flush_partial_zmq_error(self):
+        """Assert the messages sent before a ZeroMQ failure are acked, not requeued."""
+        zmq_bridge = bridges.AmqpToZmq()
+        zmq_bridge.pub_socket.send_multipart.side_effect = [None, zmq.ZMQError()]
+        channel = mock.Mock()
+        msgs = [message.Message(topic="my.topic", body={"i": i}) for i in range(3)]
+        batch = [self._delivery(msg, i + 1) for i, msg in enumerate(msgs)]
+
+        with self.assertLogs(bridges._log.name, "ERROR"):
+            zmq_bridge._flush(channel, batch)
+
+        self.assertEqual(
+            channel.mock_calls,
+            [
+                mock.call.basic_ack(delivery_tag=1, multiple=True),
+                mock.call.basic_nack(delivery_tag=3, multiple=True, requeue=True),
+            ],
+        )
+        self.assertEqual(zmq_bridge.handled, 1)
+
+    def test_flush_sign_error(self):
+        """Assert the batch is requeued if signing fails, and the consumer halts."""
+        channel = mock.Mock()
+        batch = [self._delivery(message.Message(topic="my.topic", body={}), 1)]
+        conf = {"sign_messages": True, "certname": "fedmsg"}
+
+        with mock.patch.dict("fedmsg_migration_tools.bridges.fedmsg_config.conf", conf):
+            zmq_bridge = bridges.AmqpToZmq()
+        with mock.patch(
+            "fedmsg_migration_tools.bridges.fedmsg.crypto.sign",
+            side_effect=ValueError("no cert"),
+        ):
+            self.assertRaises(
+                exceptions.HaltConsumer, zmq_bridge._flush, channel, batch
+            )
+
+        channel.basic_nack.assert_called_once_with(
+            delivery_tag=1, multiple=True, requeue=True
+        )
+        zmq_bridge.pub_socket.send_multipart.assert_not_called()
@@ -0,0 +1,210 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from fedmsg_migration_tools import capture, offline
+
+
+class FormatEntryTests(unittest.TestCase):
+    """Tests for the :func:`capture.format_entry` function."""
+
+    def test_valid_json(self):
+        """Assert entries are valid JSON embedding the body as is."""
+        body = json.dumps({"msg_id": "2019-abc", "msg": {"a": "☃"}})
+        line = capture.format_entry(1.5, 't"opic', "2019-abc", body, {"h": 1})
+        self.assertEqual(
+            json.loads(line),
+            {
+                "received": 1.5,
+                "topic": 't"opic',
+                "msg_id": "2019-abc",
+                "headers": {"h": 1},
+                "body": json.loads(body),
+            },
+        )
+        self.assertIn(body, line)
+
+    def test_multiline_body(self):
+        """Assert a pretty-printed body is written on a single line."""
+        body = json.dumps({"msg_id": "2019-abc", "msg": {"a": "b\nc"}}, indent=2)
+
+        line = capture.format_entry(1.5, "t", "2019-abc", body)
+
+        self.assertNotIn("\n", line)
+        self.assertEqual(json.loads(line)["body"], json.loads(body))
+
+    def test_without_headers(self):
+        """Assert headers are omitted when there are none."""
+        line = capture.format_entry(1.5, "t", "abc", "{}")
+        self.assertNotIn("headers", json.loads(line))
+
+
+class SegmentWriterTests(unittest.TestCase):
+    """Tests for the :class:`capture.SegmentWriter` class and its readers."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _write(self, writer, count, start=0):
+        for i in range(start, start + count):
+            msg_id = "2019-id{}".format(i)
+            writer.write(
+                float(i), msg_id, capture.format_entry(float(i), "t", msg_id, "{}")
+            )
+
+    def test_blocks(self):
+        """Assert messages are written in indexed blocks of gzip members."""
+        flushed = mock.Mock()
+        writer = capture.SegmentWriter(
+            self.tmpdir, "zmq", block_size=3, on_flush=flushed
+        )
+        self._write(writer, 7)
+        self.assertEqual(flushed.call_count, 2)
+        writer.close()
+        self.assertEqual(flushed.call_count, 3)
+
+        index = capture.read_index(writer.path)
+        self.assertEqual([block["count"] for block in index], [3, 3, 1])
+        self.assertEqual(index[1]["ids"], ["id3", "id4", "id5"])
+        self.assertEqual((index[1]["first"], index[1]["last"]), (3.0, 5.0))
+        self.assertEqual(
+            [e["msg_id"] for e in capture.read_block(writer.path, index[1])],
+            ["2019-id3", "2019-id4", "2019-id5"],
+        )
+        # The segment as a whole is a regular gzip file
+        with gzip.open(writer.path, "rt") as fd:
+            self.assertEqual(len(fd.readlines()), 7)
+
+    def test_maybe_flush(self):
+        """Assert buffered messages are written after the flush interval."""
+        writer = capture.SegmentWriter(self.tmpdir, "zmq", flush_interval=60)
+        self._write(writer, 2)
+        writer.maybe_flush()
+        self.assertIsNone(writer.path)
+        writer._buffered_since -= 60
+        writer.maybe_flush()
+        self.assertEqual(len(capture.read_index(writer.path)), 1)
+        writer.close()
+
+    def test_rotation(self):
+        """Assert a new segment is started when the current one is too big."""
+        writer = capture.SegmentWriter(self.tmpdir, "zmq", block_size=2, max_bytes=1)
+        self._write(writer, 6)
+        writer.close()
+        segments = capture.list_segments(self.tmpdir)
+        self.assertEqual(len(segments), 3)
+        self.assertTrue(segments[0].endswith(".0000.jsonl.gz"))
+        self.assertTrue(segments[2].endswith(".0002.jsonl.gz"))
+        self.assertEqual(
+            [e["msg_id"] for e in capture.read_range(self.tmpdir)],
+            ["2019-id{}".format(i) for i in range(6)],
+        )
+
+    def test_find_message(self):
+        """Assert messages are found using the index."""
+        writer = capture.SegmentWriter(self.tmpdir, "zmq", block_size=10)
+        self._write(writer, 25)
+        writer.close()
+        self.assertEqual(capture.find_message(self.tmpdir, "id17")["received"], 17.0)
+        self.assertEqual(
+            capture.find_message(writer.path, "2018-id17")["msg_id"], "2019-id17"
+        )
+        self.assertIsNone(capture.find_message(self.tmpdir, "id99"))
+
+    def test_read_block_invalid_line(self):
+        """Assert the invalid lines of a block are skipped."""
+        writer = capture.SegmentWriter(self.tmpdir, "zmq")
+        self._write(writer, 1)
+        writer.write(1.0, "2019-id1", '{"received": 1.0, "msg_id": "2019-')
+        self._write(writer, 1, start=2)
+        writer.close()
+        block = capture.read_index(writer.path)[0]
+
+        with self.assertLogs(capture._log.name, "WARNING"):
+            entries = capture.read_block(writer.path, block)
+
+        self.assertEqual([e["msg_id"] for e in entries], ["2019-id0", "2019-id2"])
+
+    def test_read_range(self):
+        """Assert only the blocks covering the range are read."""
+        writer = capture.SegmentWriter(self.tmpdir, "zmq", block_size=10)
+        self._write(writer, 30)
+        writer.close()
+        with mock.patch(
+            "fedmsg_migration_tools.capture.read_block", wraps=capture.read_block
+        ) as read_block:
+            entries = list(capture.read_range(self.tmpdir, 12, 15))
+        self.assertEqual([e["received"] for e in entries], [12.0, 13.0, 14.0])
+        self.assertEqual(read_block.call_count, 1)
+
+    def test_offline(self):
+        """Assert captures can be read by the offline verification."""
+        writer = capture.SegmentWriter(self.tmpdir, "zmq", block_size=2)
+        self._write(writer, 3)
+        writer.close()
+        self.assertEqual(
+            list(offline.read_log(self.tmpdir)),
+            [(0.0, "id0", "t"), (1.0, "id1", "t"), (2.0, "id2", "t")],
+        )
+
+
+class AmqpCaptureTests(unittest.TestCase):
+    """Tests for the :class:`capture.AmqpCapture` class."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.writer = capture.SegmentWriter(self.tmpdir, "amqp", block_size=2)
+        self.capture = capture.AmqpCapture(self.writer, {"queue": "q"}, [])
+        self.capture._channel = mock.Mock()
+
+    def _deliver(self, tag, body=b'{"a": 1}', message_id="abc"):
+        method = mock.Mock(delivery_tag=tag, routing_key="t")
+        properties = mock.Mock(message_id=message_id, headers=None)
+        self.capture._on_message(self.capture._channel, method, properties, body)
+
+    def test_ack_on_flush(self):
+        """Assert messages are only acknowledged once written."""
+        self._deliver(1)
+        self.capture._channel.basic_ack.assert_not_called()
+        self._deliver(2)
+        self.capture._channel.basic_ack.assert_called_once_with(
+            delivery_tag=2, multiple=True
+        )
+        self.writer.close()
+        self.assertEqual(self.capture._channel.basic_ack.call_count, 1)
+
+    def test_invalid(self):
+        """Assert invalid messages are acknowledged with the next block."""
+        self._deliver(1, message_id=None)
+        self._deliver(2, body=b"\xff")
+        self._deliver(3, body=b"not json")
+        self.writer.close()
+        self.capture._channel.basic_ack.assert_called_once_with(
+            delivery_tag=3, multiple=True
+        )
+        entries = list(capture.read_range(self.tmpdir))
+        self.assertEqual(entries[0]["body"], "not json")
+        self.assertEqual(entries[0]["headers"], {})
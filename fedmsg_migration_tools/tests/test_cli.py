@@ -0,0 +1,237 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+import mock
+
+from fedmsg_migration_tools import capture, cli, config
+
+
+#: The libraries only the commands need, which the CLI must not import itself.
+HEAVY_MODULES = ("fedmsg", "fedora_messaging", "pika", "twisted", "txzmq", "zmq")
+
+
+def imported_modules(code):
+    """
+    Run some code in a new interpreter, and list the modules it imported.
+
+    Args:
+        code (str): The code to run.
+
+    Returns:
+        set: The names of the imported modules.
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    ).stderr.decode("utf-8")
+    modules = set()
+    for line in output.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip())
+    return modules
+
+
+class ImportTimeTests(unittest.TestCase):
+    """Tests for the modules imported by the CLI before a command runs."""
+
+    def assertNoHeavyImports(self, code):
+        modules = imported_modules(code)
+        self.assertIn("fedmsg_migration_tools.cli", modules)
+        heavy = sorted(m for m in modules if m.split(".")[0] in HEAVY_MODULES)
+        self.assertEqual(heavy, [])
+
+    def test_import(self):
+        """Assert importing the CLI doesn't import the commands' libraries."""
+        self.assertNoHeavyImports("import fedmsg_migration_tools.cli")
+
+    def test_help(self):
+        """Assert showing the help doesn't import the commands' libraries."""
+        self.assertNoHeavyImports(
+            "import sys; sys.argv = ['fedmsg-migration-tools', 'verify_missing', "
+            "'--help']\n"
+            "from fedmsg_migration_tools.cli import cli\n"
+            "try:\n"
+            "    cli()\n"
+            "except SystemExit:\n"
+            "    pass\n"
+        )
+
+    def test_config_import(self):
+        """Assert importing the configuration doesn't configure logging."""
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import logging; from fedmsg_migration_tools import config; "
+                "print(logging.getLogger().handlers)",
+            ],
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout.decode("utf-8")
+        self.assertEqual(output.strip(), "[]")
+
+
+class CommandTests(unittest.TestCase):
+    """Tests for the commands, which import their modules when run."""
+
+    def test_offline_verify(self):
+        """Assert the offline verification loads its module when run."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = [os.path.join(tmpdir, name) for name in ("amqp.log", "zmq.log")]
+            for path in paths:
+                with open(path, "w"):
+                    pass
+            result = CliRunner().invoke(
+                cli.cli, ["verify_missing", "--offline"] + paths
+            )
+        self.assertEqual(result.exit_code, 0, result.output)
+
+    def test_find(self):
+        """Assert a captured message is printed, and a missing one reported."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = capture.SegmentWriter(tmpdir, "zmq")
+            writer.write(
+                1.0, "2019-abc", capture.format_entry(1.0, "t", "2019-abc", "{}")
+            )
+            writer.close()
+
+            found = CliRunner().invoke(cli.cli, ["find", tmpdir, "abc"])
+            missing = CliRunner().invoke(cli.cli, ["find", tmpdir, "def"])
+
+        self.assertEqual(found.exit_code, 0, found.output)
+        self.assertEqual(json.loads(found.output)["msg_id"], "2019-abc")
+        self.assertEqual(missing.exit_code, 1)
+        self.assertIn("The message def is not in", missing.output)
+
+    def test_amqp_to_zmq_batch_size(self):
+        """Assert an explicit batch size of 0 is refused, not replaced."""
+        with mock.patch("fedmsg_migration_tools.bridges.AmqpToZmq") as bridge:
+            result = CliRunner().invoke(cli.cli, ["amqp_to_zmq", "--batch-size", "0"])
+
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertIn("at least 1", result.output)
+        bridge.assert_not_called()
+
+    def test_workers(self):
+        """Assert an explicit number of workers of 0 is refused, not replaced."""
+        section = dict(config.DEFAULTS["verify_missing"], workers=4)
+        with mock.patch.dict(config.conf, {"verify_missing": section}):
+            result = CliRunner().invoke(
+                cli.cli,
+                ["verify_missing", "--workers", "0", "--zmq-endpoint", "tcp://a:9940"],
+            )
+
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertIn("at least one worker", result.output)
+
+    def test_asyncio_workers(self):
+        """Assert the asyncio engine refuses to run several workers."""
+        result = CliRunner().invoke(
+            cli.cli,
+            [
+                "verify_missing",
+                "--engine",
+                "asyncio",
+                "--workers",
+                "2",
+                "--zmq-endpoint",
+                "tcp://127.0.0.1:9940",
+            ],
+        )
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("single worker", result.output)
+
+    @mock.patch.object(config.conf, "filename", None)
+    @mock.patch.dict(config.conf, config.DEFAULTS)
+    def test_zmq_to_amqp_reload(self):
+        """Assert the ZeroMQ to AMQP bridge reloads its file, but not its flags."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "config.toml")
+            with open(path, "w") as fd:
+                fd.write('[zmq_to_amqp]\nzmq_endpoints = ["tcp://a:9940"]\n')
+            with mock.patch("fedmsg_migration_tools.bridges.ZmqToAmqp") as bridge:
+                result = CliRunner().invoke(
+                    cli.cli, ["--conf", path, "zmq_to_amqp", "--exchange", "ex"]
+                )
+            self.assertEqual(result.exit_code, 0, result.output)
+            endpoint = {
+                "endpoint": "tcp://a:9940",
+                "rcvhwm": 1000,
+                "reconnect_ivl": 1000,
+                "reconnect_ivl_max": 10000,
+                "heartbeat_ivl": 5000,
+                "heartbeat_timeout": 15000,
+                "stall_timeout": 0,
+            }
+            bridge.assert_called_once_with(
+                "ex",
+                [endpoint],
+                [""],
+                reload=mock.ANY,
+                shaping=config.DEFAULTS["zmq_to_amqp"]["shaping"],
+                lanes=config.DEFAULTS["zmq_to_amqp"]["lanes"],
+                report_interval=60,
+                report_file=None,
+                tuning=config.DEFAULTS["zmq_to_amqp"]["tuning"],
+                drain_timeout=10,
+                spill_file=None,
+            )
+            bridge.return_value.run.assert_called_once_with()
+            reload = bridge.call_args[1]["reload"]
+
+            with open(path, "w") as fd:
+                fd.write(
+                    '[zmq_to_amqp]\nexchange = "other"\ntopics = ["a."]\n'
+                    'zmq_endpoints = ["tcp://b:9940"]\nrcvhwm = 10\n'
+                    '[zmq_to_amqp.sources."tcp://b:9940"]\ntopics = ["b."]\n'
+                    "heartbeat_ivl = 0\n"
+                )
+            endpoint = dict(
+                endpoint,
+                endpoint="tcp://b:9940",
+                rcvhwm=10,
+                topics=["b."],
+                heartbeat_ivl=0,
+            )
+            self.assertEqual(reload(), ("ex", [endpoint], ["a."]))
+
+            with open(path, "w") as fd:
+                fd.write("[zmq_to_amqp\n")
+            self.assertRaises(ValueError, reload)
+        self.assertEqual(config.conf["zmq_to_amqp"]["zmq_endpoints"], ["tcp://b:9940"])
+
+    def test_zmq_to_amqp_invalid_shaping(self):
+        """Assert invalid shaping settings are reported as a usage error."""
+        shaping = dict(config.DEFAULTS["zmq_to_amqp"]["shaping"], overflow="spill")
+        shaping["rate"] = 10
+        section = dict(config.DEFAULTS["zmq_to_amqp"], shaping=shaping)
+        with mock.patch.dict(config.conf, {"zmq_to_amqp": section}):
+            result = CliRunner().invoke(
+                cli.cli, ["zmq_to_amqp", "--zmq-endpoint", "tcp://127.0.0.1:9940"]
+            )
+        self.assertEqual(result.exit_code, 2, result.output)
+        self.assertIn("overflow policy", result.output)
@@ -0,0 +1,112 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest
+
+from fedmsg_migration_tools import config, lanes
+from fedmsg_migration_tools.tests import Clock
+
+
+def _settings(**classes):
+    settings = dict(config.DEFAULTS["zmq_to_amqp"]["lanes"])
+    settings["classes"] = classes
+    return settings
+
+
+class LanesTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.lanes = lanes.Lanes.from_config(
+            _settings(
+                critical={"patterns": ["*.fas.*", "*.bodhi.update.*"], "weight": 3},
+                bulk={"patterns": ["*.buildsys.*", "*.copr.*"], "size": 2},
+            ),
+            clock=self.clock,
+        )
+
+    def test_disabled(self):
+        """Assert no lanes are built without priority classes."""
+        self.assertIsNone(lanes.Lanes.from_config(_settings()))
+
+    def test_classify(self):
+        """Assert messages go in the first lane matching their topic."""
+        topics = {
+            b"org.fedoraproject.prod.fas.user.update": "critical",
+            b"org.fedoraproject.prod.bodhi.update.comment": "critical",
+            b"org.fedoraproject.prod.bodhi.buildroot_override.tag": "default",
+            b"org.fedoraproject.prod.buildsys.tag": "bulk",
+            b"org.fedoraproject.prod.copr.build.end": "bulk",
+        }
+        for topic, name in topics.items():
+            self.assertEqual(self.lanes.lane_for(topic).name, name, topic)
+
+    def test_weighted(self):
+        """Assert the lanes are served according to their weight, in order."""
+        for i in range(4):
+            self.lanes.put(b"org.fedoraproject.prod.fas.user", "fas{}".format(i))
+            self.lanes.put(b"org.fedoraproject.prod.koschei", "koschei{}".format(i))
+        self.assertEqual(len(self.lanes), 8)
+        order = [self.lanes.get() for _ in range(8)]
+        self.assertIsNone(self.lanes.get())
+        self.assertEqual(
+            order,
+            [
+                "fas0",
+                "fas1",
+                "koschei0",
+                "fas2",
+                "fas3",
+                "koschei1",
+                "koschei2",
+                "koschei3",
+            ],
+        )
+
+    def test_burst(self):
+        """Assert a critical message isn't stuck behind a burst, which is bounded."""
+        for i in range(5):
+            self.lanes.put(b"org.fedoraproject.prod.buildsys.tag", i)
+        self.clock.now += 1
+        self.lanes.put(b"org.fedoraproject.prod.fas.user.update", "fas")
+        self.clock.now += 1
+        self.assertEqual(self.lanes.get(), "fas")
+        stats = self.lanes.stats()
+        self.assertEqual(stats["bulk"]["dropped"], 3)
+        self.assertEqual(stats["bulk"]["max_depth"], 2)
+        self.assertEqual(stats["critical"]["published"], 1)
+        self.assertAlmostEqual(stats["critical"]["latency"]["max"], 1)
+
+    def test_report(self):
+        """Assert the statistics are logged and reset periodically."""
+        self.lanes.put(b"org.fedoraproject.prod.fas.user.update", "fas")
+        self.clock.now += 60
+        with self.assertLogs(lanes._log.name, "INFO") as logs:
+            self.lanes.get()
+        self.assertIn("Priority lane critical: 0 published", logs.output[0])
+        self.assertEqual(self.lanes.stats()["critical"]["queued"], 0)
+
+    def test_drain(self):
+        """Assert all the waiting messages are taken out, by priority."""
+        self.lanes.put(b"org.fedoraproject.prod.buildsys.tag", "tag")
+        self.lanes.put(b"org.fedoraproject.prod.fas.user.update", "fas")
+
+        self.assertEqual(self.lanes.drain(), ["fas", "tag"])
+        self.assertEqual(len(self.lanes), 0)
+
+    def test_invalid(self):
+        """Assert invalid lanes are refused."""
+        self.assertRaises(ValueError, lanes.Lane, "test", weight=0)
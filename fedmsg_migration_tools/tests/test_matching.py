@@ -0,0 +1,447 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import tempfile
+import time
+import unittest
+
+import fedmsg.encoding
+import mock
+
+from fedmsg_migration_tools import config, matching
+from fedmsg_migration_tools.store import Record, SpillStore, Store
+
+
+LOGGER = "fedmsg_migration_tools.matching"
+
+
+class ExtractMsgIdTests(unittest.TestCase):
+    """Tests for the :func:`matching.extract_msg_id` function."""
+
+    def _extract(self, body, fast=True):
+        """Extract the ID, asserting whether the whole body was decoded."""
+        with mock.patch(
+            "fedmsg_migration_tools.matching.json.loads", wraps=json.loads
+        ) as loads:
+            msg_id = matching.extract_msg_id(body)
+        whole_body_decoded = mock.call(body) in loads.call_args_list
+        self.assertEqual(whole_body_decoded, not fast)
+        return msg_id
+
+    def test_fedmsg(self):
+        """Assert the ID of fedmsg messages is found without decoding them."""
+        msg = {
+            "topic": "t",
+            "msg_id": "2019-abc",
+            "i": 1,
+            "msg": {"a": [{"b": "the msg_id"}], "c": '\\"msg_id\\":\\"x\\"'},
+            "signature": "sig",
+        }
+        body = fedmsg.encoding.dumps(msg).encode("utf-8")
+        self.assertEqual(self._extract(body), "2019-abc")
+
+    def test_pretty(self):
+        """Assert IDs are found with whitespace, at either end of the message."""
+        body = json.dumps({"msg_id": "abc", "msg": {"a": 1}}, indent=2)
+        self.assertEqual(self._extract(body.encode("utf-8")), "abc")
+        body = json.dumps({"msg": {"a": 1}, "msg_id": "abc"}, indent=2)
+        self.assertEqual(self._extract(body.encode("utf-8")), "abc")
+
+    def test_nested(self):
+        """Assert nested IDs are not mistaken for the top-level one."""
+        body = b'{"msg": {"msg_id": "nested", "a": 1}, "topic": "t"}'
+        self.assertIsNone(self._extract(body, fast=False))
+        body = b'{"topic": "t", "msg": {"a": 1, "msg_id": "nested"}}'
+        self.assertIsNone(self._extract(body, fast=False))
+
+    def test_several(self):
+        """Assert messages with several IDs are decoded."""
+        body = b'{"msg": {"msg_id": "nested"}, "msg_id": "abc"}'
+        self.assertEqual(self._extract(body, fast=False), "abc")
+
+    def test_escaped(self):
+        """Assert IDs with escape sequences are decoded."""
+        body = b'{"msg": {}, "msg_id": "a\\u00e9c"}'
+        self.assertEqual(self._extract(body, fast=False), "a\u00e9c")
+
+    def test_in_string(self):
+        """Assert keys looking like an ID inside a string are not used."""
+        body = b'{"msg": "\\"msg_id\\": \\"x\\"", "topic": "t"}'
+        self.assertIsNone(self._extract(body, fast=False))
+
+    def test_not_an_object(self):
+        """Assert JSON values other than objects have no ID."""
+        self.assertIsNone(self._extract(b'["msg_id"]', fast=False))
+
+    def test_invalid(self):
+        """Assert invalid messages raise a ValueError."""
+        self.assertRaises(ValueError, matching.extract_msg_id, b'{"msg_id": "a"')
+        self.assertRaises(ValueError, matching.extract_msg_id, b"\xff")
+
+
+class BodyDigestTests(unittest.TestCase):
+    """Tests for the :func:`matching.body_digest` function."""
+
+    def test_canonical(self):
+        """Assert digests don't depend on how the body was serialized."""
+        body = json.loads('{"b": [1, 2.5, "\\u00e9"], "a": {"y": null, "x": true}}')
+        other = json.loads('{"a":{"x":true,"y":null},"b":[1,2.5,"é"]}')
+        self.assertEqual(matching.body_digest(body), matching.body_digest(other))
+        self.assertEqual(len(matching.body_digest(body)), 16)
+
+    def test_different(self):
+        """Assert different bodies have different digests."""
+        self.assertNotEqual(
+            matching.body_digest({"a": "truncated"}),
+            matching.body_digest({"a": "truncate"}),
+        )
+
+
+class ShardTests(unittest.TestCase):
+    """Tests for the :class:`matching.Shard` class."""
+
+    def test_owns(self):
+        """Assert each message belongs to exactly one shard."""
+        shards = [matching.Shard(index, 4) for index in range(4)]
+        counts = [0] * 4
+        for i in range(1000):
+            msg_id = "2019-{}".format(i)
+            owners = [shard for shard in shards if shard.owns(msg_id)]
+            self.assertEqual(len(owners), 1)
+            self.assertTrue(owners[0].owns(msg_id[5:]))
+            counts[owners[0].index] += 1
+        self.assertTrue(all(count > 200 for count in counts))
+
+    def test_no_id(self):
+        """Assert messages without an ID belong to the first shard."""
+        self.assertTrue(matching.Shard(0, 2).owns(None))
+        self.assertFalse(matching.Shard(1, 2).owns(None))
+
+
+class MakeStoreTests(unittest.TestCase):
+    """Tests for the :func:`matching.make_store` function."""
+
+    def test_spill_path(self):
+        """Assert each side, and each shard, spills to its own file."""
+        store_config = dict(
+            config.DEFAULTS["verify_missing"]["store"], spill_path="/tmp/spill"
+        )
+        with mock.patch.dict(
+            "fedmsg_migration_tools.matching.config.conf",
+            {"verify_missing": {"store": store_config}},
+        ):
+            paths = [
+                matching.make_store(side, shard).spill.path
+                for side in ("amqp", "zmq")
+                for shard in (None, matching.Shard(1, 2))
+            ]
+
+        self.assertEqual(
+            paths,
+            [
+                "/tmp/spill.amqp",
+                "/tmp/spill.amqp.1",
+                "/tmp/spill.zmq",
+                "/tmp/spill.zmq.1",
+            ],
+        )
+
+
+class MatcherTests(unittest.TestCase):
+    """Tests for the :class:`matching.Matcher` class."""
+
+    def setUp(self):
+        self.amqp_store = Store()
+        self.zmq_store = Store()
+        self.matcher = matching.Matcher(self.amqp_store, self.zmq_store)
+
+    def test_received_no_match(self):
+        """Assert a message not received on the other side yet is stored."""
+        value = Record("dummy.topic")
+        self.matcher.received(self.amqp_store, "dummy-msgid", value)
+        self.assertEqual(self.amqp_store, {"dummy-msgid": value})
+        self.assertEqual(self.zmq_store, {})
+
+    def test_received_match(self):
+        """Assert a message already received on the other side is resolved."""
+        value = Record("dummy.topic")
+        self.zmq_store["dummy-msgid"] = value
+        self.matcher.received(self.amqp_store, "dummy-msgid", value)
+        self.assertEqual(self.amqp_store, {})
+        self.assertEqual(self.zmq_store, {})
+
+    def test_received_duplicate(self):
+        """Assert a message received twice on the same side is counted once."""
+        self.matcher.received(self.amqp_store, "dummy-msgid", Record("dummy.topic"))
+        self.matcher.received(self.amqp_store, "dummy-msgid", Record("dummy.topic"))
+        self.assertEqual(len(self.amqp_store), 1)
+        summary = self.matcher.stats.summary()
+        self.assertEqual(summary["total"]["duplicates"], {"AMQP": 1})
+
+    def test_check_missing_clock(self):
+        """Assert the matcher's clock is used to expire messages."""
+        self.matcher.clock = lambda: 1000
+        self.amqp_store["old-msgid"] = Record("dummy.topic", 1000 - 61)
+        self.amqp_store["new-msgid"] = Record("dummy.topic", 1000 - 59)
+        with self.assertLogs(LOGGER, logging.WARNING):
+            self.matcher.check_missing()
+        self.assertEqual(list(self.amqp_store), ["new-msgid"])
+
+    def test_state(self):
+        """Assert the messages waiting are logged, and unlogged once resolved."""
+        self.matcher.state = state = mock.Mock()
+        self.matcher.received(self.amqp_store, "msg-0", Record("dummy.topic"))
+        self.matcher.received(self.amqp_store, "msg-1", Record("dummy.topic"))
+        self.matcher.received(self.zmq_store, "msg-0", Record("dummy.topic"))
+        self.assertEqual(
+            [c[0][:3] for c in state.added.call_args_list],
+            [("amqp", "msg-0", "dummy.topic"), ("amqp", "msg-1", "dummy.topic")],
+        )
+        state.removed.assert_called_once_with("amqp", "msg-0")
+        self.amqp_store["msg-1"].received -= self.matcher.MATCH_WINDOW + 1
+        with self.assertLogs(LOGGER, logging.WARNING):
+            self.matcher.check_missing()
+        state.removed.assert_called_with("amqp", "msg-1")
+
+    def test_state_overflowed(self):
+        """Assert the messages dropped by a full store are unlogged."""
+        self.matcher.state = state = mock.Mock()
+        self.matcher.amqp_store = store = Store(max_entries=100)
+        for i in range(101):
+            self.matcher.received(store, "msg-{}".format(i), Record("dummy.topic"))
+
+        self.assertEqual(state.added.call_count, 101)
+        self.assertEqual(
+            state.removed.call_args_list,
+            [mock.call("amqp", "msg-0"), mock.call("amqp", "msg-1")],
+        )
+        self.assertNotIn("msg-1", store)
+
+    def test_restore_overflowed(self):
+        """Assert the restored messages a full store drops are unlogged."""
+        self.matcher.clock = lambda: 1000
+        self.matcher.state = state = mock.Mock()
+        self.matcher.zmq_store = Store(max_entries=100)
+        now = time.time()
+        state.load.return_value = OrderedDict(
+            (("zmq", "msg-{}".format(i)), ("dummy.topic", now - 30 + i / 10, None))
+            for i in range(101)
+        )
+        with self.assertLogs(LOGGER, logging.INFO):
+            self.matcher.restore()
+
+        self.assertEqual(len(self.matcher.zmq_store), 99)
+        self.assertEqual(
+            state.removed.call_args_list,
+            [mock.call("zmq", "msg-0"), mock.call("zmq", "msg-1")],
+        )
+
+    def test_restore(self):
+        """Assert waiting messages are restored, aged by the time stopped."""
+        self.matcher.clock = lambda: 1000
+        self.matcher.state = state = mock.Mock()
+        now = time.time()
+        state.load.return_value = OrderedDict(
+            [
+                (("amqp", "old-msgid"), ("dummy.topic", now - 61, None)),
+                (("zmq", "new-msgid"), ("dummy.topic", now - 30, b"digest")),
+            ]
+        )
+        with self.assertLogs(LOGGER, logging.INFO) as logs:
+            self.matcher.restore()
+        self.assertEqual(self.amqp_store, {})
+        self.assertEqual(list(self.zmq_store), ["new-msgid"])
+        record = self.zmq_store["new-msgid"]
+        self.assertAlmostEqual(record.received, 970, delta=1)
+        self.assertEqual(record.digest, b"digest")
+        state.removed.assert_called_once_with("amqp", "old-msgid")
+        self.assertIn("Restored 1 messages", logs.output[0])
+        self.assertIn("1 more expired", logs.output[0])
+
+    def test_match_window(self):
+        """Assert messages are expired after the configured match window."""
+        self.matcher.match_window = 5
+        self.matcher.clock = lambda: 1000
+        self.amqp_store["old-msgid"] = Record("dummy.topic", 1000 - 6)
+        self.amqp_store["new-msgid"] = Record("dummy.topic", 1000 - 4)
+        with self.assertLogs(LOGGER, logging.WARNING):
+            self.matcher.check_missing()
+        self.assertEqual(list(self.amqp_store), ["new-msgid"])
+
+    def _observe(self, matcher, latencies):
+        for i, latency in enumerate(latencies):
+            msg_id = "msg-{}".format(i)
+            matcher.received(matcher.amqp_store, msg_id, Record("dummy.topic", 0))
+            matcher.received(matcher.zmq_store, msg_id, Record("dummy.topic", latency))
+
+    def test_adapt_window_fixed(self):
+        """Assert the match window doesn't change unless it is adaptive."""
+        self._observe(self.matcher, [0.1] * 2000)
+        self.assertIsNone(self.matcher.adapt_window())
+        self.assertEqual(self.matcher.match_window, 60)
+
+    def test_adapt_window(self):
+        """Assert the adaptive match window follows the latency quantile."""
+        matcher = matching.Matcher(
+            Store(), Store(), window_bounds=(1, 300), window_factor=2
+        )
+        self._observe(matcher, [0.1] * 995 + [5] * 5)
+        with self.assertLogs(LOGGER, logging.INFO) as logs:
+            window = matcher.adapt_window()
+        self.assertAlmostEqual(window, 10, delta=0.3)
+        self.assertEqual(matcher.match_window, window)
+        self.assertIn("Adapted the match window from 60.0s", logs.output[0])
+        # The latencies are only used once
+        self.assertEqual(matcher.adapt_window(), window)
+
+    def test_adapt_window_bounds(self):
+        """Assert the adaptive match window stays within its bounds."""
+        matcher = matching.Matcher(Store(), Store(), window_bounds=(2, 30))
+        self._observe(matcher, [0.01] * 1000)
+        self.assertEqual(matcher.adapt_window(), 2)
+        self._observe(matcher, [100] * 1000)
+        self.assertEqual(matcher.adapt_window(), 30)
+
+    def test_adapt_window_not_enough_samples(self):
+        """Assert the match window is kept until enough latencies are observed."""
+        matcher = matching.Matcher(Store(), Store(), window_bounds=(1, 300))
+        self._observe(matcher, [0.1] * 10)
+        self.assertEqual(matcher.adapt_window(), 60)
+
+    def test_adapt_window_missing(self):
+        """Assert the adaptive match window widens when messages go missing."""
+        matcher = matching.Matcher(
+            Store(), Store(), window_bounds=(1, 300), clock=lambda: 1000
+        )
+        matcher.match_window = 10
+        self._observe(matcher, [0.1] * 990)
+        for i in range(10):
+            matcher.amqp_store["lost-{}".format(i)] = Record("dummy.topic", 0)
+        with self.assertLogs(LOGGER, logging.WARNING):
+            matcher.check_missing()
+        self.assertGreater(matcher.adapt_window(), 10)
+
+    def test_report_match_window(self):
+        """Assert the adaptive match window is included in the reports."""
+        matcher = matching.Matcher(Store(), Store(), window_bounds=(1, 300))
+        summary = matcher.report()
+        self.assertEqual(summary["match_window"], 60)
+
+    def test_remove_matching(self):
+        """Assert the safety net still resolves entries added directly."""
+        value = Record("dummy.topic")
+        self.amqp_store["dummy-msgid"] = value
+        self.zmq_store["dummy-msgid"] = value
+        self.amqp_store["other-msgid"] = value
+        self.matcher.remove_matching()
+        self.assertEqual(list(self.amqp_store), ["other-msgid"])
+        self.assertEqual(self.zmq_store, {})
+
+    def test_check_missing(self):
+        """Assert only the messages older than the match window are reported."""
+        now = time.monotonic()
+        old = now - self.matcher.MATCH_WINDOW - 1
+        self.amqp_store["old-msgid"] = Record("dummy.topic", old)
+        self.amqp_store["new-msgid"] = Record("dummy.topic", now)
+        self.zmq_store["other-msgid"] = Record("dummy.topic", old)
+        with self.assertLogs(LOGGER, logging.WARNING) as logs:
+            self.matcher.check_missing()
+        self.assertEqual(list(self.amqp_store), ["new-msgid"])
+        self.assertEqual(list(self.zmq_store), [])
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("old-msgid was only received in AMQP", logs.output[0])
+        self.assertIn("other-msgid was only received in ZeroMQ", logs.output[1])
+        summary = self.matcher.stats.summary()
+        self.assertEqual(summary["total"]["missing"], {"AMQP": 1, "ZeroMQ": 1})
+
+    def test_check_missing_overflowed(self):
+        """Assert the overflowed entries are reported by topic."""
+        self.amqp_store.overflowed = {"dummy.topic": 3}
+        with self.assertLogs(LOGGER, logging.WARNING) as logs:
+            self.matcher.check_missing()
+        self.assertEqual(
+            logs.output,
+            [
+                "WARNING:fedmsg_migration_tools.matching:3 messages with topic "
+                "dummy.topic overflowed the AMQP store and could not be checked"
+            ],
+        )
+        self.assertEqual(self.amqp_store.overflowed, {})
+
+    def test_received_match_spilled(self):
+        """Assert a message spilled on the other side is still matched."""
+        self.zmq_store.spill = SpillStore()
+        self.zmq_store.max_entries = 1
+        self.zmq_store["dummy-msgid"] = Record("dummy.topic")
+        self.zmq_store["other-msgid"] = Record("dummy.topic")
+        self.assertIn("dummy-msgid", self.zmq_store.spill)
+        self.matcher.received(self.amqp_store, "dummy-msgid", Record("dummy.topic"))
+        self.assertNotIn("dummy-msgid", self.zmq_store)
+        self.assertEqual(self.amqp_store, {})
+
+    def test_received_match_latency(self):
+        """Assert the delay between both receptions is recorded."""
+        self.zmq_store["dummy-msgid"] = Record("dummy.topic", 10)
+        self.matcher.received(
+            self.amqp_store, "dummy-msgid", Record("dummy.topic", 10.5)
+        )
+        summary = self.matcher.stats.summary()
+        self.assertEqual(summary["total"]["matched"], 1)
+        self.assertEqual(summary["total"]["latency"]["max"], 0.5)
+
+    def test_received_match_digests(self):
+        """Assert messages received with different bodies are reported."""
+        self.zmq_store["same"] = Record("dummy.topic", digest=b"1")
+        self.zmq_store["different"] = Record("dummy.topic", digest=b"1")
+        self.zmq_store["unknown"] = Record("dummy.topic", digest=b"1")
+        self.matcher.received(
+            self.amqp_store, "same", Record("dummy.topic", digest=b"1")
+        )
+        self.matcher.received(self.amqp_store, "unknown", Record("dummy.topic"))
+        with self.assertLogs(LOGGER, logging.WARNING) as logs:
+            self.matcher.received(
+                self.amqp_store, "different", Record("dummy.topic", digest=b"2")
+            )
+        self.assertIn("different bodies", logs.output[0])
+        summary = self.matcher.stats.summary()
+        self.assertEqual(summary["total"]["matched"], 3)
+        self.assertEqual(summary["total"]["mismatched"], 1)
+
+    def test_report(self):
+        """Assert reports are logged, written to a file, and reset the statistics."""
+        self.matcher.stats.matched("dummy.topic", 0.1)
+        self.matcher.stats.missing("dummy.topic", "AMQP")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.matcher.report_file = os.path.join(tmpdir, "report.json")
+            with self.assertLogs(LOGGER, logging.INFO) as logs:
+                self.matcher.report()
+            with open(self.matcher.report_file) as fd:
+                report = json.load(fd)
+        self.assertEqual(report["total"]["matched"], 1)
+        self.assertEqual(report["total"]["missing"], {"AMQP": 1})
+        self.assertEqual(
+            logs.output,
+            [
+                "INFO:fedmsg_migration_tools.matching:Bridge report: 1 matched, "
+                "1 only in AMQP, latency p50=100ms p99=100ms max=100ms"
+            ],
+        )
+        self.assertEqual(self.matcher.stats.topics, {})
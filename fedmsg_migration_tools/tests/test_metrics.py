@@ -0,0 +1,175 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import datetime
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from fedmsg_migration_tools import metrics
+
+
+class HistogramTests(unittest.TestCase):
+    """Tests for the :class:`metrics.Histogram` class."""
+
+    def test_empty(self):
+        """Assert empty histograms have no quantiles."""
+        histogram = metrics.Histogram()
+        self.assertIsNone(histogram.quantile(0.5))
+        self.assertEqual(histogram.summary(), {})
+
+    def test_quantiles(self):
+        """Assert quantiles are estimated within the expected relative error."""
+        rand = random.Random(42)
+        values = [rand.uniform(0.001, 10) for __ in range(10000)]
+        histogram = metrics.Histogram()
+        for value in values:
+            histogram.add(value)
+        values.sort()
+        for q in (0.5, 0.9, 0.99, 1):
+            expected = values[int(q * len(values)) - 1]
+            self.assertAlmostEqual(
+                histogram.quantile(q), expected, delta=expected * 0.05
+            )
+        self.assertEqual(histogram.max, values[-1])
+
+    def test_small_values(self):
+        """Assert values below the minimum are all counted in the first bucket."""
+        histogram = metrics.Histogram()
+        histogram.add(0)
+        histogram.add(0.00001)
+        self.assertEqual(histogram.buckets, {0: 2})
+        self.assertEqual(histogram.quantile(0.5), 0.00001)
+
+    def test_merge(self):
+        """Assert merged histograms count the values of both."""
+        histogram1 = metrics.Histogram()
+        histogram2 = metrics.Histogram()
+        histogram1.add(1)
+        histogram2.add(1)
+        histogram2.add(100)
+        histogram1.merge(histogram2)
+        self.assertEqual(histogram1.count, 3)
+        self.assertEqual(histogram1.max, 100)
+        self.assertEqual(histogram1.total, 102)
+        self.assertAlmostEqual(histogram1.quantile(0.5), 1, delta=0.05)
+
+    def test_serialization(self):
+        """Assert histograms survive a trip through JSON."""
+        histogram = metrics.Histogram()
+        for value in (0.01, 0.5, 3):
+            histogram.add(value)
+        data = json.loads(json.dumps(histogram.to_dict()))
+        copy = metrics.Histogram.from_dict(data)
+        self.assertEqual(copy.buckets, histogram.buckets)
+        self.assertEqual(copy.summary(), histogram.summary())
+
+
+class MatchStatsTests(unittest.TestCase):
+    """Tests for the :class:`metrics.MatchStats` class."""
+
+    def test_summary(self):
+        """Assert statistics are grouped by topic prefix."""
+        stats = metrics.MatchStats(prefix_depth=2)
+        stats.matched("org.fedoraproject.prod.bodhi", 0.5)
+        stats.matched("org.fedoraproject.prod.copr", -1.5)
+        stats.matched("org.centos.prod.ci", 0.1)
+        stats.missing("org.centos.prod.ci", "AMQP")
+        stats.duplicate("org.centos.prod.ci", "ZeroMQ")
+        stats.mismatched("org.centos.prod.ci")
+
+        summary = stats.summary()
+
+        self.assertEqual(set(summary["topics"]), {"org.fedoraproject", "org.centos"})
+        fedora = summary["topics"]["org.fedoraproject"]
+        self.assertEqual(fedora["matched"], 2)
+        self.assertEqual(fedora["missing"], {})
+        self.assertEqual(fedora["latency"]["max"], 1.5)
+        centos = summary["topics"]["org.centos"]
+        self.assertEqual(centos["missing"], {"AMQP": 1})
+        self.assertEqual(centos["duplicates"], {"ZeroMQ": 1})
+        self.assertEqual(centos["mismatched"], 1)
+        self.assertEqual(fedora["mismatched"], 0)
+        self.assertEqual(summary["total"]["mismatched"], 1)
+        self.assertEqual(summary["total"]["matched"], 3)
+        self.assertEqual(summary["total"]["missing"], {"AMQP": 1})
+        self.assertEqual(summary["total"]["latency"]["max"], 1.5)
+        json.dumps(summary)
+
+    def test_reset(self):
+        """Assert resetting the statistics starts a new period."""
+        stats = metrics.MatchStats()
+        stats.missing("dummy.topic", "AMQP")
+        stats.reset()
+        self.assertEqual(stats.summary()["topics"], {})
+
+    def test_merge(self):
+        """Assert statistics are merged, including through serialization."""
+        stats = metrics.MatchStats()
+        stats.matched("dummy.topic", 0.5)
+        stats.missing("dummy.topic", "AMQP")
+        other = metrics.MatchStats()
+        other.started = stats.started - datetime.timedelta(seconds=1)
+        other.matched("dummy.topic", 1.5)
+        other.mismatched("dummy.topic")
+        other.duplicate("other.topic", "ZeroMQ")
+
+        stats.merge(
+            metrics.MatchStats.from_dict(json.loads(json.dumps(other.to_dict())))
+        )
+
+        self.assertEqual(stats.started, other.started)
+        summary = stats.summary()
+        self.assertEqual(summary["total"]["matched"], 2)
+        self.assertEqual(summary["total"]["mismatched"], 1)
+        self.assertEqual(summary["total"]["missing"], {"AMQP": 1})
+        self.assertEqual(summary["total"]["duplicates"], {"ZeroMQ": 1})
+        self.assertEqual(summary["topics"]["dummy.topic"]["latency"]["max"], 1.5)
+
+    def test_format_summary(self):
+        """Assert summaries are formatted on a single line."""
+        stats = metrics.MatchStats()
+        stats.matched("dummy.topic", 0.25)
+        stats.missing("dummy.topic", "ZeroMQ")
+        stats.duplicate("dummy.topic", "ZeroMQ")
+        self.assertEqual(
+            metrics.format_summary(stats.summary()),
+            "1 matched, 1 only in ZeroMQ, 1 duplicates, "
+            "latency p50=250ms p99=250ms max=250ms",
+        )
+        stats.mismatched("dummy.topic")
+        self.assertTrue(
+            metrics.format_summary(stats.summary()).startswith(
+                "1 matched, 1 with different bodies, 1 only in ZeroMQ"
+            )
+        )
+
+
+class WriteJsonTests(unittest.TestCase):
+    """Tests for the :func:`metrics.write_json` function."""
+
+    def test_write_json(self):
+        """Assert the file is replaced and no temporary file is left over."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "report.json")
+            metrics.write_json(path, {"a": 1})
+            metrics.write_json(path, {"b": 2})
+            with open(path) as fd:
+                self.assertEqual(json.load(fd), {"b": 2})
+            self.assertEqual(os.listdir(tmpdir), ["report.json"])
@@ -0,0 +1,87 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time
+import unittest
+
+import mock
+import zmq
+
+from fedmsg_migration_tools import monitor
+
+
+class SocketOptionsTests(unittest.TestCase):
+    def test_socket_options(self):
+        """Assert only the socket options are picked, sorted by name."""
+        settings = {"endpoint": "tcp://a:1", "rcvhwm": 10, "reconnect_ivl": 100}
+        settings["heartbeat_ivl"] = 0
+        self.assertEqual(
+            monitor.socket_options(settings),
+            (("heartbeat_ivl", 0), ("reconnect_ivl", 100)),
+        )
+
+    def test_set_socket_options(self):
+        """Assert the options are set on the socket."""
+        sub = mock.Mock()
+        monitor.set_socket_options(sub, (("reconnect_ivl_max", 1000),))
+        sub.setsockopt.assert_called_once_with(zmq.RECONNECT_IVL_MAX, 1000)
+
+
+class SocketMonitorTests(unittest.TestCase):
+    def test_handle_event(self):
+        """Assert the connections, disconnections and retries are counted."""
+        socket_monitor = monitor.SocketMonitor(mock.Mock(), "test")
+        with self.assertLogs(monitor._log.name, "DEBUG") as logs:
+            socket_monitor.handle_event(zmq.EVENT_CONNECT_RETRIED, b"tcp://a:1")
+            socket_monitor.handle_event(zmq.EVENT_CONNECTED, b"tcp://a:1")
+            socket_monitor.handle_event(zmq.EVENT_DISCONNECTED, b"tcp://a:1")
+            socket_monitor.handle_event(zmq.EVENT_CONNECTED, b"tcp://a:1")
+
+        stats = socket_monitor.stats()
+        self.assertTrue(stats["connected"])
+        self.assertEqual(stats["connects"], 2)
+        self.assertEqual(stats["disconnects"], 1)
+        self.assertEqual(stats["retries"], 1)
+        self.assertEqual(stats["last_event"], "connected")
+        self.assertIn("WARNING", logs.output[2])
+
+    def test_events(self):
+        """Assert the events of a real socket are received."""
+        context = zmq.Context.instance()
+        publisher = context.socket(zmq.PUB)
+        port = publisher.bind_to_random_port("tcp://127.0.0.1")
+        sub = context.socket(zmq.SUB)
+        self.addCleanup(sub.close, linger=0)
+        monitor.set_socket_options(sub, (("reconnect_ivl", 10),))
+        socket_monitor = monitor.SocketMonitor(sub, "test")
+        self.addCleanup(socket_monitor.close)
+        sub.connect("tcp://127.0.0.1:{}".format(port))
+
+        def wait_for(condition):
+            deadline = time.monotonic() + 5
+            while not condition() and time.monotonic() < deadline:
+                if socket_monitor.socket.poll(100):
+                    socket_monitor.handle_events()
+            self.assertTrue(condition())
+
+        wait_for(lambda: socket_monitor.connected)
+        publisher.close(linger=0)
+        wait_for(lambda: socket_monitor.retries > 0)
+
+        self.assertFalse(socket_monitor.connected)
+        self.assertEqual(socket_monitor.connects, 1)
+        self.assertEqual(socket_monitor.disconnects, 1)
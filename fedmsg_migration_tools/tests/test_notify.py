@@ -0,0 +1,151 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import socket
+import tempfile
+import unittest
+
+import mock
+
+from fedmsg_migration_tools import notify
+from fedmsg_migration_tools.tests import Clock
+
+
+class NotifierTests(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "notify")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(self.sock.close)
+        self.sock.bind(self.path)
+        self.sock.settimeout(1)
+
+    def test_notify(self):
+        """Assert the assignments are sent together to the notification socket."""
+        notifier = notify.Notifier({"NOTIFY_SOCKET": self.path})
+
+        self.assertTrue(notifier.enabled)
+        self.assertTrue(notifier.ready("Up"))
+        self.assertEqual(self.sock.recv(4096), b"READY=1\nSTATUS=Up")
+        notifier.watchdog()
+        self.assertEqual(self.sock.recv(4096), b"WATCHDOG=1")
+
+    def test_disabled(self):
+        """Assert nothing is sent outside of systemd."""
+        notifier = notify.Notifier({})
+
+        self.assertFalse(notifier.enabled)
+        self.assertFalse(notifier.stopping())
+        self.assertIsNone(notifier.watchdog_interval)
+
+    def test_abstract_socket(self):
+        """Assert a leading @ names an abstract socket."""
+        notifier = notify.Notifier({"NOTIFY_SOCKET": "@notify"})
+
+        self.assertEqual(notifier.address, "\0notify")
+
+    def test_send_error(self):
+        """Assert a failure to notify is logged, not raised."""
+        notifier = notify.Notifier({"NOTIFY_SOCKET": self.path + ".missing"})
+
+        with self.assertLogs(notify._log.name, "WARNING"):
+            self.assertFalse(notifier.status("Up"))
+
+    def test_watchdog_interval(self):
+        """Assert the watchdog is pinged twice per timeout, for this process only."""
+        environ = {"NOTIFY_SOCKET": self.path, "WATCHDOG_USEC": "30000000"}
+
+        self.assertEqual(notify.Notifier(environ).watchdog_interval, 15)
+        environ["WATCHDOG_PID"] = str(os.getpid() + 1)
+        self.assertIsNone(notify.Notifier(environ).watchdog_interval)
+
+
+class WatchdogTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.notifier = mock.Mock(enabled=True, watchdog_interval=10)
+        self.watchdog = notify.Watchdog(
+            self.notifier, status_interval=5, clock=self.clock
+        )
+
+    def test_idle(self):
+        """Assert the watchdog is pinged while there is nothing to do."""
+        for _ in range(3):
+            self.watchdog.tick(0)
+            self.clock.now += 10
+
+        self.assertEqual(self.notifier.watchdog.call_count, 3)
+
+    def test_progress(self):
+        """Assert the watchdog is pinged while messages are processed."""
+        for processed in range(3):
+            self.watchdog.tick(processed, waiting=5)
+            self.clock.now += 10
+
+        self.assertEqual(self.notifier.watchdog.call_count, 3)
+
+    def test_stuck(self):
+        """Assert the pings are withheld while messages wait and none is processed."""
+        self.watchdog.tick(1, waiting=5)
+        self.clock.now += 10
+        with self.assertLogs(notify._log.name, "WARNING") as logs:
+            for _ in range(3):
+                self.watchdog.tick(1, waiting=5)
+                self.clock.now += 10
+        self.watchdog.tick(2, waiting=5)
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertEqual(self.notifier.watchdog.call_count, 2)
+
+    def test_held(self):
+        """Assert the watchdog is pinged while messages are only held back."""
+        with mock.patch.object(notify._log, "warning") as warning:
+            for _ in range(5):
+                self.watchdog.tick(1, held=5)
+                self.clock.now += 10
+
+        self.assertEqual(self.notifier.watchdog.call_count, 5)
+        warning.assert_not_called()
+        self.notifier.status.assert_called_with(
+            "0.0 messages/s, 0 waiting, 5 held back"
+        )
+
+    def test_status(self):
+        """Assert the throughput and the messages waiting are reported."""
+        self.watchdog.tick(0)
+        self.clock.now += 5
+        self.watchdog.tick(50, waiting=3)
+        self.clock.now += 1
+        self.watchdog.tick(60, waiting=3)
+
+        self.assertEqual(
+            self.notifier.status.call_args_list,
+            [
+                mock.call("0.0 messages/s, 0 waiting"),
+                mock.call("10.0 messages/s, 3 waiting"),
+            ],
+        )
+
+    def test_disabled(self):
+        """Assert nothing is sent outside of systemd."""
+        self.notifier.enabled = False
+
+        self.watchdog.tick(0)
+
+        self.assertEqual(self.notifier.mock_calls, [])
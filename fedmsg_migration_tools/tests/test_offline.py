@@ -0,0 +1,164 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import bz2
+import gzip
+import json
+import logging
+import lzma
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from fedmsg_migration_tools import offline
+from fedmsg_migration_tools.store import Store
+
+
+class ReadLogTests(unittest.TestCase):
+    """Tests for the :func:`offline.read_log` function."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _write(self, name, lines, opener=open):
+        path = os.path.join(self.tmpdir, name)
+        with opener(path, "wt") as fd:
+            for line in lines:
+                fd.write(line + "\n")
+        return path
+
+    def test_compression(self):
+        """Assert compressed logs are decompressed according to their extension."""
+        line = json.dumps({"received": 1.5, "msg_id": "2019-abc", "topic": "t"})
+        for name, opener in (
+            ("log.jsonl", open),
+            ("log.jsonl.gz", gzip.open),
+            ("log.jsonl.bz2", bz2.open),
+            ("log.jsonl.xz", lzma.open),
+        ):
+            path = self._write(name, [line], opener)
+            self.assertEqual(list(offline.read_log(path)), [(1.5, "abc", "t")])
+
+    def test_fedmsg(self):
+        """Assert plain fedmsg messages use their timestamp as reception time."""
+        msg = {"timestamp": 10, "msg_id": "2019-abc", "topic": "t", "msg": {}}
+        path = self._write("log.jsonl", [json.dumps(msg)])
+        self.assertEqual(list(offline.read_log(path)), [(10, "abc", "t")])
+
+    def test_invalid_lines(self):
+        """Assert invalid lines are skipped."""
+        lines = [
+            "{",
+            json.dumps({"received": 1, "topic": "t"}),
+            json.dumps({"msg_id": "abc", "topic": "t"}),
+            json.dumps(["not", "a", "dict"]),
+            "",
+            json.dumps({"received": 2, "msg_id": "abc", "topic": "t"}),
+        ]
+        path = self._write("log.jsonl", lines)
+        with self.assertLogs("fedmsg_migration_tools.offline", logging.WARNING) as logs:
+            self.assertEqual(list(offline.read_log(path)), [(2, "abc", "t")])
+        self.assertEqual(len(logs.output), 4)
+
+    @mock.patch("fedmsg_migration_tools.offline.zstandard", None)
+    def test_zstd_missing(self):
+        """Assert a helpful error is raised if zstandard is not installed."""
+        path = self._write("log.jsonl.zst", [])
+        self.assertRaises(ValueError, list, offline.read_log(path))
+
+
+class VerifyTests(unittest.TestCase):
+    """Tests for the :func:`offline.verify` function."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _write(self, name, messages):
+        path = os.path.join(self.tmpdir, name)
+        with gzip.open(path, "wt") as fd:
+            for received, msg_id, topic in messages:
+                entry = {"received": received, "msg_id": msg_id, "topic": topic}
+                fd.write(json.dumps(entry) + "\n")
+        return path
+
+    def test_verify(self):
+        """Assert missing messages, duplicates and latencies are reported."""
+        amqp_log = self._write(
+            "amqp.jsonl.gz",
+            [
+                (100, "a", "org.fedoraproject.prod.bodhi.update"),
+                (101, "b", "org.fedoraproject.prod.copr.build"),
+                (101, "b", "org.fedoraproject.prod.copr.build"),
+                (300, "late", "org.fedoraproject.prod.copr.build"),
+            ],
+        )
+        zmq_log = self._write(
+            "zmq.jsonl.gz",
+            [
+                (100.5, "2019-a", "org.fedoraproject.prod.bodhi.update"),
+                (102, "c", "org.fedoraproject.prod.copr.build"),
+                (103, "2019-b", "org.fedoraproject.prod.copr.build"),
+                (200, "late", "org.fedoraproject.prod.copr.build"),
+            ],
+        )
+        report_file = os.path.join(self.tmpdir, "report.json")
+
+        with self.assertLogs("fedmsg_migration_tools.matching", logging.INFO) as logs:
+            summary = offline.verify(amqp_log, zmq_log, report_file=report_file)
+
+        total = summary["total"]
+        self.assertEqual(total["matched"], 2)
+        self.assertEqual(total["missing"], {"AMQP": 1, "ZeroMQ": 2})
+        self.assertEqual(total["duplicates"], {"AMQP": 1})
+        self.assertEqual(total["latency"]["max"], 2)
+        bodhi = summary["topics"]["org.fedoraproject.prod.bodhi"]
+        self.assertEqual(bodhi["matched"], 1)
+        self.assertAlmostEqual(bodhi["latency"]["max"], 0.5)
+        self.assertIn(
+            "Message late was only received in ZeroMQ (at 1970-01-01T00:03:20",
+            "\n".join(logs.output),
+        )
+        with open(report_file) as fd:
+            self.assertEqual(json.load(fd)["total"]["matched"], 2)
+
+    def test_bounded_memory(self):
+        """Assert only the messages of the match window are kept in memory."""
+        amqp_log = self._write(
+            "amqp.jsonl.gz", [(i, "a-{}".format(i), "t") for i in range(5000)]
+        )
+        zmq_log = self._write(
+            "zmq.jsonl.gz", [(i, "z-{}".format(i), "t") for i in range(5000)]
+        )
+        sizes = []
+
+        class MeasuredStore(Store):
+            def add(self, msg_id, record):
+                dropped = Store.add(self, msg_id, record)
+                sizes.append(len(self))
+                return dropped
+
+        with mock.patch("fedmsg_migration_tools.offline.Store", MeasuredStore):
+            with self.assertLogs("fedmsg_migration_tools.matching", logging.INFO):
+                summary = offline.verify(amqp_log, zmq_log)
+
+        self.assertEqual(summary["total"]["missing"], {"AMQP": 5000, "ZeroMQ": 5000})
+        self.assertLessEqual(max(sizes), offline.OfflineMatcher.MATCH_WINDOW + 2)
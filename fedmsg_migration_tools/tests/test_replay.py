@@ -0,0 +1,234 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import zmq
+
+from fedmsg_migration_tools import capture, replay
+
+
+class RecordingPublisher(replay.Publisher):
+    """A publisher remembering what it published."""
+
+    def __init__(self):
+        super(RecordingPublisher, self).__init__()
+        self.messages = []
+
+    def publish(self, topic, body):
+        if topic == b"fail":
+            raise ValueError("failed")
+        self.messages.append((topic, json.loads(body.decode("utf-8"))))
+
+
+class ToFedmsgTests(unittest.TestCase):
+    """Tests for the :func:`replay.to_fedmsg` function."""
+
+    def test_fedmsg(self):
+        """Assert exported fedmsg messages are used as they are."""
+        msg = {"topic": "t", "timestamp": 10, "msg_id": "2019-a", "msg": {}}
+        self.assertEqual(replay.to_fedmsg(msg), (10.0, "t", msg))
+
+    def test_zmq_capture(self):
+        """Assert messages captured from ZeroMQ are the capture body."""
+        body = {"topic": "t", "timestamp": 10, "msg_id": "2019-a", "msg": {}}
+        entry = {"received": 11.5, "topic": "t", "msg_id": "2019-a", "body": body}
+        self.assertEqual(replay.to_fedmsg(entry), (11.5, "t", body))
+
+    def test_amqp_capture(self):
+        """Assert messages captured from AMQP are wrapped in the fedmsg format."""
+        entry = {
+            "received": 11.5,
+            "topic": "t",
+            "msg_id": "a",
+            "headers": {"h": 1},
+            "body": {"b": 2},
+        }
+        self.assertEqual(
+            replay.to_fedmsg(entry),
+            (
+                11.5,
+                "t",
+                {
+                    "topic": "t",
+                    "msg": {"b": 2},
+                    "timestamp": 11,
+                    "msg_id": "a",
+                    "headers": {"h": 1},
+                    "username": replay.REPLAY_USERNAME,
+                },
+            ),
+        )
+
+
+class ReadMessagesTests(unittest.TestCase):
+    """Tests for the :func:`replay.read_messages` function."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_export(self):
+        """Assert exported messages are read and filtered by time."""
+        path = os.path.join(self.tmpdir, "export.jsonl")
+        with open(path, "w") as fd:
+            for i in range(5):
+                msg = {"topic": "t", "timestamp": i, "msg_id": str(i), "msg": {}}
+                fd.write(json.dumps(msg) + "\n")
+            fd.write("{\n")
+            fd.write(json.dumps({"timestamp": 6}) + "\n")
+        with self.assertLogs("fedmsg_migration_tools.replay") as logs:
+            messages = list(replay.read_messages(path))
+        self.assertEqual([m[0] for m in messages], [0, 1, 2, 3, 4])
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(
+            [m[0] for m in replay.read_messages(path, start=1, end=3)], [1, 2]
+        )
+
+    def test_capture_range(self):
+        """Assert the capture indexes are used to read a time range."""
+        writer = capture.SegmentWriter(self.tmpdir, "zmq", block_size=10)
+        for i in range(30):
+            body = json.dumps({"topic": "t", "msg_id": str(i), "msg": {}})
+            writer.write(i, str(i), capture.format_entry(i, "t", str(i), body))
+        writer.close()
+        with mock.patch("fedmsg_migration_tools.replay._read_entries") as read_entries:
+            messages = list(replay.read_messages(self.tmpdir, start=12, end=14))
+        read_entries.assert_not_called()
+        self.assertEqual(
+            messages,
+            [
+                (12, "t", {"topic": "t", "msg_id": "12", "msg": {}}),
+                (13, "t", {"topic": "t", "msg_id": "13", "msg": {}}),
+            ],
+        )
+
+
+class ReplayTests(unittest.TestCase):
+    """Tests for the :func:`replay.replay` function."""
+
+    def _publishers(self, count):
+        publishers = [RecordingPublisher() for __ in range(count)]
+        for publisher in publishers:
+            publisher.start()
+        return publishers
+
+    def test_sharded_by_topic(self):
+        """Assert messages are spread over publishers, in order for each topic."""
+        messages = [(i, "topic.{}".format(i % 20), {"i": i}) for i in range(100)] + [
+            (100, "fail", {})
+        ]
+        publishers = self._publishers(3)
+        summary = replay.replay(messages, publishers, speed=0)
+
+        self.assertEqual(summary["published"], 100)
+        self.assertEqual(summary["failed"], 1)
+        self.assertEqual(summary["span"], 100)
+        self.assertTrue(all(publisher.messages for publisher in publishers))
+        for publisher in publishers:
+            topics = set(topic for topic, __ in publisher.messages)
+            for topic in topics:
+                indexes = [m["i"] for t, m in publisher.messages if t == topic]
+                self.assertEqual(indexes, sorted(indexes))
+        self.assertEqual(sum(len(publisher.messages) for publisher in publishers), 100)
+
+    def test_pace(self):
+        """Assert messages are handed out at the requested speed."""
+        messages = [(100, "t", {}), (110, "t", {}), (120, "t", {}), (121, "t", {})]
+        with mock.patch("fedmsg_migration_tools.replay.time") as mock_time:
+            mock_time.monotonic.side_effect = [0, 0, 0, 0, 15, 15]
+            summary = replay.replay(messages, self._publishers(1), speed=2)
+        self.assertEqual(
+            mock_time.sleep.call_args_list, [mock.call(5.0), mock.call(10.0)]
+        )
+        self.assertEqual(summary["lag"], 4.5)
+        self.assertEqual(summary["duration"], 15)
+        self.assertIn("1.4x real time", replay.format_summary(summary))
+
+
+class AmqpPublisherTests(unittest.TestCase):
+    """Tests for the :class:`replay.AmqpPublisher` class."""
+
+    @mock.patch("fedmsg_migration_tools.replay.bridges._convert_and_maybe_publish")
+    def test_failures(self, convert):
+        """Assert the messages that failed to publish or were dropped are counted."""
+        convert.side_effect = [True, False, None]
+        publisher = replay.AmqpPublisher("amq.topic")
+        publisher.start()
+
+        with self.assertLogs(replay._log.name, "ERROR") as logs:
+            summary = replay.replay([(i, "t", {}) for i in range(3)], [publisher], 0)
+
+        self.assertEqual((summary["published"], summary["failed"]), (1, 2))
+        self.assertIn("could not be published", logs.output[0])
+        self.assertIn("dropped", logs.output[1])
+
+    def test_abstract(self):
+        """Assert publishers must implement publish."""
+        self.assertRaises(TypeError, replay.Publisher)
+
+
+class ZmqReplayTests(unittest.TestCase):
+    """Tests for replaying messages to ZeroMQ."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_main(self):
+        """Assert messages reach the ZeroMQ subscribers through the proxy."""
+        path = os.path.join(self.tmpdir, "export.jsonl")
+        with open(path, "w") as fd:
+            for i in range(10):
+                msg = {"topic": "t{}".format(i), "timestamp": i, "msg_id": str(i)}
+                fd.write(json.dumps(msg) + "\n")
+        context = zmq.Context.instance()
+        sub_socket = context.socket(zmq.SUB)
+        self.addCleanup(sub_socket.close, linger=0)
+        sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        endpoint = "inproc://test-replay"
+
+        with mock.patch.object(replay.ZmqProxy, "start", autospec=True) as start:
+
+            def start_and_subscribe(proxy):
+                start.side_effect = None
+                replay.threading.Thread.start(proxy)
+                sub_socket.connect(endpoint)
+
+            start.side_effect = start_and_subscribe
+            summary = replay.main(
+                path,
+                publish_endpoint=endpoint,
+                speed=0,
+                publishers=2,
+                subscriber_delay=0.2,
+            )
+
+        self.assertEqual(summary["published"], 10)
+        received = []
+        while sub_socket.poll(100):
+            received.append(sub_socket.recv_multipart())
+        self.assertEqual(len(received), 10)
+        self.assertEqual(
+            sorted(json.loads(body)["msg_id"] for __, body in received),
+            [str(i) for i in range(10)],
+        )
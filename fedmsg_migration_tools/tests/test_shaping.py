@@ -0,0 +1,164 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest
+
+from fedmsg_migration_tools import config, shaping
+from fedmsg_migration_tools.tests import Clock
+
+
+def _settings(**kwargs):
+    settings = dict(config.DEFAULTS["zmq_to_amqp"]["shaping"])
+    settings.update(kwargs)
+    return settings
+
+
+class TokenBucketTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_burst(self):
+        """Assert a burst goes through, and the next messages wait for tokens."""
+        bucket = shaping.TokenBucket("test", 10, burst=3, clock=self.clock)
+        self.assertEqual([bucket.offer(i) for i in range(5)], [True] * 3 + [False] * 2)
+        self.assertEqual(bucket.release(), [])
+        self.assertAlmostEqual(bucket.next_release(), 0.1)
+
+        self.clock.now += 0.15
+        self.assertEqual(bucket.release(), [3])
+        self.clock.now += 1
+        self.assertEqual(bucket.release(), [4])
+        self.assertIsNone(bucket.next_release())
+
+        stats = bucket.stats()
+        self.assertEqual(stats["passed"], 3)
+        self.assertEqual(stats["delayed"], 2)
+        self.assertEqual(stats["dropped"], 0)
+        self.assertEqual(stats["max_waiting"], 2)
+        self.assertAlmostEqual(stats["delay"]["max"], 1.15)
+
+    def test_no_overtaking(self):
+        """Assert messages don't overtake the ones waiting in the buffer."""
+        bucket = shaping.TokenBucket("test", 1, burst=1, clock=self.clock)
+        self.assertTrue(bucket.offer("a"))
+        self.assertFalse(bucket.offer("b"))
+        self.clock.now += 1
+        self.assertFalse(bucket.offer("c"))
+        self.assertEqual(bucket.release(), ["b"])
+
+    def test_buffer_full(self):
+        """Assert messages are dropped when the buffer is full."""
+        bucket = shaping.TokenBucket("test", 1, burst=1, buffer=1, clock=self.clock)
+        for i in range(3):
+            bucket.offer(i)
+        self.clock.now += 10
+        self.assertEqual(bucket.release(), [1])
+        self.assertEqual(bucket.stats()["dropped"], 1)
+
+    def test_drop(self):
+        """Assert the drop policy doesn't buffer messages."""
+        bucket = shaping.TokenBucket(
+            "test", 1, burst=1, overflow="drop", clock=self.clock
+        )
+        self.assertTrue(bucket.offer(0))
+        self.assertFalse(bucket.offer(1))
+        self.assertEqual(len(bucket.waiting), 0)
+        self.assertEqual(bucket.stats()["dropped"], 1)
+
+    def test_invalid(self):
+        """Assert invalid settings are refused."""
+        self.assertRaises(ValueError, shaping.TokenBucket, "test", 0)
+        self.assertRaises(ValueError, shaping.TokenBucket, "test", 1, overflow="spill")
+
+
+class ShaperTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.published = []
+
+    def shaper(self, **kwargs):
+        return shaping.Shaper.from_config(
+            self.published.append, _settings(**kwargs), clock=self.clock
+        )
+
+    def test_disabled(self):
+        """Assert no shaper is built without any rate."""
+        self.assertIsNone(self.shaper())
+
+    def test_prefixes(self):
+        """Assert the longest prefix is used, and other topics aren't shaped."""
+        shaper = self.shaper(
+            prefixes={
+                "org.fedoraproject": {"rate": 100},
+                "org.fedoraproject.prod.buildsys": {"rate": 1, "overflow": "drop"},
+            }
+        )
+        for _ in range(3):
+            shaper.submit(b"org.fedoraproject.prod.buildsys.tag", "build")
+            shaper.submit(b"org.fedoraproject.prod.bodhi.update", "update")
+            shaper.submit(b"org.release-monitoring.prod.anitya", "anitya")
+        self.assertEqual(self.published.count("build"), 1)
+        self.assertEqual(self.published.count("update"), 3)
+        self.assertEqual(self.published.count("anitya"), 3)
+        stats = shaper.stats()
+        self.assertEqual(stats["org.fedoraproject.prod.buildsys"]["dropped"], 2)
+        self.assertEqual(stats["org.fedoraproject"]["passed"], 3)
+
+    def test_global(self):
+        """Assert messages go through their prefix bucket, then the global one."""
+        shaper = self.shaper(
+            rate=2, burst=1, prefixes={"org.fedoraproject": {"rate": 1, "burst": 1}}
+        )
+        shaper.submit(b"org.fedoraproject.a", "a1")
+        shaper.submit(b"org.fedoraproject.a", "a2")
+        shaper.submit(b"org.other.b", "b1")
+        self.assertEqual(self.published, ["a1"])
+        self.assertAlmostEqual(shaper.run_pending(), 0.5)
+
+        self.clock.now += 0.5
+        self.assertAlmostEqual(shaper.run_pending(), 0.5)
+        self.assertEqual(self.published, ["a1", "b1"])
+        self.clock.now += 0.5
+        self.assertIsNone(shaper.run_pending())
+        self.assertEqual(self.published, ["a1", "b1", "a2"])
+
+    def test_drain(self):
+        """Assert the buffered messages are taken out, the global bucket's first."""
+        shaper = self.shaper(
+            rate=2, burst=1, prefixes={"org.fedoraproject": {"rate": 1, "burst": 1}}
+        )
+        for item in ("a1", "a2", "a3"):
+            shaper.submit(b"org.fedoraproject.a", item)
+        shaper.submit(b"org.other.b", "b1")
+        self.clock.now += 1
+        shaper.submit(b"org.other.b", "b2")
+
+        self.assertEqual(shaper.drain(), ["b1", "b2", "a2", "a3"])
+        self.assertEqual(self.published, ["a1"])
+        self.assertIsNone(shaper.run_pending())
+
+    def test_report(self):
+        """Assert the statistics are logged and reset periodically."""
+        shaper = self.shaper(rate=1, overflow="drop", report_interval=60)
+        shaper.submit(b"a", 1)
+        shaper.submit(b"a", 2)
+        shaper.run_pending()
+        self.clock.now += 60
+        with self.assertLogs(shaping._log.name, "WARNING") as logs:
+            shaper.run_pending()
+        self.assertIn("1 passed, 0 delayed (p99 0.000s), 1 dropped", logs.output[0])
+        self.assertEqual(shaper.stats()["global"]["passed"], 0)
@@ -0,0 +1,89 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import os
+import tempfile
+import unittest
+
+from fedmsg_migration_tools import offline, spill
+
+
+def _message(i):
+    body = {"msg_id": "2018-{}".format(i), "topic": "a.topic", "msg": {"i": i}}
+    return b"a.topic", json.dumps(body).encode("utf-8")
+
+
+class SpillTests(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "spill.jsonl")
+
+    def test_write_and_read(self):
+        """Assert spilled messages are appended and read back in order."""
+        self.assertEqual(spill.write(self.path, [_message(0)]), 1)
+        with self.assertLogs(spill._log.name, "ERROR"):
+            written = spill.write(self.path, [(b"a.topic", b"not json"), _message(1)])
+        self.assertEqual(written, 1)
+
+        messages = spill.read(self.path)
+
+        self.assertEqual([topic for topic, _ in messages], [b"a.topic", b"a.topic"])
+        self.assertEqual(
+            [json.loads(body.decode("utf-8")) for _, body in messages],
+            [json.loads(_message(i)[1].decode("utf-8")) for i in (0, 1)],
+        )
+        self.assertEqual(
+            [msg_id for _, msg_id, _ in offline.read_log(self.path)], ["0", "1"]
+        )
+
+    def test_multiline_body(self):
+        """Assert a pretty-printed body is spilled on a single line."""
+        body = {"msg_id": "2018-0", "topic": "a.topic", "msg": {"text": "a\nb"}}
+
+        spill.write(
+            self.path, [(b"a.topic", json.dumps(body, indent=2).encode("utf-8"))]
+        )
+
+        with open(self.path) as fd:
+            self.assertEqual(len(fd.readlines()), 1)
+        messages = spill.read(self.path)
+        self.assertEqual(json.loads(messages[0][1].decode("utf-8")), body)
+
+    def test_read_missing(self):
+        """Assert there are no messages to read without a spill file."""
+        self.assertEqual(spill.read(self.path), [])
+
+    def test_read_truncated(self):
+        """Assert a line truncated by a crash is skipped."""
+        spill.write(self.path, [_message(0)])
+        with open(self.path, "a") as fd:
+            fd.write('{"received": 1, "topic": "a.to')
+
+        with self.assertLogs(spill._log.name, "WARNING"):
+            self.assertEqual(len(spill.read(self.path)), 1)
+
+    def test_replace(self):
+        """Assert the messages left are kept, and the file removed when none are."""
+        spill.write(self.path, [_message(0), _message(1)])
+
+        spill.replace(self.path, [_message(1)])
+        self.assertEqual(len(spill.read(self.path)), 1)
+
+        spill.replace(self.path, [])
+        self.assertFalse(os.path.exists(self.path))
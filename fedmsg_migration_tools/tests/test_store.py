@@ -0,0 +1,308 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2019 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import datetime
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import mock
+
+from fedmsg_migration_tools.store import Record, SpillStore, StateLog, Store
+
+
+class CountingThreshold(object):
+    """A threshold that counts how many entries were compared to it."""
+
+    def __init__(self, value):
+        self.value = value
+        self.comparisons = 0
+
+    def __gt__(self, other):
+        self.comparisons += 1
+        return other < self.value
+
+
+class StoreTests(unittest.TestCase):
+    """Tests for the :class:`store.Store` class."""
+
+    def test_expire(self):
+        """Assert expired entries are removed and returned oldest first."""
+        store = Store()
+        for i in range(5):
+            store["msg-{}".format(i)] = Record("dummy.topic", i)
+
+        expired = list(store.expire(3))
+
+        self.assertEqual(
+            [msg_id for msg_id, __ in expired], ["msg-0", "msg-1", "msg-2"]
+        )
+        self.assertEqual(expired[0][1], Record("dummy.topic", 0))
+        self.assertEqual(list(store), ["msg-3", "msg-4"])
+
+    def test_expire_empty(self):
+        """Assert expiring an empty store does nothing."""
+        store = Store()
+        self.assertEqual(list(store.expire(3)), [])
+
+    def test_expire_after_match(self):
+        """Assert entries removed when matched are not expired."""
+        store = Store()
+        store["msg-0"] = Record("dummy.topic", 0)
+        store["msg-1"] = Record("dummy.topic", 1)
+        del store["msg-0"]
+        self.assertEqual(list(store.expire(3)), [("msg-1", Record("dummy.topic", 1))])
+
+    def test_expire_cost(self):
+        """Assert expiry only looks at the expired entries, however large the store."""
+        store = Store()
+        record = Record("dummy.topic", 1)
+        for i in range(10):
+            store[i] = Record("dummy.topic", 0)
+        for i in range(10, 2000000):
+            store[i] = record
+
+        threshold = CountingThreshold(1)
+        expired = list(store.expire(threshold))
+
+        self.assertEqual(len(expired), 10)
+        # The expired entries and the first one that isn't
+        self.assertEqual(threshold.comparisons, 11)
+        self.assertEqual(len(store), 2000000 - 10)
+
+        threshold = CountingThreshold(1)
+        self.assertEqual(list(store.expire(threshold)), [])
+        self.assertEqual(threshold.comparisons, 1)
+
+
+class RecordTests(unittest.TestCase):
+    """Tests for the :class:`store.Record` class."""
+
+    def test_slots(self):
+        """Assert records don't carry a per-instance dictionary."""
+        record = Record("dummy.topic")
+        self.assertFalse(hasattr(record, "__dict__"))
+
+    def test_topic_interned(self):
+        """Assert records share the topic strings."""
+        record1 = Record("".join(["dummy.", "topic"]))
+        record2 = Record("".join(["dummy.", "topic"]))
+        self.assertIs(record1.topic, record2.topic)
+
+    def test_received_defaults_to_now(self):
+        """Assert the reception time defaults to the current monotonic time."""
+        with mock.patch("fedmsg_migration_tools.store.time.monotonic", return_value=42):
+            record = Record("dummy.topic")
+        self.assertEqual(record.received, 42)
+
+    def test_received_at(self):
+        """Assert the monotonic reception time is converted to wall-clock time."""
+        record = Record("dummy.topic", time.monotonic() - 30)
+        delta = datetime.datetime.utcnow() - record.received_at()
+        self.assertAlmostEqual(delta.total_seconds(), 30, delta=1)
+
+
+class BoundedStoreTests(unittest.TestCase):
+    """Tests for the limits of the :class:`store.Store` class."""
+
+    def test_max_entries_spill(self):
+        """Assert the oldest entries are spilled and can still be matched."""
+        store = Store(max_entries=100, spill=SpillStore())
+        for i in range(150):
+            store["msg-{}".format(i)] = Record("dummy.topic", i)
+
+        self.assertLessEqual(dict.__len__(store), 100)
+        self.assertEqual(len(store) + len(store.spill), 150)
+        self.assertIn("msg-0", store)
+        self.assertEqual(store.pop("msg-0"), Record("dummy.topic", 0))
+        self.assertNotIn("msg-0", store)
+        del store["msg-1"]
+        self.assertNotIn("msg-1", store)
+        self.assertIsNone(store.pop("msg-1", None))
+        self.assertEqual(store.pop_overflowed(), {})
+
+    def test_spilled_entries_expire_first(self):
+        """Assert spilled entries are expired, before the ones in memory."""
+        store = Store(max_entries=10, spill=SpillStore())
+        for i in range(20):
+            store["msg-{}".format(i)] = Record("dummy.topic", i)
+
+        expired = [msg_id for msg_id, __ in store.expire(15)]
+
+        self.assertEqual(expired, ["msg-{}".format(i) for i in range(15)])
+        self.assertEqual(len(store.spill), 0)
+        self.assertEqual(list(store), ["msg-{}".format(i) for i in range(15, 20)])
+
+    def test_max_entries_count(self):
+        """Assert the oldest entries are counted by topic without a spill store."""
+        store = Store(max_entries=100)
+        for i in range(150):
+            store["msg-{}".format(i)] = Record("dummy.topic.{}".format(i % 2), i)
+
+        self.assertLessEqual(len(store), 100)
+        self.assertNotIn("msg-0", store)
+        overflowed = store.pop_overflowed()
+        self.assertEqual(sum(overflowed.values()) + len(store), 150)
+        self.assertEqual(set(overflowed), {"dummy.topic.0", "dummy.topic.1"})
+        self.assertEqual(store.pop_overflowed(), {})
+
+    def test_add_dropped(self):
+        """Assert adding an entry returns the IDs of the entries it dropped."""
+        store = Store(max_entries=100)
+        added = [
+            store.add("msg-{}".format(i), Record("dummy.topic", i)) for i in range(101)
+        ]
+
+        self.assertEqual(added[:100], [[]] * 100)
+        self.assertEqual(added[100], ["msg-0", "msg-1"])
+
+    def test_add_spilled(self):
+        """Assert spilled entries are not reported as dropped."""
+        store = Store(max_entries=100, spill=SpillStore())
+        added = [
+            store.add("msg-{}".format(i), Record("dummy.topic", i)) for i in range(101)
+        ]
+
+        self.assertEqual(added, [[]] * 101)
+        self.assertIn("msg-0", store)
+
+    def test_max_bytes(self):
+        """Assert the approximate size of the store is bounded."""
+        store = Store(max_bytes=10000)
+        for i in range(1000):
+            store["msg-{}".format(i)] = Record("dummy.topic", i)
+
+        self.assertLessEqual(store.size, 10000)
+        self.assertLess(len(store), 1000)
+        for msg_id in list(store):
+            del store[msg_id]
+        self.assertEqual(store.size, 0)
+
+    def test_spill_file(self):
+        """Assert the spill store can use a given file."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "spill.sqlite")
+            spill = SpillStore(path)
+            spill.add([("msg-0", Record("dummy.topic", 0, b"digest"))])
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(spill.pop("msg-0"), Record("dummy.topic", 0, b"digest"))
+            spill.close()
+
+    def test_spill_count(self):
+        """Assert the entries are counted without counting them in the database."""
+        spill = SpillStore()
+        spill.add([("msg-0", Record("a", 0)), ("msg-1", Record("a", 1))])
+        spill.add([("msg-1", Record("b", 2)), ("msg-2", Record("a", 3))])
+
+        self.assertEqual(len(spill), 3)
+        self.assertEqual(spill.pop("msg-1"), Record("b", 2))
+        self.assertEqual(len(spill), 2)
+        spill.close()
+
+    def test_spill_file_in_use(self):
+        """Assert two stores can't share a spill file and wipe each other's entries."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "spill.sqlite")
+            spill = SpillStore(path)
+            spill.add([("msg-0", Record("dummy.topic", 0))])
+            other = SpillStore(path)
+
+            self.assertRaises(
+                sqlite3.OperationalError, other.add, [("msg-1", Record("a", 0))]
+            )
+            self.assertIn("msg-0", spill)
+            spill.close()
+
+
+class StateLogTests(unittest.TestCase):
+    """Tests for the :class:`store.StateLog` class."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "state.jsonl")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        """Assert the messages still waiting are read back, in order."""
+        state = StateLog(self.path)
+        state.added("amqp", "msg-0", "dummy.topic", 1000.0, b"digest")
+        state.added("zmq", "msg-1", "dummy.topic", 1001.0)
+        state.added("amqp", "msg-2", "dummy.topic", 1002.0)
+        state.removed("amqp", "msg-0")
+        state.flush()
+        state.close()
+        self.assertEqual(
+            list(StateLog(self.path).read().items()),
+            [
+                (("zmq", "msg-1"), ("dummy.topic", 1001.0, None)),
+                (("amqp", "msg-2"), ("dummy.topic", 1002.0, None)),
+            ],
+        )
+
+    def test_digest(self):
+        """Assert digests are read back as bytes."""
+        state = StateLog(self.path)
+        state.added("amqp", "msg-0", "dummy.topic", 1000.0, b"\x00digest")
+        state.flush()
+        entries = state.read()
+        self.assertEqual(entries[("amqp", "msg-0")][2], b"\x00digest")
+
+    def test_buffered(self):
+        """Assert nothing is written until the log is flushed."""
+        state = StateLog(self.path)
+        state.added("amqp", "msg-0", "dummy.topic", 1000.0)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(state.read(), {})
+        state.flush()
+        self.assertEqual(len(state.read()), 1)
+
+    def test_truncated(self):
+        """Assert a line truncated by a crash is ignored."""
+        state = StateLog(self.path)
+        state.added("amqp", "msg-0", "dummy.topic", 1000.0)
+        state.flush()
+        state.close()
+        with open(self.path, "a") as fd:
+            fd.write('["+", "zmq", "msg-1", "dum')
+        self.assertEqual(list(StateLog(self.path).read()), [("amqp", "msg-0")])
+
+    def test_compaction(self):
+        """Assert the log is rewritten once mostly made of matched messages."""
+        state = StateLog(self.path, compact_min_lines=10)
+        for i in range(10):
+            state.added("amqp", "msg-{}".format(i), "dummy.topic", 1000.0)
+            state.removed("amqp", "msg-{}".format(i))
+        state.added("zmq", "msg-last", "dummy.topic", 1000.0)
+        state.flush()
+        with open(self.path) as fd:
+            self.assertEqual(len(fd.readlines()), 1)
+        state.added("zmq", "msg-next", "dummy.topic", 1000.0)
+        state.flush()
+        self.assertEqual(list(state.read()), [("zmq", "msg-last"), ("zmq", "msg-next")])
+
+    def test_load_compacts(self):
+        """Assert loading the log compacts it."""
+        state = StateLog(self.path)
+        state.added("amqp", "msg-0", "dummy.topic", 1000.0)
+        state.removed("amqp", "msg-0")
+        state.flush()
+        self.assertEqual(StateLog(self.path).load(), {})
+        self.assertEqual(os.path.getsize(self.path), 0)
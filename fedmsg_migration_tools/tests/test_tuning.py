@@ -0,0 +1,144 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest
+
+from fedmsg_migration_tools import config, tuning
+from fedmsg_migration_tools.tests import Clock
+
+
+class BurstProfileTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.profile = tuning.BurstProfile(gap=0.05, clock=self.clock)
+
+    def test_bursts(self):
+        """Assert messages close together are counted as a burst."""
+        for _ in range(3):
+            self.profile.add(10, 1000)
+            self.clock.now += 0.01
+        self.clock.now += 1
+        self.profile.add(5, 500)
+
+        stats = self.profile.stats()
+        self.assertEqual(stats["max_burst"], 30)
+        self.assertEqual(stats["max_burst_bytes"], 3000)
+        self.assertEqual(stats["bursts"]["max"], 30)
+        self.assertAlmostEqual(stats["interarrival"]["max"], 1.01)
+        self.assertEqual(self.profile.burst, 5)
+
+    def test_steady(self):
+        """Assert steady traffic, however fast, doesn't make ever larger bursts."""
+        for _ in range(10000):
+            self.profile.add(10, 1000)
+            self.clock.now += 0.01
+
+        self.assertAlmostEqual(self.profile.rate, 1000, delta=1)
+        # Only the traffic before the baseline is known adds up
+        self.assertLessEqual(self.profile.max_burst, 100)
+        self.assertGreater(self.profile.bursts.count, 1000)
+        self.assertFalse(tuning.Tuner().recommend(self.profile, 1000)["grow"])
+
+    def test_surge(self):
+        """Assert a surge over steady traffic is measured as a burst."""
+        for _ in range(1000):
+            self.profile.add(1, 100)
+            self.clock.now += 0.01
+        for _ in range(50):
+            self.profile.add(100, 10000)
+            self.clock.now += 0.01
+
+        self.assertGreater(self.profile.max_burst, 4500)
+
+    def test_backlog(self):
+        """Assert the backlog counts the messages received until the socket is drained."""
+        self.profile.add(10, 1000, drained=False)
+        self.profile.add(10, 1000, drained=False)
+        self.profile.add(3, 300, drained=True)
+        self.profile.add(4, 400, drained=True)
+
+        self.assertEqual(self.profile.max_backlog, 23)
+        self.assertEqual(self.profile.backlog, 0)
+
+    def test_reset_stats(self):
+        """Assert the largest burst and backlog are kept across periods."""
+        self.profile.add(10, 1000, drained=False)
+        self.profile.reset_stats()
+
+        stats = self.profile.stats()
+        self.assertEqual(stats["max_backlog"], 10)
+        self.assertEqual(stats["interarrival"], {})
+
+
+class TunerTests(unittest.TestCase):
+    def setUp(self):
+        self.profile = tuning.BurstProfile(clock=Clock())
+
+    def test_no_messages(self):
+        """Assert nothing is recommended before any message."""
+        self.assertIsNone(tuning.Tuner().recommend(self.profile, 1000))
+
+    def test_recommend(self):
+        """Assert the largest burst is held with headroom, rounded to a power of two."""
+        self.profile.add(1500, 600000)
+
+        recommended = tuning.Tuner().recommend(self.profile, 2000)
+
+        self.assertEqual(
+            recommended,
+            {"hwm": 4096, "buffer": 2097152, "saturated": False, "grow": True},
+        )
+
+    def test_saturated(self):
+        """Assert at least twice the high water mark is recommended when it was reached."""
+        self.profile.add(100, 1000, drained=False)
+
+        recommended = tuning.Tuner(headroom=1).recommend(self.profile, 100)
+
+        self.assertTrue(recommended["saturated"])
+        self.assertEqual(recommended["hwm"], 256)
+
+    def test_never_shrink(self):
+        """Assert the current settings are kept when the bursts fit."""
+        self.profile.add(10, 1000)
+
+        recommended = tuning.Tuner().recommend(self.profile, 1000, 4194304)
+
+        self.assertEqual(
+            recommended,
+            {"hwm": 1000, "buffer": 4194304, "saturated": False, "grow": False},
+        )
+
+    def test_maximums(self):
+        """Assert the recommendations don't go over the maximums."""
+        self.profile.add(100000, 10**9)
+        settings = dict(
+            config.DEFAULTS["zmq_to_amqp"]["tuning"], max_hwm=5000, max_buffer=10**6
+        )
+
+        recommended = tuning.Tuner.from_config(settings).recommend(self.profile, 1000)
+
+        self.assertEqual(recommended["hwm"], 5000)
+        self.assertEqual(recommended["buffer"], 10**6)
+        self.assertEqual(
+            tuning.Tuner(max_buffer=10**9).recommend(self.profile, 1000)["buffer"],
+            10**9,
+        )
+
+    def test_invalid_headroom(self):
+        """Assert the headroom must be at least 1."""
+        self.assertRaises(ValueError, tuning.Tuner, headroom=0.5)
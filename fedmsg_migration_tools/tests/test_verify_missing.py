@@ -18,9 +18,16 @@
 import datetime
 import json
 import unittest
+import unittest.mock
 
 from fedora_messaging.api import Message
+from twisted.internet import defer, task
+import mock
+
 from fedmsg_migration_tools import verify_missing
+from fedmsg_migration_tools.matching import Shard
+from fedmsg_migration_tools.metrics import MatchStats
+from fedmsg_migration_tools.store import Store
 
 
 class AmqpConsumerTestCase(unittest.TestCase):
@@ -36,7 +43,7 @@ class AmqpConsumerTestCase(unittest.TestCase):
         self.consumer.on_message(msg)
         self.assertEqual(len(self.store), 1)
         self.assertIn("dummy-msgid", self.store)
-        self.assertEqual(self.store["dummy-msgid"][1]["msg_id"], msg.id)
+        self.assertEqual(self.store["dummy-msgid"].topic, "dummy.topic")
 
     def test_without_year_prefix(self):
         """Assert it handles messages without the year prefix."""
@@ -45,8 +52,7 @@ class AmqpConsumerTestCase(unittest.TestCase):
         self.consumer.on_message(msg)
         self.assertEqual(len(self.store), 1)
         self.assertIn("dummy-msgid", self.store)
-        self.assertEqual(self.store["dummy-msgid"][1]["msg_id"], msg.id)
-        self.assertEqual(self.store["dummy-msgid"][1]["topic"], "dummy.topic")
+        self.assertEqual(self.store["dummy-msgid"].topic, "dummy.topic")
 
     def test_without_message_id(self):
         """Assert it handles messages without a message_id."""
@@ -96,15 +102,243 @@ class ZmqConsumerTestCase(unittest.TestCase):
         """Assert the year prefix on fedmsg is removed."""
         year = datetime.datetime.utcnow().year
         msg = {"msg_id": "{}-dummy-msgid".format(year), "body": "dummy-body"}
-        self.consumer.on_message(json.dumps(msg), b"dummy.topic")
+        self.consumer.on_message(json.dumps(msg).encode("utf-8"), b"dummy.topic")
         self.assertEqual(len(self.store), 1)
         self.assertIn("dummy-msgid", self.store)
-        self.assertEqual(self.store["dummy-msgid"][1], msg)
+        self.assertEqual(self.store["dummy-msgid"].topic, "dummy.topic")
 
     def test_without_year_prefix(self):
         """Assert it handles messages without the year prefix."""
         msg = {"msg_id": "dummy-msgid", "body": "dummy-body"}
-        self.consumer.on_message(json.dumps(msg), b"dummy.topic")
+        self.consumer.on_message(json.dumps(msg).encode("utf-8"), b"dummy.topic")
         self.assertEqual(len(self.store), 1)
         self.assertIn("dummy-msgid", self.store)
-        self.assertEqual(self.store["dummy-msgid"][1], msg)
+        self.assertEqual(self.store["dummy-msgid"].topic, "dummy.topic")
+
+    def test_without_msg_id(self):
+        """Assert messages without a msg_id are ignored."""
+        msg = {"body": "dummy-body", "msg": {"msg_id": "nested"}}
+        self.consumer.on_message(json.dumps(msg).encode("utf-8"), b"dummy.topic")
+        self.assertEqual(len(self.store), 0)
+
+    def test_invalid(self):
+        """Assert invalid messages are ignored."""
+        self.consumer.on_message(b'{"msg_id": "dummy-msgid"', b"dummy.topic")
+        self.assertEqual(len(self.store), 0)
+
+
+class ComparatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.amqp_store = Store()
+        self.zmq_store = Store()
+        self.comparator = verify_missing.Comparator(self.amqp_store, self.zmq_store)
+
+    def test_consumers_match_on_receipt(self):
+        """Assert consumers resolve matches as soon as both sides are received."""
+        amqp_consumer = verify_missing.AmqpConsumer(self.amqp_store, self.comparator)
+        zmq_consumer = verify_missing.ZmqConsumer(self.zmq_store, [], self.comparator)
+        msg = Message(topic="dummy.topic", body={"body": "dummy-body"})
+        msg.id = "2019-dummy-msgid"
+
+        amqp_consumer.on_message(msg)
+        self.assertIn("dummy-msgid", self.amqp_store)
+        zmq_consumer.on_message(
+            json.dumps({"msg_id": msg.id}).encode("utf-8"), b"dummy.topic"
+        )
+
+        self.assertEqual(self.amqp_store, {})
+        self.assertEqual(self.zmq_store, {})
+
+    def test_start_stop(self):
+        """Assert the periodic checks are started and stopped with the service."""
+        clock = task.Clock()
+        for loop in (
+            self.comparator._rm_loop,
+            self.comparator._cm_loop,
+            self.comparator._report_loop,
+        ):
+            loop.clock = clock
+        self.comparator.stats.matched("dummy.topic", 0.1)
+        self.comparator.startService()
+        self.assertNotEqual(self.comparator.stats.topics, {})
+        clock.advance(self.comparator.report_interval)
+        self.assertEqual(self.comparator.stats.topics, {})
+        self.comparator.stopService()
+        self.assertFalse(self.comparator._report_loop.running)
+        self.assertFalse(self.comparator._cm_loop.running)
+
+    def test_state(self):
+        """Assert the waiting messages are restored on start and saved on stop."""
+        state = mock.Mock()
+        state.load.return_value = {}
+        self.comparator.state = state
+        clock = task.Clock()
+        for loop in (
+            self.comparator._rm_loop,
+            self.comparator._cm_loop,
+            self.comparator._report_loop,
+            self.comparator._state_loop,
+        ):
+            loop.clock = clock
+        self.comparator.startService()
+        state.load.assert_called_once_with()
+        self.assertTrue(self.comparator._state_loop.running)
+        clock.advance(self.comparator.state_interval)
+        state.flush.assert_called_once_with()
+        self.comparator.stopService()
+        self.assertEqual(state.flush.call_count, 2)
+        state.close.assert_called_once_with()
+
+
+@mock.patch(
+    "fedmsg_migration_tools.verify_missing.threads.deferToThread",
+    defer.maybeDeferred,
+)
+class DigestsTestCase(unittest.TestCase):
+    """Tests for the comparison of the message bodies."""
+
+    def setUp(self):
+        self.amqp_store = Store()
+        self.zmq_store = Store()
+        self.comparator = verify_missing.Comparator(self.amqp_store, self.zmq_store)
+        self.amqp_consumer = verify_missing.AmqpConsumer(
+            self.amqp_store, self.comparator, digests=True
+        )
+        self.zmq_consumer = verify_missing.ZmqConsumer(
+            self.zmq_store, [], self.comparator, digests=True
+        )
+
+    def _receive(self, amqp_body, zmq_body):
+        msg = Message(topic="dummy.topic", body=amqp_body)
+        msg.id = "dummy-msgid"
+        self.amqp_consumer.on_message(msg)
+        self.assertIsNotNone(self.amqp_store["dummy-msgid"].digest)
+        zmq_msg = {"msg_id": "2019-dummy-msgid", "msg": zmq_body}
+        self.zmq_consumer.on_message(
+            json.dumps(zmq_msg).encode("utf-8"), b"dummy.topic"
+        )
+        self.assertEqual(self.amqp_store, {})
+        return self.comparator.stats.summary()["total"]
+
+    def test_same_body(self):
+        """Assert bodies serialized differently are the same."""
+        total = self._receive({"a": 1, "b": [2, 3]}, {"b": [2, 3], "a": 1})
+        self.assertEqual(total["matched"], 1)
+        self.assertEqual(total["mismatched"], 0)
+
+    def test_different_body(self):
+        """Assert bodies mangled by the bridge are reported."""
+        total = self._receive({"a": "some text"}, {"a": "some te"})
+        self.assertEqual(total["matched"], 1)
+        self.assertEqual(total["mismatched"], 1)
+
+    def test_invalid(self):
+        """Assert invalid ZeroMQ messages are ignored."""
+        self.zmq_consumer.on_message(b'{"msg_id": ', b"dummy.topic")
+        self.zmq_consumer.on_message(b"[]", b"dummy.topic")
+        self.assertEqual(self.zmq_store, {})
+
+
+class ShardingTestCase(unittest.TestCase):
+    """Tests for the verification of the messages split in shards."""
+
+    def setUp(self):
+        self.store = {}
+        self.shards = [Shard(0, 2), Shard(1, 2)]
+        self.msg_ids = ["2019-{}".format(i) for i in range(20)]
+
+    def test_amqp_consumer(self):
+        """Assert the AMQP consumer only records the messages of its shard."""
+        consumer = verify_missing.AmqpConsumer(self.store, shard=self.shards[1])
+        for msg_id in self.msg_ids:
+            msg = Message(topic="dummy.topic", body={})
+            msg.id = msg_id[5:]
+            consumer.on_message(msg)
+        expected = [m[5:] for m in self.msg_ids if self.shards[1].owns(m)]
+        self.assertEqual(sorted(self.store), sorted(expected))
+        self.assertTrue(0 < len(expected) < len(self.msg_ids))
+
+    def test_amqp_consumer_queue(self):
+        """Assert each shard consumes from its own queue."""
+        consumer = verify_missing.AmqpConsumer(self.store, shard=self.shards[1])
+        with mock.patch.object(consumer._service.factory, "consume") as consume:
+            consumer.startService()
+        queues = consume.call_args[1]["queues"]
+        self.assertEqual(list(queues), ["amqp_bridge_verify_missing-1"])
+        for binding in consume.call_args[1]["bindings"]:
+            self.assertEqual(binding["queue"], "amqp_bridge_verify_missing-1")
+
+    def test_zmq_consumer(self):
+        """Assert the ZeroMQ consumer only records the messages of its shard."""
+        consumer = verify_missing.ZmqConsumer(self.store, [], shard=self.shards[0])
+        for msg_id in self.msg_ids:
+            body = json.dumps({"msg_id": msg_id}).encode("utf-8")
+            consumer.on_message(body, b"dummy.topic")
+        expected = [m[5:] for m in self.msg_ids if self.shards[0].owns(m)]
+        self.assertEqual(sorted(self.store), sorted(expected))
+
+    def test_comparator_report_queue(self):
+        """Assert sharded comparators hand their statistics to the parent."""
+        report_queue = mock.Mock()
+        comparator = verify_missing.Comparator(
+            Store(), Store(), shard=self.shards[1], report_queue=report_queue
+        )
+        comparator.stats.matched("dummy.topic", 0.5)
+        comparator.report()
+        index, stats, match_window = report_queue.put.call_args[0][0]
+        self.assertEqual(index, 1)
+        self.assertIsNone(match_window)
+        self.assertEqual(MatchStats.from_dict(stats).summary()["total"]["matched"], 1)
+        self.assertEqual(comparator.stats.topics, {})
+
+
+class ShardReportsTestCase(unittest.TestCase):
+    """Tests for the :class:`verify_missing.ShardReports` class."""
+
+    def setUp(self):
+        self.now = 0
+        self.reports = verify_missing.ShardReports(
+            3, report_interval=60, clock=lambda: self.now
+        )
+        self.stats = MatchStats()
+        self.stats.matched("dummy.topic", 0.5)
+
+    def test_all_shards(self):
+        """Assert statistics are reported once all shards sent theirs."""
+        summaries = []
+        with mock.patch.object(verify_missing, "report_stats") as report:
+            report.side_effect = lambda stats, *args: summaries.append(stats.summary())
+            for index in range(3):
+                self.assertEqual(summaries, [])
+                self.reports.add(index, self.stats.to_dict())
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0]["total"]["matched"], 3)
+
+    def test_match_window(self):
+        """Assert the widest adaptive match window of the shards is reported."""
+        with mock.patch.object(verify_missing, "report_stats") as report:
+            for index, window in enumerate((20, 30, 25)):
+                self.reports.add(index, self.stats.to_dict(), window)
+        report.assert_called_once_with(mock.ANY, None, 30)
+        self.assertIsNone(self.reports.match_window)
+
+    def test_late_shard(self):
+        """Assert late shards don't hold up the reports."""
+        with mock.patch.object(verify_missing, "report_stats") as report:
+            self.reports.add(0, self.stats.to_dict())
+            self.now = 29
+            self.reports.maybe_flush()
+            report.assert_not_called()
+            self.now = 30
+            self.reports.maybe_flush()
+            report.assert_called_once()
+            self.reports.maybe_flush()
+            report.assert_called_once()
+
+    def test_shard_ahead(self):
+        """Assert a shard reporting twice starts a new period."""
+        with mock.patch.object(verify_missing, "report_stats") as report:
+            self.reports.add(0, self.stats.to_dict())
+            self.reports.add(0, self.stats.to_dict())
+        report.assert_called_once()
+        self.assertEqual(self.reports.stats.summary()["total"]["matched"], 1)
@@ -0,0 +1,201 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import json
+import unittest
+
+import mock
+import pika
+import zmq
+
+from fedmsg_migration_tools import verify_missing_asyncio
+from fedmsg_migration_tools.matching import body_digest
+from fedmsg_migration_tools.store import Store
+
+
+def _amqp_message(msg_id, topic="dummy.topic", body=None):
+    """Build the arguments pika passes to the AMQP consumer."""
+    method = mock.Mock(routing_key=topic)
+    properties = pika.BasicProperties(message_id=msg_id)
+    body = json.dumps(body or {"body": "dummy-body"}).encode("utf-8")
+    return None, method, properties, body
+
+
+class AsyncioTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.comparator = verify_missing_asyncio.Comparator(Store(), Store())
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_briefly(self):
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+
+
+class ComparatorTestCase(AsyncioTestCase):
+    def test_start_stop(self):
+        """Assert the periodic checks are run between start and stop."""
+        self.comparator.check_missing = mock.Mock(__name__="check_missing")
+        self.comparator.report = mock.Mock(__name__="report")
+        self.comparator.start()
+        self.run_briefly()
+        self.comparator.check_missing.assert_called_once_with()
+        self.comparator.report.assert_not_called()
+        self.comparator.stop()
+        self.run_briefly()
+        self.assertEqual(self.comparator._tasks, [])
+
+    def test_failing_check(self):
+        """Assert a failing check is logged, and doesn't stop the next ones."""
+        self.comparator.check_interval = 0.01
+        self.comparator.check_missing = mock.Mock(
+            __name__="check_missing", side_effect=ValueError
+        )
+        self.comparator.start()
+        with self.assertLogs(verify_missing_asyncio._log.name, "ERROR"):
+            self.run_briefly()
+        self.comparator.stop()
+        self.assertGreater(self.comparator.check_missing.call_count, 1)
+
+    def test_state(self):
+        """Assert the waiting messages are restored on start and saved on stop."""
+        state = mock.Mock()
+        state.load.return_value = {}
+        self.comparator.state = state
+        self.comparator.start()
+        state.load.assert_called_once_with()
+        self.comparator.stop()
+        self.run_briefly()
+        state.flush.assert_called_once_with()
+        state.close.assert_called_once_with()
+
+
+class ZmqConsumerTestCase(AsyncioTestCase):
+    def setUp(self):
+        super(ZmqConsumerTestCase, self).setUp()
+        self.consumer = verify_missing_asyncio.ZmqConsumer(
+            self.comparator.zmq_store, [], self.comparator
+        )
+
+    def test_year_prefix(self):
+        """Assert the year prefix on fedmsg is removed."""
+        body = json.dumps({"msg_id": "2019-dummy-msgid", "msg": {}})
+        self.consumer.on_message(body.encode("utf-8"), b"dummy.topic")
+        self.assertEqual(list(self.comparator.zmq_store), ["dummy-msgid"])
+        self.assertEqual(self.comparator.zmq_store["dummy-msgid"].topic, "dummy.topic")
+
+    def test_invalid(self):
+        """Assert invalid messages are logged and dropped."""
+        with self.assertLogs(verify_missing_asyncio._log.name, "INFO"):
+            self.consumer.on_message(b"not json", b"dummy.topic")
+        self.assertEqual(self.comparator.zmq_store, {})
+
+    def test_without_msg_id(self):
+        """Assert messages without a msg_id are logged and dropped."""
+        with self.assertLogs(verify_missing_asyncio._log.name, "INFO"):
+            self.consumer.on_message(b'{"msg": {}}', b"dummy.topic")
+        self.assertEqual(self.comparator.zmq_store, {})
+
+    def test_digests(self):
+        """Assert the digests are computed in the executor."""
+        self.consumer.digests = True
+        body = json.dumps({"msg_id": "2019-dummy-msgid", "msg": {"a": 1}})
+        self.consumer.on_message(body.encode("utf-8"), b"dummy.topic")
+        self.assertEqual(self.comparator.zmq_store, {})
+        self.run_briefly()
+        record = self.comparator.zmq_store["dummy-msgid"]
+        self.assertEqual(record.digest, body_digest({"a": 1}))
+
+    def test_receive(self):
+        """Assert messages are received from the ZeroMQ endpoints."""
+        context = zmq.Context()
+        publisher = context.socket(zmq.PUB)
+        port = publisher.bind_to_random_port("tcp://127.0.0.1")
+        self.consumer.endpoints = ["tcp://127.0.0.1:{}".format(port)]
+        self.consumer.start()
+        try:
+            for _ in range(50):
+                publisher.send_multipart(
+                    [b"dummy.topic", b'{"msg_id": "2019-dummy-msgid"}']
+                )
+                self.loop.run_until_complete(asyncio.sleep(0.02))
+                if self.comparator.zmq_store:
+                    break
+        finally:
+            self.consumer.stop()
+            publisher.close(linger=0)
+            context.term()
+        self.assertIn("dummy-msgid", self.comparator.zmq_store)
+
+
+class AmqpConsumerTestCase(AsyncioTestCase):
+    def setUp(self):
+        super(AmqpConsumerTestCase, self).setUp()
+        self.consumer = verify_missing_asyncio.AmqpConsumer(
+            self.comparator.amqp_store, self.comparator
+        )
+
+    def test_year_prefix(self):
+        """Assert the year prefix is removed from the message IDs."""
+        self.consumer.on_message(*_amqp_message("2019-dummy-msgid"))
+        self.assertEqual(list(self.comparator.amqp_store), ["dummy-msgid"])
+
+    def test_without_message_id(self):
+        """Assert messages without a message_id are logged and dropped."""
+        with self.assertLogs(verify_missing_asyncio._log.name, "INFO"):
+            self.consumer.on_message(*_amqp_message(None))
+        self.assertEqual(self.comparator.amqp_store, {})
+
+    def test_match(self):
+        """Assert messages are matched with the ZeroMQ ones."""
+        zmq_consumer = verify_missing_asyncio.ZmqConsumer(
+            self.comparator.zmq_store, [], self.comparator
+        )
+        zmq_consumer.on_message(b'{"msg_id": "2019-dummy-msgid"}', b"dummy.topic")
+        self.consumer.on_message(*_amqp_message("2019-dummy-msgid"))
+        self.assertEqual(self.comparator.amqp_store, {})
+        self.assertEqual(self.comparator.zmq_store, {})
+        self.assertEqual(self.comparator.stats.summary()["total"]["matched"], 1)
+
+    def test_digests(self):
+        """Assert the digests are computed in the executor."""
+        self.consumer.digests = True
+        self.consumer.on_message(*_amqp_message("dummy-msgid", body={"a": 1}))
+        self.run_briefly()
+        record = self.comparator.amqp_store["dummy-msgid"]
+        self.assertEqual(record.digest, body_digest({"a": 1}))
+
+    def test_reconnect(self):
+        """Assert the consumer retries connecting until stopped."""
+        self.consumer.parameters = pika.ConnectionParameters(
+            host="127.0.0.1", port=1, connection_attempts=1
+        )
+        self.consumer.RECONNECT_DELAY = 0.01
+        with mock.patch.object(
+            self.consumer, "_connect", wraps=self.consumer._connect
+        ) as connect:
+            self.consumer.start()
+            with self.assertLogs(verify_missing_asyncio._log.name, "WARNING"):
+                self.run_briefly()
+            closed = self.consumer.stop()
+            self.loop.run_until_complete(asyncio.wait([closed], timeout=1))
+        self.assertTrue(closed.done())
+        self.assertGreater(connect.call_count, 1)
@@ -0,0 +1,252 @@
+# This file is part of fedmsg_migration_tools.
+# Copyright (C) 2018 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Size the queues and buffers of the ZeroMQ sockets from the bursts they see.
+
+A :class:`BurstProfile` records how the messages going through a socket are
+spread out: the bursts of messages arriving faster than usual, the time between
+them, and the backlog of messages that waited in the socket's queue. A
+:class:`Tuner` turns the largest of them into the high water mark and kernel
+buffer size that would have held them, rather than guessing.
+"""
+
+import math
+import time
+
+from fedmsg_migration_tools.metrics import Histogram
+
+
+class BurstProfile(object):
+    """
+    The bursts of the messages going through a socket.
+
+    A burst is the excess of messages arriving faster than the baseline rate:
+    each message adds to it, and it shrinks as time goes by, like a queue
+    emptied :attr:`DRAIN` times faster than the baseline rate, so the jitter of
+    steady traffic doesn't add up. A burst ends when less than a message of it
+    is left, or when no message arrives for ``gap`` seconds. So steady traffic,
+    however fast, makes no large bursts, and only surges above it do. The
+    baseline is the average rate over the last ``window`` seconds or so, and is
+    only used once it covers ``gap`` seconds, before which every message adds
+    to the burst.
+
+    The backlog is how many messages were received from the socket before it
+    had none left waiting, which is how many it queued. The largest burst and
+    backlog are kept since the profile was created, while the distributions of
+    the bursts and of the time between receptions are reset with the
+    statistics.
+
+    Args:
+        gap (float): The time between two messages that ends a burst, in seconds.
+        window (float): The time constant of the baseline rate, in seconds.
+        clock (callable): The monotonic clock to use.
+    """
+
+    GAP = 0.05
+    WINDOW = 60
+    #: How much faster than the baseline rate bursts are emptied.
+    DRAIN = 1.1
+
+    def __init__(self, gap=GAP, window=WINDOW, clock=time.monotonic):
+        self.gap = gap
+        self.window = window
+        self._clock = clock
+        self._last = None
+        # The exponentially decayed messages, bytes and time of the baseline
+        self._count = 0.0
+        self._bytes = 0.0
+        self._time = 0.0
+        self._peak = 0
+        self.burst = 0
+        self.burst_bytes = 0
+        self.backlog = 0
+        self.max_burst = 0
+        self.max_burst_bytes = 0
+        self.max_backlog = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Forget the distributions counted so far and start a new period."""
+        self.bursts = Histogram()
+        self.interarrival = Histogram()
+
+    @property
+    def rate(self):
+        """float: The baseline rate, in messages per second, or 0 until it is known."""
+        return self._count / self._time if self._time >= self.gap else 0
+
+    @property
+    def byte_rate(self):
+        """float: The baseline rate, in bytes per second, or 0 until it is known."""
+        return self._bytes / self._time if self._time >= self.gap else 0
+
+    def add(self, count, size, drained=True):
+        """
+        Count messages received, or sent, together.
+
+        Args:
+            count (int): How many messages.
+            size (int): Their size, in bytes.
+            drained (bool): Whether the socket had no more messages waiting
+                after these.
+        """
+        now = self._clock()
+        if self._last is not None:
+            interval = now - self._last
+            self.interarrival.add(interval)
+            drain = self.DRAIN * interval
+            self.burst = max(0, self.burst - self.rate * drain)
+            self.burst_bytes = max(0, self.burst_bytes - self.byte_rate * drain)
+            if interval >= self.gap or self.burst < 1:
+                self._end_burst()
+            decay = math.exp(-interval / self.window)
+            self._count = self._count * decay + count
+            self._bytes = self._bytes * decay + size
+            self._time = self._time * decay + interval
+        self._last = now
+        self.burst += count
+        self.burst_bytes += size
+        self._peak = max(self._peak, self.burst)
+        self.backlog += count
+        self.max_burst = max(self.max_burst, self.burst)
+        self.max_burst_bytes = max(self.max_burst_bytes, self.burst_bytes)
+        self.max_backlog = max(self.max_backlog, self.backlog)
+        if drained:
+            self.backlog = 0
+
+    def _end_burst(self):
+        if self._peak:
+            self.bursts.add(self._peak)
+        self._peak = 0
+        self.burst = 0
+        self.burst_bytes = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict: The largest burst, in messages and bytes, and backlog, the
+                baseline rate, and the distributions of the bursts and of the
+                time between receptions since the statistics were reset.
+        """
+        return {
+            "rate": self.rate,
+            "max_burst": self.max_burst,
+            "max_burst_bytes": self.max_burst_bytes,
+            "max_backlog": self.max_backlog,
+            "bursts": self.bursts.summary(),
+            "interarrival": self.interarrival.summary(),
+        }
+
+
+def _power_of_two(value):
+    """Round a value up to a power of two."""
+    return 2 ** int(math.ceil(math.log(max(value, 1), 2)))
+
+
+class Tuner(object):
+    """
+    Recommend high water marks and kernel buffer sizes from burst profiles.
+
+    The recommended high water mark holds the largest burst or backlog seen,
+    times ``headroom``, and the recommended buffer the largest burst in bytes,
+    times ``headroom``, both rounded up to a power of two. When the backlog
+    reached the high water mark, messages were probably dropped and the bursts
+    were larger than seen, so at least twice the high water mark is
+    recommended. The recommendations never shrink the current values, and never
+    go over the maximums.
+
+    Args:
+        auto (bool): Whether to apply the recommendations, rather than only
+            reporting them. What applying them means is up to the bridge.
+        headroom (float): How much larger than the largest burst the queues and
+            buffers should be.
+        max_hwm (int): The largest high water mark to recommend.
+        max_buffer (int): The largest kernel buffer size to recommend, in bytes.
+
+    Raises:
+        ValueError: If the headroom is less than 1.
+    """
+
+    #: The default size of the socket buffers on Linux, in bytes.
+    DEFAULT_BUFFER = 212992
+
+    def __init__(self, auto=False, headroom=2, max_hwm=100000, max_buffer=8388608):
+        if headroom < 1:
+            raise ValueError("The tuning headroom must be at least 1")
+        self.auto = auto
+        self.headroom = headroom
+        self.max_hwm = max_hwm
+        self.max_buffer = max_buffer
+
+    @classmethod
+    def from_config(cls, settings):
+        """
+        Build a tuner from the ``tuning`` settings of a bridge.
+
+        Args:
+            settings (dict): The ``auto``, ``headroom``, ``max_hwm`` and
+                ``max_buffer`` settings.
+
+        Returns:
+            Tuner: The tuner.
+
+        Raises:
+            ValueError: If the settings are invalid.
+        """
+        return cls(
+            auto=settings["auto"],
+            headroom=settings["headroom"],
+            max_hwm=settings["max_hwm"],
+            max_buffer=settings["max_buffer"],
+        )
+
+    def recommend(self, profile, hwm, buffer=None):
+        """
+        Recommend the high water mark and kernel buffer size of a socket.
+
+        Args:
+            profile (BurstProfile): The bursts seen by the socket.
+            hwm (int): The current high water mark of the socket.
+            buffer (int): The current kernel buffer size of the socket, in
+                bytes, or ``None`` if it's the system's default.
+
+        Returns:
+            dict: The recommended ``hwm`` and ``buffer``, whether the backlog
+                reached the high water mark (``saturated``), and whether they
+                are larger than the current ones (``grow``), or ``None`` if no
+                message went through the socket yet.
+        """
+        if not profile.max_burst:
+            return None
+        saturated = profile.max_backlog >= hwm
+        needed = max(profile.max_burst, profile.max_backlog) * self.headroom
+        if saturated:
+            needed = max(needed, hwm * 2)
+        current_buffer = buffer or self.DEFAULT_BUFFER
+        recommended_hwm = max(hwm, min(_power_of_two(needed), self.max_hwm))
+        recommended_buffer = max(
+            current_buffer,
+            min(
+                _power_of_two(profile.max_burst_bytes * self.headroom), self.max_buffer
+            ),
+        )
+        return {
+            "hwm": recommended_hwm,
+            "buffer": recommended_buffer,
+            "saturated": saturated,
+            "grow": recommended_hwm > hwm or recommended_buffer > current_buffer,
+        }
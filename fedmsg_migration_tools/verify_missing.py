@@ -15,12 +15,13 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import json
 import logging
+import multiprocessing
+import queue
 import re
-from datetime import datetime, timedelta
+import time
 
-from twisted.internet import reactor, task
+from twisted.internet import reactor, task, threads
 from twisted.application import service
 
 # twisted.logger is available with Twisted 15+
@@ -31,29 +32,63 @@ from fedora_messaging import config as fm_config
 from fedora_messaging.twisted.service import FedoraMessagingServiceV2
 
 from fedmsg_migration_tools import config
+from fedmsg_migration_tools.matching import (
+    PeriodicMatcher,
+    Shard,
+    body_digest,
+    decode_with_digest,
+    extract_msg_id,
+    get_verify_config as _get_config,
+    make_comparator,
+    report_stats,
+)
+from fedmsg_migration_tools.metrics import MatchStats
+from fedmsg_migration_tools.store import Record
 
 
+_log = logging.getLogger(__name__)
+
 YEAR_PREFIX_RE = re.compile("^[0-9]{4}-")
 
 
 class AmqpConsumer(FedoraMessagingServiceV2):
+    """
+    Record the messages received from AMQP.
+
+    Args:
+        store (Store): Where to record the messages.
+        comparator (Comparator): The comparator to hand the messages to, if any.
+        digests (bool): Whether to compute the digest of the message bodies.
+            The digests are computed in the reactor's thread pool.
+        shard (Shard): The shard of the messages to record, if they are
+            sharded. Each shard consumes from its own queue, named after the
+            configured one.
+    """
 
     name = "AmqpConsumer"
 
-    def __init__(self, store):
+    def __init__(self, store, comparator=None, digests=False, shard=None):
         self.store = store
+        self.comparator = comparator
+        self.digests = digests
+        self.shard = shard
         FedoraMessagingServiceV2.__init__(self, fm_config.conf["amqp_url"])
 
     def startService(self):
         FedoraMessagingServiceV2.startService(self)
         bindings = config.conf["verify_missing"]["bindings"]
-        queue = config.conf["verify_missing"]["queue"]
+        queue = dict(config.conf["verify_missing"]["queue"])
         queue_name = queue.pop("queue")
+        if self.shard is not None:
+            queue_name = "{}-{}".format(queue_name, self.shard.index)
+            bindings = [dict(binding, queue=queue_name) for binding in bindings]
         self._service.factory.consume(
             self.on_message, bindings=bindings, queues={queue_name: queue}
         )
 
     def on_message(self, message):
+        if self.shard is not None and not self.shard.owns(message.id):
+            return
         log.msg(
             "Received from AMQP on topic {topic}: {msgid}".format(
                 topic=message.topic, msgid=message.id
@@ -71,23 +106,65 @@ class AmqpConsumer(FedoraMessagingServiceV2):
                 logLevel=logging.INFO,
             )
             return
+        record = Record(message.topic)
+        if not self.digests:
+            self._add(msg_id, record)
+            return
+        d = threads.deferToThread(body_digest, message.body)
+        d.addCallback(self._add_with_digest, msg_id, record)
+        d.addErrback(
+            lambda failure: log.msg(
+                "Failed to compute the digest of AMQP message {msg_id}: {e}".format(
+                    msg_id=msg_id, e=failure.value
+                ),
+                logLevel=logging.ERROR,
+            )
+        )
+
+    def _add_with_digest(self, digest, msg_id, record):
+        record.digest = digest
+        self._add(msg_id, record)
+
+    def _add(self, msg_id, record):
         if msg_id in self.store:
             log.msg(
                 "Received a duplicate AMQP message with id {msg_id} on topic {topic}".format(
-                    msg_id=msg_id, topic=message.topic
+                    msg_id=msg_id, topic=record.topic
                 ),
                 logLevel=logging.INFO,
             )
+            if self.comparator is not None:
+                self.comparator.stats.duplicate(record.topic, "AMQP")
             return
-        self.store[msg_id] = (
-            datetime.utcnow(),
-            {"msg_id": message.id, "topic": message.topic, "msg": str(message)},
-        )
+        if self.comparator is None:
+            self.store[msg_id] = record
+        else:
+            self.comparator.received(self.store, msg_id, record)
 
 
 class ZmqConsumer(service.Service):
-    def __init__(self, store, zmq_endpoints):
+    """
+    Record the messages received from ZeroMQ.
+
+    Args:
+        store (Store): Where to record the messages.
+        zmq_endpoints (list): The ZeroMQ endpoints to subscribe to.
+        comparator (Comparator): The comparator to hand the messages to, if any.
+        digests (bool): Whether to compute the digest of the message bodies.
+            This requires decoding the messages entirely, which is done along
+            with computing the digests in the reactor's thread pool. Otherwise,
+            only the message IDs are extracted.
+        shard (Shard): The shard of the messages to record, if they are
+            sharded. Messages are filtered on their ID before being decoded.
+    """
+
+    def __init__(
+        self, store, zmq_endpoints, comparator=None, digests=False, shard=None
+    ):
         self.store = store
+        self.comparator = comparator
+        self.digests = digests
+        self.shard = shard
         self.endpoints = zmq_endpoints
         self._socket = None
         self._factory = None
@@ -110,8 +187,35 @@ class ZmqConsumer(service.Service):
 
     def on_message(self, body, topic):
         topic = topic.decode("utf-8")
-        msg = json.loads(body)
-        if "msg_id" not in msg:
+        record = Record(topic)
+        if not self.digests or self.shard is not None:
+            try:
+                msg_id = extract_msg_id(body)
+            except ValueError as e:
+                self._invalid(topic, e)
+                return
+            if self.shard is not None and not self.shard.owns(msg_id):
+                return
+        if self.digests:
+            d = threads.deferToThread(decode_with_digest, body)
+            d.addCallbacks(
+                lambda result: self._add(result[0], record, result[1]),
+                lambda failure: self._invalid(topic, failure.value),
+            )
+            return
+        self._add(msg_id, record)
+
+    def _invalid(self, topic, error):
+        log.msg(
+            "Received an invalid message from ZeroMQ on topic {topic}: {e}".format(
+                topic=topic, e=error
+            ),
+            logLevel=logging.INFO,
+        )
+
+    def _add(self, msg_id, record, digest=None):
+        topic = record.topic
+        if msg_id is None:
             log.msg(
                 "Received a message without a msg_id from ZeroMQ on topic {topic}".format(
                     topic=topic
@@ -119,14 +223,14 @@ class ZmqConsumer(service.Service):
                 logLevel=logging.INFO,
             )
             return
-        msg_id = msg["msg_id"]
         log.msg(
             "Received from ZeroMQ on topic {topic}: {msgid}".format(
-                topic=topic, msgid=msg["msg_id"]
+                topic=topic, msgid=msg_id
             ),
             logLevel=logging.DEBUG,
         )
         msg_id = YEAR_PREFIX_RE.sub("", msg_id)
+        record.digest = digest
         if msg_id in self.store:
             log.msg(
                 "Received a duplicate ZeroMQ message with id {msg_id} on topic {topic}".format(
@@ -134,8 +238,13 @@ class ZmqConsumer(service.Service):
                 ),
                 logLevel=logging.INFO,
             )
+            if self.comparator is not None:
+                self.comparator.stats.duplicate(topic, "ZeroMQ")
             return
-        self.store[msg_id] = (datetime.utcnow(), msg)
+        if self.comparator is None:
+            self.store[msg_id] = record
+        else:
+            self.comparator.received(self.store, msg_id, record)
 
     def stopService(self):
         log.msg("Stopping ZmqConsumer", logLevel=logging.DEBUG)
@@ -143,86 +252,211 @@ class ZmqConsumer(service.Service):
             self._factory.shutdown()
 
 
-class Comparator(service.Service):
+class Comparator(PeriodicMatcher, service.Service):
+    """
+    A service running the :class:`PeriodicMatcher` checks with the reactor.
 
-    MATCH_WINDOW = 60
+    See :class:`PeriodicMatcher` for the arguments.
+    """
 
-    def __init__(self, amqp_store, zmq_store):
-        self.amqp_store = amqp_store
-        self.zmq_store = zmq_store
+    def __init__(self, amqp_store, zmq_store, **kwargs):
+        PeriodicMatcher.__init__(self, amqp_store, zmq_store, **kwargs)
         self._rm_loop = task.LoopingCall(self.remove_matching)
         self._cm_loop = task.LoopingCall(self.check_missing)
+        self._report_loop = task.LoopingCall(self.report)
+        self._state_loop = task.LoopingCall(self.flush_state)
 
     def startService(self):
-        self._rm_loop.start(1)
-        self._cm_loop.start(10)
+        self.start()
+        if self.state is not None:
+            self._state_loop.start(self.state_interval, now=False)
+        self._rm_loop.start(self.SAFETY_NET_INTERVAL)
+        self._cm_loop.start(self.check_interval)
+        self._report_loop.start(self.report_interval, now=False)
 
     def stopService(self):
         log.msg("Stopping Comparator", logLevel=logging.DEBUG)
-        for loop in (self._rm_loop, self._cm_loop):
+        for loop in (self._rm_loop, self._cm_loop, self._report_loop, self._state_loop):
             if loop.running:
                 loop.stop()
+        self.stop()
 
-    def remove_matching(self):
-        log.msg(
-            "Checking for matching messages ({amqplen}, {zmqlen})".format(
-                amqplen=len(self.amqp_store), zmqlen=len(self.zmq_store)
-            ),
-            logLevel=logging.DEBUG,
-        )
-        for msg_id in list(self.amqp_store.keys()):
-            if msg_id in self.zmq_store:
-                log.msg(
-                    (
-                        "Successfully received message (id {msgid}) via ZMQ and AMQP"
-                    ).format(msgid=msg_id)
-                )
-                del self.amqp_store[msg_id]
-                del self.zmq_store[msg_id]
-
-    def check_missing(self):
-        log.msg("Checking for missing messages", logLevel=logging.DEBUG)
-        self._check_store(self.amqp_store, "AMQP")
-        self._check_store(self.zmq_store, "ZeroMQ")
-
-    def _check_store(self, store, source_name):
-        threshold = datetime.utcnow() - timedelta(seconds=self.MATCH_WINDOW)
-        for msg_id, value in list(store.items()):
-            time, msg = value
-            if time < threshold:
-                log.msg(
-                    (
-                        "Message {msgid} was only received in {source} "
-                        "(at {time}, with topic {topic})"
-                    ).format(
-                        msgid=msg_id,
-                        source=source_name,
-                        time=time.isoformat(),
-                        topic=msg.get("topic", "NO TOPIC"),
-                    ),
-                    logLevel=logging.WARNING,
-                )
-                del store[msg_id]
-
-
-def get_main_service(zmq_endpoints):
-    amqp_store = {}
-    zmq_store = {}
+
+def get_main_service(zmq_endpoints, shard=None, report_queue=None):
+    """
+    Create the verify_missing service.
+
+    Args:
+        zmq_endpoints (list): The ZeroMQ endpoints to subscribe to.
+        shard (Shard): The shard of the messages to verify, if they are sharded.
+        report_queue (multiprocessing.Queue): The queue to put the statistics
+            in, rather than reporting them, if any.
+
+    Returns:
+        service.MultiService: The service.
+    """
+    digests = _get_config("digests")
+    if digests:
+        reactor.suggestThreadPoolSize(_get_config("digest_threads"))
     verify_service = service.MultiService()
-    comparator = Comparator(amqp_store, zmq_store)
+    comparator = make_comparator(Comparator, shard, report_queue)
     comparator.setServiceParent(verify_service)
-    zmq_consumer = ZmqConsumer(zmq_store, zmq_endpoints)
+    zmq_consumer = ZmqConsumer(
+        comparator.zmq_store, zmq_endpoints, comparator, digests, shard
+    )
     zmq_consumer.setServiceParent(verify_service)
-    amqp_consumer = AmqpConsumer(amqp_store)
+    amqp_consumer = AmqpConsumer(comparator.amqp_store, comparator, digests, shard)
     amqp_consumer.setServiceParent(verify_service)
     return verify_service
 
 
-def main(zmq_endpoints):
-    verify_service = get_main_service(zmq_endpoints)
+def main(zmq_endpoints, shard=None, report_queue=None):
+    verify_service = get_main_service(zmq_endpoints, shard, report_queue)
     verify_service.startService()
     try:
         reactor.run()
     except KeyboardInterrupt:
         verify_service.stopService()
         reactor.run()
+
+
+def _run_worker(conf, zmq_endpoints, shard, report_queue):
+    """
+    Run the verify_missing service for one shard, in a worker process.
+
+    Args:
+        conf (dict): The application configuration of the parent process.
+        zmq_endpoints (list): The ZeroMQ endpoints to subscribe to.
+        shard (Shard): The shard of the messages to verify.
+        report_queue (multiprocessing.Queue): The queue to put the statistics in.
+    """
+    config.conf.loaded = True
+    config.conf.update(conf)
+    config.conf.setup_logging()
+    log.PythonLoggingObserver(loggerName="verify_missing").start()
+    log.startLogging(log.NullFile())
+    log.msg("Starting the worker for shard {} of {}".format(shard.index, shard.count))
+    main(zmq_endpoints, shard, report_queue)
+
+
+class ShardReports(object):
+    """
+    Merge the statistics reported by the shards, and report them together.
+
+    The statistics are reported once every shard has sent its own, or
+    half a report interval after the first one did, so a stuck or dead worker
+    doesn't hold up the reports.
+
+    Args:
+        shards (int): The number of shards.
+        report_interval (int): How often the shards report, in seconds.
+        report_file (str): The path of the JSON file to write the reports to, if
+            any.
+        prefix_depth (int): How many components of the topics are used to
+            group the statistics.
+        clock (callable): The function returning the current time.
+    """
+
+    def __init__(
+        self,
+        shards,
+        report_interval=60,
+        report_file=None,
+        prefix_depth=4,
+        clock=time.monotonic,
+    ):
+        self.shards = shards
+        self.report_interval = report_interval
+        self.report_file = report_file
+        self.clock = clock
+        self.stats = MatchStats(prefix_depth)
+        self.match_window = None
+        self._reported = set()
+        self._deadline = None
+
+    def add(self, index, stats, match_window=None):
+        """
+        Merge the statistics of a shard, and report them if all shards did.
+
+        Args:
+            index (int): The shard index.
+            stats (dict): The statistics, from :meth:`MatchStats.to_dict`.
+            match_window (float): The adaptive match window of the shard, if
+                any. The widest one of the shards is reported.
+        """
+        if index in self._reported:
+            # This shard is a whole period ahead of a late one
+            self.flush()
+        self.stats.merge(MatchStats.from_dict(stats))
+        if match_window is not None:
+            self.match_window = max(self.match_window or 0, match_window)
+        self._reported.add(index)
+        if self._deadline is None:
+            self._deadline = self.clock() + self.report_interval / 2.0
+        if len(self._reported) == self.shards:
+            self.flush()
+
+    def maybe_flush(self):
+        """Report the merged statistics if some shards are late."""
+        if self._deadline is not None and self.clock() >= self._deadline:
+            missing = sorted(set(range(self.shards)) - self._reported)
+            _log.warning("Shards %s did not report in time", missing)
+            self.flush()
+
+    def flush(self):
+        """Report the merged statistics, and start a new period."""
+        if not self._reported:
+            return
+        report_stats(self.stats, self.report_file, self.match_window)
+        self.stats.reset()
+        self.match_window = None
+        self._reported = set()
+        self._deadline = None
+
+
+def main_sharded(zmq_endpoints, workers):
+    """
+    Run the verify_missing service in several processes, each one verifying
+    the messages whose ID falls in its shard, and merge their statistics.
+
+    Args:
+        zmq_endpoints (list): The ZeroMQ endpoints to subscribe to.
+        workers (int): The number of worker processes.
+    """
+    # Twisted's reactor does not survive forking
+    context = multiprocessing.get_context("spawn")
+    report_queue = context.Queue()
+    conf = dict(config.conf)
+    processes = []
+    for index in range(workers):
+        process = context.Process(
+            target=_run_worker,
+            args=(conf, zmq_endpoints, Shard(index, workers), report_queue),
+            name="verify_missing-{}".format(index),
+        )
+        process.start()
+        processes.append(process)
+    reports = ShardReports(
+        workers,
+        report_interval=_get_config("report_interval"),
+        report_file=_get_config("report_file") or None,
+        prefix_depth=_get_config("topic_prefix_depth"),
+    )
+    try:
+        while any(process.is_alive() for process in processes):
+            try:
+                report = report_queue.get(timeout=1)
+            except queue.Empty:
+                reports.maybe_flush()
+                continue
+            reports.add(*report)
+    except KeyboardInterrupt:
+        # The workers got the interrupt too, let them stop on their own
+        pass
+    finally:
+        for process in processes:
+            process.join(10)
+            if process.is_alive():
+                _log.warning("Terminating the stuck worker %s", process.name)
+                process.terminate()
+        reports.flush()
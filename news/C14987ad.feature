@@ -0,0 +1,2 @@
+Add ``verify_missing --offline AMQP_LOG ZMQ_LOG`` to compare two recorded
+message logs rather than the live buses.
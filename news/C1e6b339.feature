@@ -0,0 +1,3 @@
+The ZeroMQ to AMQP bridge uses a socket per endpoint, whose ``rcvhwm``, topics
+and weight can be set in ``[zmq_to_amqp.sources]``, and reports statistics per
+endpoint every ``report_interval`` seconds, optionally to ``report_file``.
@@ -0,0 +1,2 @@
+The ZeroMQ to AMQP bridge reloads its endpoints, topics and exchange on SIGHUP
+without restarting, and its systemd unit gains an ``ExecReload``.
@@ -0,0 +1,4 @@
+The bridges recommend ZeroMQ queue and buffer sizes from the bursts they
+observe, in their logs and their reports. With ``auto`` in the new
+``[zmq_to_amqp.tuning]`` table, the ZeroMQ to AMQP bridge applies them the next
+time an endpoint reconnects.
@@ -0,0 +1,4 @@
+On SIGTERM, the ZeroMQ to AMQP bridge publishes the messages it holds for up to
+``drain_timeout`` seconds, and writes the rest to ``spill_file`` to publish
+them on its next start. Its systemd unit waits 30 seconds for it with
+``TimeoutStopSec``.
@@ -0,0 +1,4 @@
+Add an ``amqp_to_zmq`` command bridging AMQP to ZeroMQ in batches: messages are
+sent back-to-back and acknowledged together. The batches are sized with
+``--batch-size`` and ``--batch-timeout``, or with the ``batch_size``,
+``batch_timeout`` and ``drain_timeout`` keys of ``[consumer_config]``.
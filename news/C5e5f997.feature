@@ -0,0 +1,2 @@
+verify_missing keeps the messages waiting to be matched across restarts when
+``state_file`` is set, saving them every ``state_interval`` seconds.
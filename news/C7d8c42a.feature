@@ -0,0 +1,4 @@
+Bound the memory of verify_missing with the ``max_entries`` and ``max_bytes``
+keys of the new ``[verify_missing.store]`` table. The oldest entries over the
+limits are spilled to SQLite files named after ``spill_path``, one per store,
+or only counted with ``overflow = "count"``.
@@ -0,0 +1,2 @@
+Add ``verify_missing --engine asyncio`` and the ``engine`` key, to run
+verify_missing on asyncio instead of Twisted.
@@ -0,0 +1,4 @@
+The match window of verify_missing is set with ``match_window`` and the
+interval between checks with ``check_interval``. With ``adaptive_window``, the
+window follows the observed latencies, within ``match_window_min`` and
+``match_window_max``.
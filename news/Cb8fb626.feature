@@ -0,0 +1,6 @@
+The bridges log their ZeroMQ connections and disconnections. The
+``reconnect_ivl``, ``reconnect_ivl_max``, ``heartbeat_ivl`` and
+``heartbeat_timeout`` socket options can be set, and ``stall_timeout`` warns
+about silent endpoints. The AMQP to ZeroMQ bridge reports its publication rate
+and connection counters every ``report_interval`` seconds of
+``[consumer_config]``, optionally to ``report_file``.
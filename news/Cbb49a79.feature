@@ -0,0 +1,4 @@
+The bridges notify systemd when they are ready and stopping, report their
+throughput in their status, and ping its watchdog while they make progress.
+Both units use ``Type=notify`` and ``WatchdogSec=30``, and the AMQP to ZeroMQ
+unit runs the ``amqp_to_zmq`` command.
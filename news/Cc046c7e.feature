@@ -0,0 +1,4 @@
+Add a ``replay`` command publishing captured or exported messages to ZeroMQ or
+AMQP, paced on their recorded times with ``--speed``, over several
+``--publishers``, and limited with ``--start`` and ``--end``. Its defaults are
+set in the new ``[replay]`` section.
@@ -0,0 +1,2 @@
+The ZeroMQ to AMQP bridge can limit the rate of the messages it publishes,
+globally or by topic prefix, with the new ``[zmq_to_amqp.shaping]`` table.
@@ -0,0 +1,2 @@
+The ZeroMQ to AMQP bridge can publish some topics ahead of others, with
+weighted priority classes set in the new ``[zmq_to_amqp.lanes]`` table.
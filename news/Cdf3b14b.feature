@@ -0,0 +1,2 @@
+Add ``verify_missing --workers`` and the ``workers`` key, to split the
+verification over several processes, each with its own AMQP queue.
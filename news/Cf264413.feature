@@ -0,0 +1,3 @@
+verify_missing can compare the bodies of matched messages with ``digests =
+true``, hashing them in ``digest_threads`` threads, and counts the mismatches
+in its reports.
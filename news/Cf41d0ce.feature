@@ -0,0 +1,4 @@
+verify_missing reports the messages matched, missing and duplicated, and their
+latency, by topic prefix every ``report_interval`` seconds. The full report can
+be written to ``report_file`` as JSON, and ``topic_prefix_depth`` sets how
+topics are grouped.
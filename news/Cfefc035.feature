@@ -0,0 +1,4 @@
+Add a ``capture`` command recording the ZeroMQ and AMQP buses to rotating,
+indexed segment files, configured in the new ``[capture]`` section, and a
+``find`` command printing a captured message from its ID. verify_missing
+``--offline`` also reads capture directories.
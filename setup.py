@@ -73,6 +73,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=get_requirements(),
+    extras_require={"zstd": ["zstandard"]},
     tests_require=get_requirements(requirements_file="dev-requirements.txt"),
     test_suite="fedmsg_migration_tools.tests",
     entry_points={